@@ -13,36 +13,40 @@ import asyncio
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import os, django
+
+# Django setup, before anything imports models, so the app can also be started on its own with uvicorn
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatRAG.settings')
+django.setup()
+
 from asgiref.sync import sync_to_async
 from pgvector.django import CosineDistance
-from django.db.models import Q
 from typing import List, Dict, Any
-from django.db.models import Q
 from datetime import datetime
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
 from core.models import VectorDB
-from rerankers import Reranker
+from core.document_catalog import metadata_filter, filter_chunks
 from typing import Optional
 from django.contrib.postgres.search import SearchVector, SearchRank 
-import cohere
 
 def print_timestamp():
     current_time = datetime.now()
     formatted_time = current_time.strftime("%Y-%m-%d %H:%M:%S")
     print(f"Current timestamp: {formatted_time}")
 
-# Django setup
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatRAG.settings')
-django.setup()
-
 # FastAPI app setup
 app = FastAPI()
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
-cohere_api_key = os.getenv("COHERE_API_KEY")
-co = cohere.Client(cohere_api_key)
+_cohere_client = None
+
+def get_cohere_client():
+    """Creates the Cohere client on the first rerank, so importing the app stays fast."""
+    global _cohere_client
+    if _cohere_client is None:
+        import cohere
+
+        # CO_API_URL overrides the Cohere endpoint, e.g. with the fake rerank server of the latency benchmark
+        _cohere_client = cohere.Client(os.getenv("COHERE_API_KEY"), base_url=os.getenv("CO_API_URL"))
+    return _cohere_client
 
 # Define request model
 class SearchRequest(BaseModel):
@@ -59,21 +63,21 @@ async def perform_hybrid_search(db_name, query_vector, top_k, query, twin_versio
 
     try:
         # Initialize metadata filter
-        metadata_filters = Q()
-        if meta_data:
-            for key, value in meta_data.items():
-                if value is not None:
-                    metadata_filters &= Q(**{f'meta_data__{key}__icontains': value})
+        metadata_filters = metadata_filter(meta_data)
 
         # Perform filtering first
-        filtered_results = await sync_to_async(list)(
-            db_name.objects.filter(twin_version_id=twin_version_id).filter(metadata_filters)
-        ) or []
-
-        if filtered_results:
+        chunks = db_name.objects.filter(twin_version_id=twin_version_id)
+        if metadata_filters and db_name is VectorDB:
+            # Resolved on the document catalog, one row per document, then joined to their chunks.
+            # Chunks not in the catalog yet are filtered on their own metadata.
+            chunks = filter_chunks(chunks, twin_version_id, meta_data)
+        elif metadata_filters:
+            chunks = chunks.filter(metadata_filters)
+        filtered_ids = await sync_to_async(list)(chunks.values_list("id", flat=True)) or []
+
+        if filtered_ids:
             print("Starting keyword search and vector search...")
             # Perform BM25 Keyword Search and Vector Search in the same block
-            filtered_ids = [r.id for r in filtered_results]
 
             keyword_results, vector_results = await asyncio.gather(
                 sync_to_async(list)(
@@ -146,7 +150,7 @@ async def perform_hybrid_search(db_name, query_vector, top_k, query, twin_versio
         documents = [result.text for result in sorted_results]
 
         # Call Cohere's Rerank API
-        response = co.rerank(
+        response = get_cohere_client().rerank(
             model='rerank-v3.5',
             query=query,
             documents=documents,
@@ -157,7 +161,10 @@ async def perform_hybrid_search(db_name, query_vector, top_k, query, twin_versio
         reranked_results = [sorted_results[result.index] for result in response.results]
 
         # Final formatted results
-        final_results = [{"text": result.text, "pdf": result.pdf} for result in reranked_results]
+        final_results = [
+            {"id": result.id, "text": result.text, "pdf": result.pdf, "token_count": result.token_count, "meta_data": result.meta_data}
+            for result in reranked_results
+        ]
 
         print("Hybrid search and reranking complete.")
         return final_results
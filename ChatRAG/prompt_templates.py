@@ -2,6 +2,10 @@
 Prompt templates for different twin IDs in the chatbot system.
 Each template defines how the chatbot should behave for a specific twin ID.
 """
+import json
+import os
+import threading
+from django.conf import settings
 
 # Default RAG prompt template for general queries
 prompt = [
@@ -64,36 +68,120 @@ TWIN_PROMPT_TEMPLATES = {
     "default": DEFAULT_PROMPT_TEMPLATE
 }
 
-SIMILAR_QUERY_TWIN_ID = "b7586e58-9a07-47f6-8049-43d6d6f2c5e54455"
+
+SIMILAR_RESPONSE_TEMPLATE = (
+    "This is my previous response to a similar query:\n"
+    "{similar_response}\n"
+    "Please make the new response as consistent as possible with the above, "
+    "but do not neglect any new information provided. Update or add to the answer as needed."
+)
+
+
+class CompiledPromptTemplate:
+    """
+    A twin's prompt template split into a static prefix and the query message.
+
+    All messages without a {query} placeholder form the prefix, in their original order, and
+    the query message is placed after them. Every request of a twin then starts with the same
+    messages, which lets the provider reuse its cached prefix. The prefix messages are shared
+    between requests and must not be modified.
+    """
+
+    def __init__(self, messages):
+        self.prefix = []
+        self.query_parts = None
+
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str) and "{query}" in content and self.query_parts is None:
+                before, after = content.split("{query}", 1)
+                self.query_role = message["role"]
+                self.query_parts = (before, after)
+            else:
+                self.prefix.append(dict(message))
+
+        self.prefix = tuple(self.prefix)
+
+    def render(self, query, similar_response=None):
+        messages = list(self.prefix)
+        if self.query_parts is not None:
+            before, after = self.query_parts
+            messages.append({"role": self.query_role, "content": before + query + after})
+        if similar_response:
+            messages.append({
+                "role": "system",
+                "content": SIMILAR_RESPONSE_TEMPLATE.replace("{similar_response}", similar_response),
+            })
+        return messages
+
+
+class PromptTemplateRegistry:
+    """
+    Holds the compiled prompt template of every twin.
+
+    The built-in templates above are compiled when the module is imported. Templates in the
+    optional JSON file set by PROMPT_TEMPLATES_FILE ({"<twin_id>": [messages]}) are added on
+    top of them, and the file is re-read whenever it changes so templates can be edited
+    without restarting the workers.
+    """
+
+    def __init__(self, templates, templates_file=None):
+        self.builtin_templates = templates
+        self.templates_file = templates_file
+        self._file_mtime = None
+        self._lock = threading.Lock()
+        self._compiled = self._compile(templates)
+
+    @staticmethod
+    def _compile(templates):
+        return {twin_id: CompiledPromptTemplate(messages) for twin_id, messages in templates.items()}
+
+    def _refresh(self):
+        if not self.templates_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.templates_file)
+        except OSError:
+            mtime = None
+        if mtime == self._file_mtime:
+            return
+
+        with self._lock:
+            if mtime == self._file_mtime:
+                return
+            templates = dict(self.builtin_templates)
+            if mtime is not None:
+                try:
+                    with open(self.templates_file, 'r') as f:
+                        templates.update(json.load(f))
+                except (OSError, ValueError) as e:
+                    print(f"Error loading prompt templates from {self.templates_file}: {e}")
+                    return
+            self._compiled = self._compile(templates)
+            self._file_mtime = mtime
+            print(f"Compiled prompt templates for {len(self._compiled)} twins")
+
+    def get(self, twin_id):
+        self._refresh()
+        return self._compiled.get(twin_id) or self._compiled["default"]
+
+
+prompt_template_registry = PromptTemplateRegistry(
+    TWIN_PROMPT_TEMPLATES,
+    getattr(settings, "PROMPT_TEMPLATES_FILE", None),
+)
 
 
 def get_prompt_template(twin_id, query, similar_response=None):
     """
     Get the prompt template for a specific twin ID and format it with the query.
+    The static instructions come first and the query message follows them.
     
     Args:
         twin_id (str): The twin ID to get the template for
         query (str): The user query to insert into the template
+        similar_response (str): Previous answer to a similar query, if one was found
     Returns:
         list: The formatted prompt template messages
     """
-    template = TWIN_PROMPT_TEMPLATES.get(twin_id, DEFAULT_PROMPT_TEMPLATE)
-    formatted_template = [message.copy() for message in template]
-    
-    for message in formatted_template:
-        if isinstance(message["content"], str) and "{query}" in message["content"]:
-            message["content"] = message["content"].format(query=query)
-    
-    # If this is the special twin and similar_response is provided, append the context
-    if twin_id == SIMILAR_QUERY_TWIN_ID and similar_response:
-        formatted_template.append({
-            "role": "system",
-            "content": (
-                "This is my previous response to a similar query:\n"
-                f"{similar_response}\n"
-                "Please make the new response as consistent as possible with the above, "
-                "but do not neglect any new information provided. Update or add to the answer as needed."
-            )
-        })
-    return formatted_template        
-    
\ No newline at end of file
+    return prompt_template_registry.get(twin_id).render(query, similar_response)
@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/5.0/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
+import json
 import os
 from dotenv import load_dotenv
 from pathlib import Path
@@ -94,14 +95,15 @@ WSGI_APPLICATION = "ChatRAG.wsgi.application"
 #         'PORT': '5433'
 #     }
 # }
+# DB_* environment variables point the app at another database, e.g. a local pgvector for the latency benchmark
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'chatbot',
-        'USER': 'admin',
-        'PASSWORD': '1234qwer$$',
-        'HOST': '52.21.129.119',
-        'PORT': '5432'
+        'NAME': os.getenv('DB_NAME', 'chatbot'),
+        'USER': os.getenv('DB_USER', 'admin'),
+        'PASSWORD': os.getenv('DB_PASSWORD', '1234qwer$$'),
+        'HOST': os.getenv('DB_HOST', '52.21.129.119'),
+        'PORT': os.getenv('DB_PORT', '5432')
     }
 }
 
@@ -149,6 +151,115 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chatrag-default',
+    }
+}
+
+# Seconds a twin's metadata schema is kept in memory before it is read from the database again
+METADATA_SCHEMA_TTL = int(os.getenv('METADATA_SCHEMA_TTL', 60))
+
+# Seconds an extracted metadata filter is reused for the same twin and query
+METADATA_CACHE_TTL = int(os.getenv('METADATA_CACHE_TTL', 3600))
+
+# Semantic answer cache over previous chat turns of the same twin.
+# Above the return threshold the previous answer is sent back as is,
+# above the context threshold it is added to the prompt as a reference answer.
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+ANSWER_CACHE_RETURN_THRESHOLD = float(os.getenv('ANSWER_CACHE_RETURN_THRESHOLD', 0.97))
+ANSWER_CACHE_CONTEXT_THRESHOLD = float(os.getenv('ANSWER_CACHE_CONTEXT_THRESHOLD', 0.90))
+# Only turns of the last days are searched, so the lookup stays in the recent chat_history partitions
+ANSWER_CACHE_MAX_AGE_DAYS = int(os.getenv('ANSWER_CACHE_MAX_AGE_DAYS', 90))
+
+# Optional JSON file with prompt templates per twin, re-read when it changes
+PROMPT_TEMPLATES_FILE = os.getenv('PROMPT_TEMPLATES_FILE', os.path.join(BASE_DIR, 'prompt_templates.json'))
+
+# Chat turns are written to chat_history in the background after the response is sent
+CHAT_HISTORY_WRITE_BEHIND = os.getenv('CHAT_HISTORY_WRITE_BEHIND', 'true').lower() == 'true'
+CHAT_HISTORY_WRITE_BATCH_SIZE = int(os.getenv('CHAT_HISTORY_WRITE_BATCH_SIZE', 50))
+CHAT_HISTORY_FLUSH_INTERVAL = float(os.getenv('CHAT_HISTORY_FLUSH_INTERVAL', 0.5))
+
+# Conversation memory of the chat instances, shared by all workers. "database" keeps it in the
+# chat_memory table, "cache" in the cache named by CONVERSATION_MEMORY_CACHE_ALIAS (e.g. Redis).
+# Each worker keeps up to CONVERSATION_MEMORY_LOCAL_SIZE chats for CONVERSATION_MEMORY_LOCAL_TTL seconds.
+CONVERSATION_MEMORY_BACKEND = os.getenv('CONVERSATION_MEMORY_BACKEND', 'database')
+CONVERSATION_MEMORY_CACHE_ALIAS = os.getenv('CONVERSATION_MEMORY_CACHE_ALIAS', 'default')
+CONVERSATION_MEMORY_TTL = int(os.getenv('CONVERSATION_MEMORY_TTL', 7 * 86400))
+# Turns are kept while they fit in the token budget, older ones are folded into a summary
+CONVERSATION_MEMORY_MAX_TURNS = int(os.getenv('CONVERSATION_MEMORY_MAX_TURNS', 10))
+CONVERSATION_MEMORY_TOKEN_BUDGET = int(os.getenv('CONVERSATION_MEMORY_TOKEN_BUDGET', 1000))
+CONVERSATION_SUMMARY_MAX_WORDS = int(os.getenv('CONVERSATION_SUMMARY_MAX_WORDS', 120))
+CONVERSATION_MEMORY_LOCAL_SIZE = int(os.getenv('CONVERSATION_MEMORY_LOCAL_SIZE', 10000))
+CONVERSATION_MEMORY_LOCAL_TTL = float(os.getenv('CONVERSATION_MEMORY_LOCAL_TTL', 2))
+# A chat's memory is rebuilt from its chat_history turns of the last days only
+CONVERSATION_MEMORY_HYDRATE_DAYS = int(os.getenv('CONVERSATION_MEMORY_HYDRATE_DAYS', 30))
+
+# Chat history items returned per page by load_chat_history_api, by default and at most
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', 200))
+# Documents returned per page by get_documents_list_api, by default and at most
+DOCUMENT_LIST_PAGE_SIZE = int(os.getenv('DOCUMENT_LIST_PAGE_SIZE', 50))
+DOCUMENT_LIST_MAX_PAGE_SIZE = int(os.getenv('DOCUMENT_LIST_MAX_PAGE_SIZE', 200))
+
+# chat_history is partitioned by month (manage.py partition_chat_history). archive_chat_history
+# keeps CHAT_HISTORY_PARTITIONS_AHEAD future partitions and archives rows older than the
+# retention, CHAT_HISTORY_RETENTION_DAYS_PER_TWIN is a JSON object of per twin overrides.
+CHAT_HISTORY_PARTITIONS_AHEAD = int(os.getenv('CHAT_HISTORY_PARTITIONS_AHEAD', 3))
+CHAT_HISTORY_RETENTION_DAYS = int(os.getenv('CHAT_HISTORY_RETENTION_DAYS', 365))
+CHAT_HISTORY_RETENTION_DAYS_PER_TWIN = json.loads(os.getenv('CHAT_HISTORY_RETENTION_DAYS_PER_TWIN', '{}'))
+CHAT_HISTORY_ARCHIVE_DIR = os.getenv('CHAT_HISTORY_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive', 'chat_history'))
+# Rows fetched from the server-side cursor at a time by the chat history export, also the Parquet row group size
+CHAT_HISTORY_EXPORT_CHUNK_SIZE = int(os.getenv('CHAT_HISTORY_EXPORT_CHUNK_SIZE', 2000))
+
+# Seconds the last retrieval of a chat instance is kept for follow-up queries
+RETRIEVAL_WORKING_SET_TTL = int(os.getenv('RETRIEVAL_WORKING_SET_TTL', 1800))
+
+# Speculative retrieval: the unfiltered search starts together with the metadata extraction
+# and the filter is applied to its SPECULATIVE_TOP_K candidates. With 48, keyword and vector
+# candidates together stay within one Cohere rerank search unit (100 documents).
+SPECULATIVE_RETRIEVAL_ENABLED = os.getenv('SPECULATIVE_RETRIEVAL_ENABLED', 'true').lower() == 'true'
+SPECULATIVE_RETRIEVAL_DISABLED_TWINS = [
+    twin for twin in os.getenv('SPECULATIVE_RETRIEVAL_DISABLED_TWINS', '').split(',') if twin
+]
+SPECULATIVE_TOP_K = int(os.getenv('SPECULATIVE_TOP_K', 48))
+# Fewer filtered candidates than this and the filtered search is run after all
+SPECULATIVE_MIN_CANDIDATES = int(os.getenv('SPECULATIVE_MIN_CANDIDATES', 6))
+SPECULATIVE_SEARCH_WORKERS = int(os.getenv('SPECULATIVE_SEARCH_WORKERS', 16))
+# Share of speculative requests also searched with the filter to measure the recall per twin,
+# twins below SPECULATIVE_MIN_RECALL after SPECULATIVE_MIN_SAMPLES audits stop speculating
+SPECULATIVE_AUDIT_RATE = float(os.getenv('SPECULATIVE_AUDIT_RATE', 0.05))
+SPECULATIVE_MIN_RECALL = float(os.getenv('SPECULATIVE_MIN_RECALL', 0.8))
+SPECULATIVE_MIN_SAMPLES = int(os.getenv('SPECULATIVE_MIN_SAMPLES', 10))
+
+# Per request cost and latency ledger, written in batches like the chat history
+REQUEST_LEDGER_ENABLED = os.getenv('REQUEST_LEDGER_ENABLED', 'true').lower() == 'true'
+
+# USD per million tokens as (input, output), used for the cost in the request ledger
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'text-embedding-3-small': (0.02, 0),
+    'text-embedding-ada-002': (0.10, 0),
+}
+# USD per Cohere rerank search unit (up to 100 documents)
+RERANK_PRICE_PER_SEARCH = float(os.getenv('RERANK_PRICE_PER_SEARCH', 0.002))
+
+# Query router of the decision pipeline. SENSOR_NAMES_FILE is an optional JSON file with the
+# known sensor names per twin. A query is routed by its nearest example query when the
+# similarity and the lead over the next route are above these values, otherwise by the LLM.
+SENSOR_NAMES_FILE = os.getenv('SENSOR_NAMES_FILE', os.path.join(BASE_DIR, 'sensor_names.json'))
+ROUTER_PROTOTYPE_THRESHOLD = float(os.getenv('ROUTER_PROTOTYPE_THRESHOLD', 0.5))
+ROUTER_PROTOTYPE_MARGIN = float(os.getenv('ROUTER_PROTOTYPE_MARGIN', 0.08))
+# Seconds an LLM routing decision is reused for the same twin and query
+ROUTER_CACHE_TTL = int(os.getenv('ROUTER_CACHE_TTL', 86400))
+
+# Search service (FastAPI app started by manage.py runserver)
+SEARCH_SERVICE_URL = os.getenv('SEARCH_SERVICE_URL', 'http://127.0.0.1:8201')
+
 # CORS_ALLOWED_ORIGINS = [
 #     "http://localhost:5173", 
 # ]
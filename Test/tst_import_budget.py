@@ -0,0 +1,82 @@
+"""
+Cold start budget check.
+
+Measures, each in a fresh interpreter, how long it takes to load the Django app with all its
+URLs (what a worker does before serving the first request) and to import the FastAPI search
+service. Prints the slowest imports from `python -X importtime` and exits with 1 when a
+target is over its budget, so it can run in CI.
+
+Run from the repository root:
+    python Test/tst_import_budget.py
+    python Test/tst_import_budget.py --django-budget 1.5 --search-budget 2 --top 20
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    "django": (
+        "import os, django\n"
+        "os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatRAG.settings')\n"
+        "django.setup()\n"
+        "import ChatRAG.urls\n"
+    ),
+    "search": "import ChatRAG.document_db_service_pgvector_rerank\n",
+}
+
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure(code):
+    """Returns (seconds, [(cumulative_us, module), ...]) for running the code in a new interpreter."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        raise RuntimeError("Import failed")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        # Only top level imports, nested ones are included in their parent's time
+        if match and len(match.group(3)) == 1:
+            imports.append((int(match.group(2)), match.group(4)))
+    return seconds, sorted(imports, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--django-budget", type=float, default=float(os.getenv("DJANGO_IMPORT_BUDGET", 3)))
+    parser.add_argument("--search-budget", type=float, default=float(os.getenv("SEARCH_IMPORT_BUDGET", 3)))
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to show")
+    args = parser.parse_args()
+
+    budgets = {"django": args.django_budget, "search": args.search_budget}
+    over_budget = False
+
+    for name, code in TARGETS.items():
+        seconds, imports = measure(code)
+        status = "OK" if seconds <= budgets[name] else "OVER BUDGET"
+        over_budget = over_budget or seconds > budgets[name]
+
+        print(f"{name}: {seconds:.2f}s (budget {budgets[name]:.2f}s) {status}")
+        for cumulative_us, module in imports[:args.top]:
+            print(f"    {cumulative_us / 1e6:6.3f}s  {module}")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
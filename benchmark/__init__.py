@@ -0,0 +1,49 @@
+"""
+Offline end to end latency benchmark.
+
+The OpenAI API and Cohere rerank are replaced by local stand-ins (fake_openai_server.py and
+fake_rerank_server.py) and the database is a local pgvector seeded with synthetic twins, so
+latency can be compared between changes without network calls or API cost.
+
+    python manage.py seed_benchmark_data
+    python manage.py run_latency_benchmark --concurrency 1 4 16
+
+Both commands refuse to run unless DB_HOST points at a local database.
+"""
+import random
+
+TWIN_PREFIX = "benchmark-twin-"
+
+FAKE_OPENAI_PORT = 8301
+FAKE_RERANK_PORT = 8302
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1", "")
+
+DOCUMENT_TYPES = ["manual", "report", "specification", "service agreement", "purchase order"]
+
+VOCABULARY = (
+    "compressor generator chiller pump valve boiler turbine motor fan filter sensor controller "
+    "pressure temperature humidity vibration voltage current flow level speed torque load "
+    "maintenance inspection calibration replacement warranty service schedule interval "
+    "failure alarm fault shutdown restart overheating leak corrosion wear noise efficiency "
+    "manual report specification agreement order proposal invoice certificate drawing "
+    "installation commissioning operation safety procedure checklist requirement limit "
+    "site building floor room zone area plant line unit system network panel cabinet "
+    "oil water air gas refrigerant coolant fuel lubricant belt bearing seal gasket coil "
+    "daily weekly monthly quarterly annual hours cycles runtime downtime uptime capacity "
+    "supplier vendor contractor technician engineer operator manager client owner"
+).split()
+
+
+def synthetic_text(rng, words):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def synthetic_queries(count, seed=0):
+    """Deterministic list of questions built from the same vocabulary as the seeded chunks."""
+    rng = random.Random(seed)
+    return [f"What does the {synthetic_text(rng, rng.randint(4, 10))} say?" for _ in range(count)]
+
+
+def is_local_database(database):
+    return database.get("HOST", "") in LOCAL_HOSTS
@@ -0,0 +1,155 @@
+"""
+OpenAI compatible stand-in for the latency benchmark.
+
+Serves /v1/embeddings and /v1/chat/completions (also streamed) with a configurable latency, so the
+pipeline can be measured without network calls or API cost. Embeddings are deterministic: every
+word gets a fixed random vector and a text is the normalized sum of its words, so texts that share
+words are close to each other like they would be with a real embedding model.
+
+The OpenAI SDK picks it up through OPENAI_BASE_URL, e.g. OPENAI_BASE_URL=http://127.0.0.1:8301/v1
+
+Latency is set in milliseconds with FAKE_OPENAI_EMBEDDING_LATENCY_MS, FAKE_OPENAI_CHAT_LATENCY_MS
+(time to first token) and FAKE_OPENAI_TOKEN_LATENCY_MS (per streamed token). FAKE_OPENAI_JITTER
+adds up to that fraction of random extra latency.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+from functools import lru_cache
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBEDDING_DIMENSIONS = 1536
+
+EMBEDDING_LATENCY_MS = float(os.getenv("FAKE_OPENAI_EMBEDDING_LATENCY_MS", 60))
+CHAT_LATENCY_MS = float(os.getenv("FAKE_OPENAI_CHAT_LATENCY_MS", 400))
+TOKEN_LATENCY_MS = float(os.getenv("FAKE_OPENAI_TOKEN_LATENCY_MS", 15))
+JITTER = float(os.getenv("FAKE_OPENAI_JITTER", 0.2))
+ANSWER_WORDS = int(os.getenv("FAKE_OPENAI_ANSWER_WORDS", 60))
+
+app = FastAPI()
+
+
+@lru_cache(maxsize=50000)
+def _word_vector(word):
+    seed = int.from_bytes(hashlib.sha256(word.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS)
+
+
+def deterministic_embedding(text):
+    """Returns the same unit vector for the same text. Also used to seed the benchmark database."""
+    words = re.findall(r"\w+", (text or "").lower()) or [""]
+    vector = np.sum([_word_vector(word) for word in words], axis=0)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def _count_tokens(text):
+    # Rough estimate, only used for the usage numbers
+    return max(1, len(str(text)) // 4)
+
+
+async def _sleep(latency_ms):
+    await asyncio.sleep(latency_ms * (1 + random.uniform(0, JITTER)) / 1000)
+
+
+def _completion_text(body):
+    # Metadata extraction and the decision pipeline expect a JSON object in the answer
+    prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+    json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+    if json_mode or "extract the following metadata" in prompt.lower():
+        return json.dumps({"document_type": None})
+
+    words = re.findall(r"\w+", prompt) or ["answer"]
+    rng = random.Random(prompt)
+    return " ".join(rng.choice(words) for _ in range(ANSWER_WORDS)) + "."
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    await _sleep(EMBEDDING_LATENCY_MS)
+
+    prompt_tokens = sum(_count_tokens(text) for text in inputs)
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": deterministic_embedding(text)}
+            for i, text in enumerate(inputs)
+        ],
+        "model": body.get("model", "text-embedding-3-small"),
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "gpt-4o-mini")
+    messages = body.get("messages", [])
+    text = _completion_text(body)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    usage = {
+        "prompt_tokens": sum(_count_tokens(message.get("content", "")) for message in messages),
+        "completion_tokens": _count_tokens(text),
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+    await _sleep(CHAT_LATENCY_MS)
+
+    if not body.get("stream"):
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    async def stream():
+        tokens = re.findall(r"\S+\s*", text)
+        for token in tokens:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await _sleep(TOKEN_LATENCY_MS)
+
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
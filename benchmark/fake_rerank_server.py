@@ -0,0 +1,59 @@
+"""
+Cohere rerank stand-in for the latency benchmark.
+
+Serves /v1/rerank and /v2/rerank with a configurable latency. Documents are scored by the
+share of query words they contain. The search service picks it up through CO_API_URL,
+e.g. CO_API_URL=http://127.0.0.1:8302
+
+Latency is set in milliseconds with FAKE_RERANK_LATENCY_MS, FAKE_RERANK_JITTER adds up to
+that fraction of random extra latency.
+"""
+import asyncio
+import os
+import random
+import re
+import uuid
+from fastapi import FastAPI, Request
+
+LATENCY_MS = float(os.getenv("FAKE_RERANK_LATENCY_MS", 120))
+JITTER = float(os.getenv("FAKE_RERANK_JITTER", 0.2))
+
+app = FastAPI()
+
+
+def _score(query_words, document):
+    if not query_words:
+        return 0.0
+    document_words = set(re.findall(r"\w+", document.lower()))
+    return len(query_words & document_words) / len(query_words)
+
+
+async def _rerank(request: Request):
+    body = await request.json()
+    query_words = set(re.findall(r"\w+", body.get("query", "").lower()))
+    documents = [
+        document if isinstance(document, str) else document.get("text", "")
+        for document in body.get("documents", [])
+    ]
+    await asyncio.sleep(LATENCY_MS * (1 + random.uniform(0, JITTER)) / 1000)
+
+    scores = sorted(
+        ((_score(query_words, document), index) for index, document in enumerate(documents)),
+        reverse=True,
+    )
+    top_n = body.get("top_n") or len(documents)
+    return {
+        "id": str(uuid.uuid4()),
+        "results": [{"index": index, "relevance_score": score} for score, index in scores[:top_n]],
+        "meta": {"api_version": {"version": "1"}, "billed_units": {"search_units": 1}},
+    }
+
+
+@app.post("/v1/rerank")
+async def rerank_v1(request: Request):
+    return await _rerank(request)
+
+
+@app.post("/v2/rerank")
+async def rerank_v2(request: Request):
+    return await _rerank(request)
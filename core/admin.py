@@ -1,5 +1,19 @@
 from django.contrib import admin
-from .models import VectorDB
+from .models import Document, VectorDB, MetaDataAttributes
 
 
 admin.site.register(VectorDB)
+
+
+@admin.register(MetaDataAttributes)
+class MetaDataAttributesAdmin(admin.ModelAdmin):
+    list_display = ('twin_version_id', 'meta_data_name', 'position', 'updated_at')
+    list_filter = ('twin_version_id',)
+    ordering = ('twin_version_id', 'position')
+
+
+@admin.register(Document)
+class DocumentAdmin(admin.ModelAdmin):
+    list_display = ('name', 'pdf_id', 'twin_id', 'twin_version_id', 'chunk_count', 'created_at')
+    list_filter = ('twin_id',)
+    search_fields = ('name', 'pdf_id')
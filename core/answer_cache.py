@@ -0,0 +1,76 @@
+"""
+Semantic answer cache over ChatHistory.
+
+Every saved chat turn keeps the embedding of its user query. A new query is matched against
+the nearest previous query of the same twin through the HNSW index on chat_history, among the
+turns of the last ANSWER_CACHE_MAX_AGE_DAYS days. Turns are marked as no longer cacheable when
+the twin's documents change, so answers built from old documents are not reused, and the
+twin's retrieval working sets are made stale with them.
+
+Embeddings barely tell "pump 3" from "pump 4", so an answer is only returned as is when both
+queries name the same numbers and codes (same_identifiers); otherwise the previous answer is
+only context for the new one.
+"""
+import re
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from pgvector.django import CosineDistance
+from core.models import ChatHistory
+from core.retrieval_working_set import bump_generation
+
+NUMBER_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+# Upper case codes like "AHU" or "RFI", from two letters on
+CODE_PATTERN = re.compile(r'\b[A-Z]{2,}\b')
+
+
+def query_identifiers(query):
+    """The numbers (without leading zeros) and upper case codes of a query, e.g. RFI-112 -> {"112", "RFI"}."""
+    numbers = {number.lstrip("0") or "0" for number in NUMBER_PATTERN.findall(query or "")}
+    return numbers | set(CODE_PATTERN.findall(query or ""))
+
+
+def same_identifiers(query, previous_query):
+    """Whether an answer to previous_query can be returned for query without asking the LLM."""
+    return query_identifiers(query) == query_identifiers(previous_query)
+
+
+def lookup_similar_answer(twin_version_id, query_vector):
+    """
+    Returns (similarity, chatbot_response, user_query) for the closest previous query of the
+    twin. chatbot_response and user_query are None when nothing is above the context threshold.
+    """
+    if not settings.ANSWER_CACHE_ENABLED or not twin_version_id:
+        return 0, None, None
+
+    since = timezone.now() - timedelta(days=settings.ANSWER_CACHE_MAX_AGE_DAYS)
+    nearest = (
+        ChatHistory.objects.filter(
+            twin_id=twin_version_id, cacheable=True, query_embedding__isnull=False, created_at__gte=since,
+        )
+        .annotate(distance=CosineDistance("query_embedding", query_vector))
+        .order_by("distance")
+        .values("user_query", "chatbot_response", "distance")
+        .first()
+    )
+    if not nearest:
+        return 0, None, None
+
+    similarity = 1 - nearest["distance"]
+    print(f"Closest previous query similarity: {similarity:.4f}")
+    if similarity < settings.ANSWER_CACHE_CONTEXT_THRESHOLD:
+        return similarity, None, None
+    return similarity, nearest["chatbot_response"], nearest["user_query"]
+
+
+def invalidate_answer_cache(twin_version_id):
+    """Stops reusing the previous answers and retrievals of a twin whose documents have changed."""
+    try:
+        bump_generation(twin_version_id)
+    except Exception as e:
+        print(f"Error invalidating working sets for twin_version_id {twin_version_id}: {e}")
+    try:
+        updated = ChatHistory.objects.filter(twin_id=twin_version_id, cacheable=True).update(cacheable=False)
+        print(f"Invalidated {updated} cached answers for twin_version_id: {twin_version_id}")
+    except Exception as e:
+        print(f"Error invalidating cached answers for twin_version_id {twin_version_id}: {e}")
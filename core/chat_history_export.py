@@ -0,0 +1,206 @@
+"""
+Streaming export of the chat history.
+
+The chat turns of a twin and time range are read through a server-side cursor
+(QuerySet.iterator), CHAT_HISTORY_EXPORT_CHUNK_SIZE rows at a time, and written out as they
+arrive, so an export of any size runs in constant memory. With include_retrieval every turn
+is joined with the RequestLedger row of the request that answered it (by request_id, one
+query per chunk of turns): endpoint, status, latency, cost, caches hit and the metadata
+filter and chunk ids that were retrieved. Turns saved before request ids existed have no
+retrieval.
+
+NDJSON needs nothing else. Parquet needs pyarrow, which is optional: every chunk becomes a
+row group that is handed out as soon as it is written.
+"""
+import json
+from datetime import datetime, time
+from itertools import islice
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from core.models import ChatHistory, RequestLedger
+
+FORMATS = ("ndjson", "parquet")
+
+EXPORT_COLUMNS = ("id", "chat_instance_id", "twin_id", "user_query", "chatbot_response", "cacheable", "created_at", "request_id")
+
+RETRIEVAL_COLUMNS = ("endpoint", "status_code", "total_ms", "cost_usd", "cache_hits", "retrieval")
+
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class ExportFormatError(Exception):
+    pass
+
+
+def parse_export_time(value):
+    """Parses an ISO 8601 time or date (midnight), naive values are in the current time zone. Raises ValueError."""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f"{value} is not an ISO 8601 time or date")
+        parsed = datetime.combine(date, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def get_export_rows(twin_id=None, since=None, until=None):
+    """Returns the chat turns to export, oldest first. since is inclusive, until exclusive."""
+    rows = ChatHistory.objects.all()
+    if twin_id:
+        rows = rows.filter(twin_id=twin_id)
+    # created_at bounds only scan the partitions of the range
+    if since:
+        rows = rows.filter(created_at__gte=since)
+    if until:
+        rows = rows.filter(created_at__lt=until)
+    return rows.order_by("id").values(*EXPORT_COLUMNS)
+
+
+def _chunks(rows, chunk_size):
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _empty_retrieval():
+    return {column: None for column in RETRIEVAL_COLUMNS}
+
+
+def _add_retrieval(chunk):
+    request_ids = {row["request_id"] for row in chunk if row["request_id"]}
+    ledger = {}
+    if request_ids:
+        for entry in RequestLedger.objects.filter(request_id__in=request_ids).values("request_id", *RETRIEVAL_COLUMNS):
+            ledger[entry.pop("request_id")] = entry
+    for row in chunk:
+        row.update(ledger.get(row["request_id"]) or _empty_retrieval())
+    return chunk
+
+
+def iter_export_chunks(twin_id=None, since=None, until=None, include_retrieval=False, chunk_size=None):
+    """Yields the rows (dicts) to export in lists of up to chunk_size rows."""
+    chunk_size = chunk_size or settings.CHAT_HISTORY_EXPORT_CHUNK_SIZE
+    rows = get_export_rows(twin_id, since, until).iterator(chunk_size=chunk_size)
+    for chunk in _chunks(rows, chunk_size):
+        yield _add_retrieval(chunk) if include_retrieval else chunk
+
+
+def _ndjson(chunks):
+    for chunk in chunks:
+        yield "".join(json.dumps(row, default=str) + "\n" for row in chunk).encode("utf-8")
+
+
+class _DrainableSink:
+    """A write-only file for pyarrow whose written bytes are taken out after every row group."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportFormatError("Parquet export needs pyarrow, install it with `pip install pyarrow`")
+    return pyarrow
+
+
+def _parquet_schema(pa, include_retrieval):
+    fields = [
+        ("id", pa.int64()),
+        ("chat_instance_id", pa.int64()),
+        ("twin_id", pa.string()),
+        ("user_query", pa.string()),
+        ("chatbot_response", pa.string()),
+        ("cacheable", pa.bool_()),
+        ("created_at", pa.timestamp("us", tz="UTC")),
+        ("request_id", pa.string()),
+    ]
+    if include_retrieval:
+        fields += [
+            ("endpoint", pa.string()),
+            ("status_code", pa.int32()),
+            ("total_ms", pa.float64()),
+            ("cost_usd", pa.float64()),
+            ("cache_hits", pa.list_(pa.string())),
+            ("retrieval_query", pa.string()),
+            # Attributes differ per twin, so the filter stays JSON
+            ("metadata", pa.string()),
+            ("chunk_ids", pa.list_(pa.int64())),
+            ("reused_retrieval", pa.bool_()),
+        ]
+    return pa.schema(fields)
+
+
+def _flatten_retrieval(row):
+    retrieval = row.pop("retrieval") or {}
+    row["retrieval_query"] = retrieval.get("query")
+    metadata = retrieval.get("metadata")
+    row["metadata"] = json.dumps(metadata) if metadata is not None else None
+    row["chunk_ids"] = retrieval.get("chunk_ids")
+    row["reused_retrieval"] = retrieval.get("reused")
+    return row
+
+
+def _parquet(chunks, include_retrieval):
+    pa = _import_pyarrow()
+    schema = _parquet_schema(pa, include_retrieval)
+    sink = _DrainableSink()
+    writer = pa.parquet.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        for chunk in chunks:
+            if include_retrieval:
+                chunk = [_flatten_retrieval(row) for row in chunk]
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            yield sink.drain()
+    finally:
+        # The footer is written on close
+        writer.close()
+    yield sink.drain()
+
+
+def check_format(export_format):
+    if export_format not in FORMATS:
+        raise ExportFormatError(f"export_format must be one of {', '.join(FORMATS)}")
+    if export_format == "parquet":
+        _import_pyarrow()
+
+
+def export_chat_history(export_format="ndjson", twin_id=None, since=None, until=None, include_retrieval=False):
+    """Yields the export as chunks of bytes. Call check_format first to fail before streaming."""
+    chunks = iter_export_chunks(twin_id, since, until, include_retrieval)
+    if export_format == "parquet":
+        return _parquet(chunks, include_retrieval)
+    return _ndjson(chunks)
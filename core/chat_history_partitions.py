@@ -0,0 +1,143 @@
+"""
+Monthly range partitions of chat_history on created_at.
+
+`python manage.py partition_chat_history` turns the table created by the migrations into a
+partitioned table once: one partition per month (chat_history_pYYYYMM) plus a default
+partition, with the primary key on (id, created_at) as PostgreSQL requires, and the indexes
+of the original table created on the parent, so every partition gets its own and a dropped
+partition takes its indexes with it. `python manage.py archive_chat_history` creates the
+partitions of the coming months and archives and removes the expired ones.
+
+Rows outside every monthly partition go to the default partition, e.g. a row written for a
+month whose partition was already dropped. When a month gets its partition, its rows are
+moved out of the default partition first, PostgreSQL cannot create it otherwise.
+
+Queries that bound created_at only scan the partitions of their range: the export, the archive
+and the older pages of load_chat_history_api, whose cursor carries the created_at of its row.
+The first page of a chat is read on the id index of every partition.
+"""
+import gzip
+import json
+import os
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+
+TABLE = "chat_history"
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+ARCHIVE_COLUMNS = ("id", "chat_instance_id", "twin_id", "user_query", "chatbot_response", "cacheable", "created_at", "request_id")
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return datetime(value.year + month // 12, month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start:%Y%m}"
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relkind IN ('r', 'p')", [TABLE])
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def list_partitions(cursor):
+    """Returns [(name, start, end)] of the monthly partitions, oldest first."""
+    cursor.execute(
+        """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+        """,
+        [TABLE],
+    )
+    partitions = []
+    for (name,) in cursor.fetchall():
+        if name == DEFAULT_PARTITION:
+            continue
+        start = datetime.strptime(name[len(TABLE) + 2:], "%Y%m").replace(tzinfo=dt_timezone.utc)
+        partitions.append((name, start, add_months(start, 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partition(cursor, start):
+    end = add_months(start, 1)
+    name = partition_name(start)
+    cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [name])
+    if cursor.fetchone() is not None:
+        return
+
+    cursor.execute(
+        f'SELECT EXISTS (SELECT 1 FROM "{DEFAULT_PARTITION}" WHERE created_at >= %s AND created_at < %s)',
+        [start, end],
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute(f'CREATE TABLE "{name}" PARTITION OF "{TABLE}" FOR VALUES FROM (%s) TO (%s)', [start, end])
+        return
+
+    # The month's rows are in the default partition, they move to the new table before it is attached
+    with transaction.atomic():
+        cursor.execute(f'CREATE TABLE "{name}" (LIKE "{TABLE}" INCLUDING DEFAULTS)')
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE created_at >= %s AND created_at < %s RETURNING *) '
+            f'INSERT INTO "{name}" SELECT * FROM moved',
+            [start, end],
+        )
+        print(f"Moved {cursor.rowcount} rows from {DEFAULT_PARTITION} to {name}")
+        cursor.execute(f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)', [start, end])
+
+
+def ensure_partitions(cursor, first_month, months_ahead=None):
+    """Creates the monthly partitions from first_month up to months_ahead months from now."""
+    if months_ahead is None:
+        months_ahead = settings.CHAT_HISTORY_PARTITIONS_AHEAD
+    last = add_months(month_start(datetime.now(dt_timezone.utc)), months_ahead)
+    start = month_start(first_month)
+    created = []
+    while start <= last:
+        create_partition(cursor, start)
+        created.append(partition_name(start))
+        start = add_months(start, 1)
+    return created
+
+
+def get_retention_cutoffs(now):
+    """Returns (default cutoff, {twin_id: cutoff}), rows created before their twin's cutoff are expired."""
+    default_cutoff = now - timedelta(days=settings.CHAT_HISTORY_RETENTION_DAYS)
+    twin_cutoffs = {
+        twin_id: now - timedelta(days=days)
+        for twin_id, days in settings.CHAT_HISTORY_RETENTION_DAYS_PER_TWIN.items()
+    }
+    return default_cutoff, twin_cutoffs
+
+
+def count_default_rows(cursor):
+    cursor.execute(f'SELECT count(*) FROM "{DEFAULT_PARTITION}"')
+    return cursor.fetchone()[0]
+
+
+def write_archive(rows, path):
+    """Writes rows (dicts) to a gzipped NDJSON file and returns how many were written. Never overwrites a file."""
+    if os.path.exists(path):
+        # Its rows were deleted after it was written, this archive is their only copy
+        raise FileExistsError(f"Archive {path} already exists")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    written = 0
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, default=str) + "\n")
+            written += 1
+    # Only complete archives get their final name
+    os.replace(tmp_path, path)
+    return written
+
@@ -0,0 +1,204 @@
+"""
+Write-behind persistence.
+
+The answer is returned to the user first, and the rows to save are put on an in-process queue.
+A background thread writes queued rows in batches with bulk_create. The rows of a batch that
+fails because the database is unavailable are kept aside and retried before any newer row is
+taken from the queue, so a row is written at least once and rows are written in the order they
+were queued. Rows get their created_at when they are queued, not when they are written. The
+queue is flushed when the process exits. Used for chat turns and the request ledger.
+
+Writing chat turns also updates the activity summary of their chat instances (last message
+time, message count and a preview of the last query), which the chat list shows.
+"""
+import atexit
+import queue
+import threading
+import time
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+from django.db.models import DateTimeField, F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from core.models import ChatHistory, ChatInstance
+
+RETRY_DELAY_SECONDS = 1
+MAX_RETRY_DELAY_SECONDS = 30
+
+PREVIEW_LENGTH = 200
+
+
+def update_chat_instance_activity(rows):
+    """
+    Adds written chat history rows, in the order they were saved, to their chat instances' activity
+    summary. The last message time is the newest created_at of the rows, not the time of the write.
+    """
+    activity = {}
+    for row in rows:
+        count, _, last_message_at = activity.get(row["chat_instance_id"], (0, None, None))
+        created_at = row.get("created_at") or timezone.now()
+        activity[row["chat_instance_id"]] = (
+            count + 1,
+            row["user_query"],
+            max(created_at, last_message_at) if last_message_at else created_at,
+        )
+
+    for chat_instance_id, (count, last_query, last_message_at) in activity.items():
+        ChatInstance.objects.filter(id=chat_instance_id).update(
+            message_count=F("message_count") + count,
+            # A retried batch must not move the chat back, PostgreSQL's GREATEST skips a NULL
+            last_message_at=Greatest(F("last_message_at"), Value(last_message_at, output_field=DateTimeField())),
+            last_query_preview=(last_query or "")[:PREVIEW_LENGTH],
+        )
+
+
+class BatchWriter:
+    def __init__(self, model, batch_size=50, flush_interval=0.5):
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Held while a batch is taken and written, by the thread or by flush
+        self._write_lock = threading.Lock()
+        # Rows of a failed batch, written before anything newer from the queue
+        self._pending = []
+        self._stopped = threading.Event()
+        self._retry_delay = RETRY_DELAY_SECONDS
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                name = f"{self.model._meta.db_table.replace('_', '-')}-writer"
+                self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def put(self, row):
+        """Queues a dict of model field values to be written."""
+        self.start()
+        self.queue.put(row)
+
+    def _next_batch(self, timeout):
+        if self._pending:
+            batch, self._pending = self._pending, []
+            return batch
+
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                with self._write_lock:
+                    batch = self._next_batch(self.flush_interval)
+                    written = not batch or self._write(batch)
+                if not written:
+                    time.sleep(self._retry_delay)
+                    self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_DELAY_SECONDS)
+            except Exception as e:
+                # Nothing may end the thread, the queue would never be written again
+                print(f"Error in the {self.model.__name__} writer: {e}")
+                time.sleep(self._retry_delay)
+
+    def after_write(self, rows):
+        """Called with the rows of a batch that were written."""
+
+    def _write(self, batch):
+        """Writes a batch and returns False when rows of it were kept aside to be retried."""
+        try:
+            self.model.objects.bulk_create([self.model(**row) for row in batch])
+            self._retry_delay = RETRY_DELAY_SECONDS
+            written = batch
+        except IntegrityError:
+            # A row pointing at a deleted row (e.g. chat instance) fails the whole batch, write the others one by one
+            written = []
+            failed = []
+            for row in batch:
+                try:
+                    self.model.objects.create(**row)
+                    written.append(row)
+                except IntegrityError as e:
+                    print(f"Dropping {self.model.__name__} row: {e}")
+                except Exception as e:
+                    print(f"Error writing {self.model.__name__} row, retrying: {e}")
+                    failed.append(row)
+            if failed:
+                # E.g. the database went away mid-batch, the rows written so far are kept
+                self._pending = failed
+                self._after_write(written)
+                return False
+        except Exception as e:
+            print(f"Error writing {len(batch)} {self.model.__name__} rows, retrying: {e}")
+            self._pending = batch
+            close_old_connections()
+            return False
+
+        self._after_write(written)
+        return True
+
+    def _after_write(self, written):
+        try:
+            if written:
+                self.after_write(written)
+        except Exception as e:
+            # The rows are written, a retry would write them twice
+            print(f"Error after writing {len(written)} {self.model.__name__} rows: {e}")
+        finally:
+            close_old_connections()
+
+    def flush(self, attempts=3):
+        """Stops the background thread and writes everything that is still queued."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + MAX_RETRY_DELAY_SECONDS)
+
+        while attempts > 0 and (self._pending or not self.queue.empty()):
+            with self._write_lock:
+                batch = self._next_batch(0)
+                written = not batch or self._write(batch)
+            if not written:
+                attempts -= 1
+                time.sleep(RETRY_DELAY_SECONDS)
+
+        left = len(self._pending) + self.queue.qsize()
+        if left:
+            print(f"Could not write {left} {self.model.__name__} rows before shutdown")
+
+
+class ChatHistoryWriter(BatchWriter):
+    def __init__(self, batch_size=50, flush_interval=0.5):
+        super().__init__(ChatHistory, batch_size, flush_interval)
+
+    def after_write(self, rows):
+        update_chat_instance_activity(rows)
+
+    def enqueue(self, chat_instance_id, twin_id, user_query, chatbot_response, query_embedding=None, request_id="", cacheable=True):
+        self.put({
+            "chat_instance_id": chat_instance_id,
+            "twin_id": twin_id,
+            "user_query": user_query,
+            "chatbot_response": chatbot_response,
+            "query_embedding": query_embedding,
+            "request_id": request_id,
+            "cacheable": cacheable,
+            "created_at": timezone.now(),
+        })
+
+
+chat_history_writer = ChatHistoryWriter(
+    batch_size=settings.CHAT_HISTORY_WRITE_BATCH_SIZE,
+    flush_interval=settings.CHAT_HISTORY_FLUSH_INTERVAL,
+)
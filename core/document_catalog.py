@@ -0,0 +1,138 @@
+"""
+Document catalog.
+
+Every ingested document has one Document row with its name, twins, asset and integration ids,
+metadata and number of chunks, and its chunks in VectorDB point to it. The row and the chunks
+are written, and deleted, in one transaction, so the catalog always matches the chunks.
+
+The document list reads the catalog instead of the chunks, and the search resolves its
+metadata filter on the catalog, one row per document, before it goes to the chunks of the
+documents that matched, plus the chunks that have no catalog row yet, filtered on their own
+metadata. Chunks ingested before the catalog existed are added to it with
+`python manage.py build_document_catalog`, and the document list adds those of its twin
+before it reads the catalog.
+"""
+import uuid
+from django.db import transaction
+from django.db.models import Count, Q
+from core.models import Document, VectorDB
+
+
+def metadata_filter(meta_data):
+    """Q of the case-insensitive containment of every non null metadata value."""
+    filters = Q()
+    for key, value in (meta_data or {}).items():
+        if value is not None:
+            filters &= Q(**{f"meta_data__{key}__icontains": value})
+    return filters
+
+
+def filter_documents(twin_version_id, meta_data):
+    """Returns the twin's documents matching the metadata filter."""
+    return Document.objects.filter(twin_version_id=twin_version_id).filter(metadata_filter(meta_data))
+
+
+def filter_chunks(chunks, twin_version_id, meta_data):
+    """
+    Filters VectorDB chunks on the metadata of their catalog row, or on their own metadata for
+    chunks that have none yet.
+    """
+    filters = metadata_filter(meta_data)
+    if not filters:
+        return chunks
+    return chunks.filter(
+        Q(document__in=filter_documents(twin_version_id, meta_data)) | (Q(document__isnull=True) & filters)
+    )
+
+
+def create_document(chunks, name, twin_id="", twin_version_id="", meta_data=None, asset_id=None,
+                    integration_entity_id=None, type="document", pdf_id=None):
+    """Saves the catalog row of a document and its chunks (unsaved VectorDB objects) together."""
+    pdf_id = pdf_id or str(uuid.uuid4())
+    with transaction.atomic():
+        document = Document.objects.create(
+            pdf_id=pdf_id,
+            name=name,
+            twin_id=twin_id,
+            twin_version_id=twin_version_id,
+            type=type,
+            asset_id=asset_id,
+            integration_entity_id=integration_entity_id,
+            meta_data=meta_data or {},
+            chunk_count=len(chunks),
+        )
+        for chunk in chunks:
+            chunk.document = document
+            chunk.pdf_id = pdf_id
+        VectorDB.objects.bulk_create(chunks, batch_size=500)
+    return document
+
+
+def delete_documents(chunks):
+    """Deletes the chunks and the catalog rows of their documents together, returns the number of chunks deleted."""
+    with transaction.atomic():
+        document_ids = list(chunks.exclude(document=None).order_by().values_list("document_id", flat=True).distinct())
+        deleted, _ = chunks.delete()
+        # Documents that still have chunks outside the filter keep their row with the chunks left
+        remaining = {
+            row["document_id"]: row["count"]
+            for row in VectorDB.objects.filter(document_id__in=document_ids)
+            .values("document_id").annotate(count=Count("id"))
+        }
+        Document.objects.filter(id__in=document_ids).exclude(id__in=list(remaining)).delete()
+        for document_id, count in remaining.items():
+            Document.objects.filter(id=document_id).update(chunk_count=count)
+    return deleted
+
+
+def attach_chunks(chunks, pdf_id, defaults):
+    """
+    Adds chunks saved without a catalog row to the catalog row of pdf_id, creating it from
+    defaults. Returns (document, number of chunks attached).
+    """
+    with transaction.atomic():
+        document, _ = Document.objects.get_or_create(pdf_id=pdf_id, defaults=defaults)
+        attached = chunks.update(document=document, pdf_id=pdf_id)
+        # Counted rather than added up, two runs attaching the same chunks would count them twice
+        Document.objects.filter(id=document.id).update(chunk_count=VectorDB.objects.filter(document=document).count())
+    return document, attached
+
+
+def catalog_uncataloged_chunks(twin_id=None):
+    """
+    Adds the chunks saved without a catalog row, of one twin or of all, to the catalog, one row
+    per document. Returns (documents, chunks) added.
+    """
+    uncataloged = VectorDB.objects.filter(document__isnull=True)
+    if twin_id:
+        uncataloged = uncataloged.filter(twin_id=twin_id)
+
+    # Chunks saved without a pdf_id are told apart by their twin and document name
+    keys = list(uncataloged.order_by().values("pdf_id", "twin_id", "pdf").distinct())
+
+    documents = 0
+    chunks = 0
+    for key in keys:
+        document_chunks = uncataloged.filter(**key)
+        first = document_chunks.order_by("id").values(
+            "pdf", "twin_id", "twin_version_id", "type", "asset_id", "integration_entity_id", "meta_data",
+        ).first()
+        if first is None:
+            continue
+
+        _, attached = attach_chunks(document_chunks, key["pdf_id"] or str(uuid.uuid4()), {
+            "name": first["pdf"],
+            "twin_id": first["twin_id"],
+            "twin_version_id": first["twin_version_id"],
+            "type": first["type"],
+            "asset_id": first["asset_id"],
+            "integration_entity_id": first["integration_entity_id"],
+            "meta_data": first["meta_data"] or {},
+        })
+        documents += 1
+        chunks += attached
+    return documents, chunks
+
+
+def has_uncataloged_chunks(twin_id):
+    return VectorDB.objects.filter(twin_id=twin_id, document__isnull=True).exists()
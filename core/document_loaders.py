@@ -1,16 +1,19 @@
+"""
+Text extraction and conversion for uploaded documents.
+
+The format specific libraries (langchain loaders, aspose.words, extract_msg, reportlab) are
+slow to import, so each one is imported by the function that needs it on first use instead of
+when the server starts.
+"""
 import os
 import json
-from langchain_community.document_loaders import UnstructuredWordDocumentLoader, UnstructuredExcelLoader
-from langchain_community.document_loaders import PyPDFLoader
-import extract_msg
-import aspose.words as aw
 # from pptxtopdf import convert
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 import re
 
 def extract_text_from_pdf(pdf_path, component):
     try:
+        from langchain_community.document_loaders import PyPDFLoader
+
         text = []
         loader = PyPDFLoader(pdf_path)
         docs = loader.load()  # Returns a list of document objects (one per page)
@@ -29,6 +32,8 @@ def extract_text_from_pdf(pdf_path, component):
         
 def extract_text_from_docx(docx_path, component):
     try:
+        from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+
         text = []
         loader = UnstructuredWordDocumentLoader(docx_path)
         docs = loader.load()  # Returns a list of document objects (one per section/page)
@@ -44,6 +49,8 @@ def extract_text_from_docx(docx_path, component):
         return []
 
 def convert_doc_to_pdf(doc_path):
+    import aspose.words as aw
+
     doc = aw.Document(doc_path)
     pdf_path = doc_path.replace('.doc', '.pdf')
     doc.save(pdf_path)
@@ -58,6 +65,10 @@ def clean_text(content):
 
 def convert_msg_to_pdf(msg_path):
     try:
+        import extract_msg
+        from reportlab.lib.pagesizes import letter
+        from reportlab.pdfgen import canvas
+
         pdf_path = msg_path.replace(".msg", ".pdf")
         
         # Load the .msg file
@@ -113,6 +124,8 @@ def convert_msg_to_pdf(msg_path):
         
 def extract_text_from_xlsx(xlsx_path, component):
     try:
+        from langchain_community.document_loaders import UnstructuredExcelLoader
+
         text = []
         loader = UnstructuredExcelLoader(xlsx_path)
         docs = loader.load()  # List of document objects
@@ -0,0 +1,161 @@
+"""
+Micro-batching of embedding requests.
+
+Callers submit single texts. A dispatcher thread per model and connection pool collects the
+texts that arrive within a short window (EMBEDDING_BATCH_WINDOW_MS after the first one), or
+until the batch is full, and sends them as one embeddings call through llm_client. Every caller
+gets back the vector of its own text. Under load this turns many tiny calls into a few larger
+ones, which keeps us under the request rate limit.
+
+If a batch is rejected as a bad request, its texts are sent again one by one so one bad input
+only fails its own caller. Every submitted text gets a result or an error, and callers wait
+at most EMBEDDING_RESULT_TIMEOUT seconds for it.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import openai
+from core.llm_client import POOL_LIMITS, create_embeddings
+
+BATCH_WINDOW_SECONDS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 10)) / 1000
+MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", 64))
+# Keeps a batch of long chunks well below the per request token limit
+MAX_BATCH_CHARACTERS = int(os.getenv("EMBEDDING_BATCH_MAX_CHARACTERS", 400000))
+# Seconds a caller waits for its embedding, covering the window, a busy executor and the retries
+RESULT_TIMEOUT = float(os.getenv("EMBEDDING_RESULT_TIMEOUT", 60))
+
+
+class EmbeddingBatcher:
+    def __init__(self, model, pool="query", hedge=False, window=BATCH_WINDOW_SECONDS, max_batch_size=MAX_BATCH_SIZE):
+        self.model = model
+        self.pool = pool
+        self.hedge = hedge
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Several batches can be in flight while the next one is collected
+        self._executor = ThreadPoolExecutor(
+            max_workers=POOL_LIMITS.get(pool, POOL_LIMITS["query"]),
+            thread_name_prefix=f"embedding-batch-{pool}",
+        )
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"embedding-batcher-{self.pool}", daemon=True)
+                self._thread.start()
+
+    def submit(self, text):
+        """Queues the text and returns a Future with its embedding."""
+        self.start()
+        future = Future()
+        self.queue.put((text, future))
+        return future
+
+    def embed(self, text, timeout=RESULT_TIMEOUT):
+        return self.submit(text).result(timeout=timeout)
+
+    def _run(self):
+        carry = None
+        while True:
+            batch = []
+            try:
+                first = carry or self.queue.get()
+                carry = None
+                batch = [first]
+                characters = len(first[0])
+                end = time.monotonic() + self.window
+
+                while len(batch) < self.max_batch_size:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if characters + len(item[0]) > MAX_BATCH_CHARACTERS:
+                        carry = item
+                        break
+                    batch.append(item)
+                    characters += len(item[0])
+
+                self._executor.submit(self._send, batch)
+            except Exception as e:
+                # The dispatcher must keep running, only this batch fails
+                print(f"Error batching embeddings for {self.model}: {e}")
+                _fail_unresolved(batch, e)
+
+    def _request(self, texts):
+        response = create_embeddings(texts, model=self.model, pool=self.pool, hedge=self.hedge)
+        return {text: data.embedding for text, data in zip(texts, sorted(response.data, key=lambda data: data.index))}
+
+    def _send(self, batch):
+        try:
+            self._send_batch(batch)
+        except Exception as e:
+            print(f"Error sending embeddings to {self.model}: {e}")
+        finally:
+            # No caller is left waiting, whatever happened above
+            _fail_unresolved(batch, RuntimeError(f"No embedding was returned by {self.model}"))
+
+    def _send_batch(self, batch):
+        # Identical texts in a batch are embedded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = self._request(texts)
+            if len(texts) > 1:
+                print(f"Sent {len(texts)} texts in one embeddings call to {self.model}")
+        except openai.BadRequestError as e:
+            if len(texts) == 1:
+                vectors = {texts[0]: e}
+            else:
+                print(f"Batch of {len(texts)} embeddings was rejected, sending them one by one")
+                vectors = {}
+                for text in texts:
+                    try:
+                        vectors.update(self._request([text]))
+                    except Exception as error:
+                        vectors[text] = error
+        except Exception as e:
+            vectors = {text: e for text in texts}
+
+        for text, future in batch:
+            # Missing when the API returned fewer embeddings than texts, failed in _send
+            result = vectors.get(text)
+            if result is None:
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def _fail_unresolved(batch, error):
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(error)
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(model="text-embedding-3-small", pool="query", hedge=False):
+    key = (model, pool, hedge)
+    if key not in _batchers:
+        with _batchers_lock:
+            if key not in _batchers:
+                _batchers[key] = EmbeddingBatcher(model, pool, hedge)
+    return _batchers[key]
+
+
+def embed_text(text, model="text-embedding-3-small", pool="query", hedge=False):
+    """Returns the embedding of a single text, sent together with concurrent requests."""
+    return get_embedding_batcher(model, pool, hedge).embed(text)
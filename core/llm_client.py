@@ -0,0 +1,257 @@
+"""
+Shared OpenAI client used for every chat completion and embedding call.
+
+Clients are created once per connection pool on first use. Interactive query traffic and
+bulk ingestion use separate pools, so an upload burst can not take all connections from user
+queries. Every call gets a deadline, and rate limit (429), server (5xx) and connection errors
+are retried with jittered exponential backoff inside that deadline. The latency-critical query
+embedding can be hedged: if the first request has not answered after a short delay a second
+identical request is sent and whichever returns first is used. Timing and token usage of each
+call is collected in get_metrics(). Chat completions wait for a slot of the per twin fair
+scheduler in llm_scheduler.py before they are sent.
+
+Configuration comes from environment variables so this module also works outside Django
+(e.g. in pre_processing_pdf.py).
+"""
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
+import openai
+from dotenv import load_dotenv
+from openai import OpenAI
+from core.llm_scheduler import llm_scheduler, INTERACTIVE
+from core.request_metrics import record_usage
+
+load_dotenv()
+
+# Connection pool limits per traffic class
+POOL_LIMITS = {
+    "query": int(os.getenv("OPENAI_QUERY_MAX_CONNECTIONS", 50)),
+    "ingest": int(os.getenv("OPENAI_INGEST_MAX_CONNECTIONS", 10)),
+}
+
+# Default deadlines in seconds, including retries
+CHAT_DEADLINE = float(os.getenv("OPENAI_CHAT_DEADLINE", 60))
+EMBEDDING_DEADLINE = float(os.getenv("OPENAI_EMBEDDING_DEADLINE", 10))
+CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", 5))
+
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 3))
+BASE_BACKOFF_SECONDS = 0.25
+MAX_BACKOFF_SECONDS = 8
+
+# Seconds to wait before sending the hedged embedding request, 0 disables hedging
+EMBEDDING_HEDGE_DELAY = float(os.getenv("EMBEDDING_HEDGE_DELAY", 0.3))
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,
+)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_hedge_executor = None
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_openai_client(pool="query"):
+    """Returns the shared OpenAI client of the given connection pool, creating it on first use."""
+    client = _clients.get(pool)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        if pool not in _clients:
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("OPENAI_API_KEY is not set in .env file")
+
+            max_connections = POOL_LIMITS.get(pool, POOL_LIMITS["query"])
+            http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                timeout=httpx.Timeout(CHAT_DEADLINE, connect=CONNECT_TIMEOUT),
+            )
+            # Retries are done here with jitter and a deadline, not by the SDK
+            _clients[pool] = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+        return _clients[pool]
+
+
+def _record(operation, model, seconds, usage=None, retries=0, error=False):
+    with _metrics_lock:
+        stats = _metrics.setdefault((operation, model), {
+            "calls": 0,
+            "errors": 0,
+            "retries": 0,
+            "total_seconds": 0.0,
+            "max_seconds": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        })
+        stats["calls"] += 1
+        stats["errors"] += int(error)
+        stats["retries"] += retries
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        if usage is not None:
+            stats["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            stats["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+
+def get_metrics():
+    """Returns a snapshot of per operation and model call counts, latency and token usage."""
+    with _metrics_lock:
+        return {f"{operation}:{model}": dict(stats) for (operation, model), stats in _metrics.items()}
+
+
+def _retry_delay(attempt, error):
+    delay = random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt))
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), MAX_BACKOFF_SECONDS))
+        except ValueError:
+            pass
+    return delay
+
+
+def call_with_retries(operation, model, request, deadline, max_retries=MAX_RETRIES):
+    """
+    Calls request(timeout=<seconds left>) until it succeeds, the retries are used up
+    or the deadline has passed.
+    """
+    start = time.monotonic()
+    end = start + deadline
+    attempt = 0
+
+    while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            _record(operation, model, time.monotonic() - start, retries=attempt, error=True)
+            raise TimeoutError(f"{operation} call to {model} exceeded its {deadline}s deadline")
+
+        try:
+            response = request(timeout=remaining)
+        except RETRYABLE_ERRORS as e:
+            attempt += 1
+            delay = _retry_delay(attempt, e)
+            if attempt > max_retries or time.monotonic() + delay >= end:
+                _record(operation, model, time.monotonic() - start, retries=attempt - 1, error=True)
+                raise
+            print(f"{operation} call to {model} failed ({e.__class__.__name__}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+            continue
+        except Exception:
+            _record(operation, model, time.monotonic() - start, retries=attempt, error=True)
+            raise
+
+        elapsed = time.monotonic() - start
+        usage = getattr(response, "usage", None)
+        _record(operation, model, elapsed, usage, retries=attempt)
+        # Only counted when called from a request thread, batched embeddings are counted by the caller
+        record_usage(
+            operation,
+            model,
+            getattr(usage, "prompt_tokens", 0),
+            getattr(usage, "completion_tokens", 0),
+        )
+        print(f"{operation} call to {model} took {elapsed:.3f}s")
+        return response
+
+
+class ScheduledStream:
+    """Completion stream that keeps its scheduler slot until it has been read or closed."""
+
+    def __init__(self, stream, tenant):
+        self.stream = stream
+        self.tenant = tenant
+        self._released = False
+
+    def __iter__(self):
+        try:
+            yield from self.stream
+        finally:
+            self.close()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            llm_scheduler.release(self.tenant)
+
+    def __del__(self):
+        self.close()
+
+
+def create_chat_completion(messages, model="gpt-4o-mini", pool="query", deadline=None, tenant=None, priority=INTERACTIVE, **kwargs):
+    """
+    Sends a chat completion request through the shared client once the scheduler gives the
+    tenant (twin_version_id) a slot. With stream=True only opening the stream is retried,
+    the returned stream is read by the caller.
+    """
+    client = get_openai_client(pool)
+    llm_scheduler.acquire(tenant, priority)
+    try:
+        response = call_with_retries(
+            "chat",
+            model,
+            lambda timeout: client.chat.completions.create(model=model, messages=messages, timeout=timeout, **kwargs),
+            deadline or CHAT_DEADLINE,
+        )
+    except Exception:
+        llm_scheduler.release(tenant)
+        raise
+
+    if kwargs.get("stream"):
+        return ScheduledStream(response, tenant)
+    llm_scheduler.release(tenant)
+    return response
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _clients_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=POOL_LIMITS["query"], thread_name_prefix="embedding-hedge")
+    return _hedge_executor
+
+
+def create_embeddings(input, model="text-embedding-3-small", pool="query", deadline=None, hedge=False):
+    """
+    Sends an embeddings request through the shared client. With hedge=True a second request
+    is sent when the first has not returned after EMBEDDING_HEDGE_DELAY seconds.
+    """
+    client = get_openai_client(pool)
+
+    def request():
+        return call_with_retries(
+            "embeddings",
+            model,
+            lambda timeout: client.embeddings.create(model=model, input=input, timeout=timeout),
+            deadline or EMBEDDING_DEADLINE,
+        )
+
+    if not hedge or EMBEDDING_HEDGE_DELAY <= 0:
+        return request()
+
+    executor = _get_hedge_executor()
+    first = executor.submit(request)
+    done, _ = wait([first], timeout=EMBEDDING_HEDGE_DELAY)
+    if done:
+        return first.result()
+
+    print(f"Embedding request slower than {EMBEDDING_HEDGE_DELAY}s, sending a hedged request")
+    second = executor.submit(request)
+    done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+    for future in done:
+        if future.exception() is None:
+            return future.result()
+
+    # The request that finished first failed, use the other one
+    other = second if first in done else first
+    return other.result()
@@ -0,0 +1,138 @@
+"""
+Admission control and fair scheduling of outbound LLM calls.
+
+Every chat completion takes a slot from the scheduler before it is sent. The number of calls
+in flight is limited overall (LLM_MAX_CONCURRENCY) and per twin (LLM_TWIN_MAX_CONCURRENCY).
+When slots are taken, waiting calls are started in weighted fair order: every call of a twin
+gets a finish tag that grows by 1/weight with each call, and the lowest tag goes first, so a
+twin sending a burst of calls can not starve twins sending a few. Interactive calls always go
+before batch calls.
+
+A twin with LLM_TWIN_MAX_QUEUE calls already waiting is rejected right away with
+LLMQueueFullError, which the views return as a 429, instead of queueing until it times out.
+
+Per twin weights can be set as JSON in LLM_TWIN_WEIGHTS, e.g. {"<twin_version_id>": 2}.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))
+TWIN_MAX_CONCURRENCY = int(os.getenv("LLM_TWIN_MAX_CONCURRENCY", 8))
+TWIN_MAX_QUEUE = int(os.getenv("LLM_TWIN_MAX_QUEUE", 16))
+QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 30))
+TWIN_WEIGHTS = json.loads(os.getenv("LLM_TWIN_WEIGHTS", "{}"))
+
+# Calls without a twin (e.g. routing) are scheduled as one shared tenant
+DEFAULT_TENANT = "default"
+
+
+class LLMQueueFullError(Exception):
+    """Raised when a call is not admitted because its twin has too many calls waiting."""
+
+
+class _Waiter:
+    __slots__ = ("tenant", "priority", "tag", "seq")
+
+    def __init__(self, tenant, priority, tag, seq):
+        self.tenant = tenant
+        self.priority = priority
+        self.tag = tag
+        self.seq = seq
+
+    def sort_key(self):
+        return PRIORITIES.index(self.priority), self.tag, self.seq
+
+
+class LLMScheduler:
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, tenant_max_concurrency=TWIN_MAX_CONCURRENCY,
+                 tenant_max_queue=TWIN_MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT, weights=None):
+        self.max_concurrency = max_concurrency
+        self.tenant_max_concurrency = tenant_max_concurrency
+        self.tenant_max_queue = tenant_max_queue
+        self.queue_timeout = queue_timeout
+        self.weights = weights or {}
+        self._condition = threading.Condition()
+        self._waiters = []
+        self._running = {}
+        self._queued = {}
+        self._finish_tags = {}
+        self._virtual_time = 0.0
+        self._total_running = 0
+        self._seq = itertools.count()
+
+    def check_admission(self, tenant):
+        """Fails fast when the twin's queue is already full, before any work is done for a request."""
+        tenant = tenant or DEFAULT_TENANT
+        with self._condition:
+            if self._queued.get(tenant, 0) >= self.tenant_max_queue:
+                raise LLMQueueFullError(f"Too many queued LLM calls for twin {tenant}, try again later")
+
+    def _eligible(self, waiter):
+        return self._running.get(waiter.tenant, 0) < self.tenant_max_concurrency
+
+    def _next_waiter(self):
+        eligible = [waiter for waiter in self._waiters if self._eligible(waiter)]
+        return min(eligible, key=_Waiter.sort_key) if eligible else None
+
+    def acquire(self, tenant=None, priority=INTERACTIVE):
+        tenant = tenant or DEFAULT_TENANT
+        priority = priority if priority in PRIORITIES else INTERACTIVE
+
+        with self._condition:
+            if self._queued.get(tenant, 0) >= self.tenant_max_queue:
+                raise LLMQueueFullError(f"Too many queued LLM calls for twin {tenant}, try again later")
+
+            weight = self.weights.get(tenant, 1)
+            tag = max(self._virtual_time, self._finish_tags.get(tenant, 0.0)) + 1 / weight
+            self._finish_tags[tenant] = tag
+            waiter = _Waiter(tenant, priority, tag, next(self._seq))
+            self._waiters.append(waiter)
+            self._queued[tenant] = self._queued.get(tenant, 0) + 1
+
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self._total_running >= self.max_concurrency or self._next_waiter() is not waiter:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise LLMQueueFullError(f"LLM call for twin {tenant} waited longer than {self.queue_timeout}s")
+                    self._condition.wait(remaining)
+            finally:
+                self._waiters.remove(waiter)
+                self._queued[tenant] -= 1
+                # Someone else may be next now
+                self._condition.notify_all()
+
+            self._virtual_time = max(self._virtual_time, waiter.tag - 1 / weight)
+            self._running[tenant] = self._running.get(tenant, 0) + 1
+            self._total_running += 1
+
+    def release(self, tenant=None):
+        tenant = tenant or DEFAULT_TENANT
+        with self._condition:
+            self._running[tenant] -= 1
+            self._total_running -= 1
+            self._condition.notify_all()
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                "running": self._total_running,
+                "queued": len(self._waiters),
+                "twins": {
+                    tenant: {"running": self._running.get(tenant, 0), "queued": self._queued.get(tenant, 0)}
+                    for tenant in set(self._running) | set(self._queued)
+                },
+            }
+
+
+llm_scheduler = LLMScheduler(weights=TWIN_WEIGHTS)
@@ -0,0 +1,123 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from core.chat_history_partitions import (
+    ARCHIVE_COLUMNS,
+    DEFAULT_PARTITION,
+    count_default_rows,
+    is_partitioned,
+    list_partitions,
+    ensure_partitions,
+    get_retention_cutoffs,
+    write_archive,
+)
+from core.models import ChatHistory
+
+
+class Command(BaseCommand):
+    help = (
+        'Create the chat_history partitions of the coming months, and archive to gzipped NDJSON '
+        'and remove the rows that are past their twin\'s retention'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', default=settings.CHAT_HISTORY_ARCHIVE_DIR, help='Directory of the archive files')
+        parser.add_argument('--dry-run', action='store_true', help='Only print what would be archived')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        # Every run writes its own files, an earlier archive of the same rows is never replaced
+        options['run'] = f'{now:%Y%m%dT%H%M%SZ}'
+        default_cutoff, twin_cutoffs = get_retention_cutoffs(now)
+
+        with connection.cursor() as cursor:
+            if not is_partitioned(cursor):
+                raise CommandError('chat_history is not partitioned, run partition_chat_history first')
+            created = ensure_partitions(cursor, now)
+            partitions = list_partitions(cursor)
+
+        self.stdout.write(f'Partitions up to {created[-1]} are in place')
+
+        for name, start, end in partitions:
+            # A twin's rows in the partition are expired once the partition ends before its cutoff
+            default_expired = end <= default_cutoff
+            expired_twins = [twin_id for twin_id, cutoff in twin_cutoffs.items() if end <= cutoff]
+            kept_twins = [twin_id for twin_id in twin_cutoffs if twin_id not in expired_twins]
+
+            if default_expired and not kept_twins:
+                self._drop_partition(name, start, end, options)
+            elif default_expired or expired_twins:
+                self._archive_rows(name, start, end, default_expired, expired_twins, list(twin_cutoffs), options)
+
+        self._archive_default(partitions, default_cutoff, twin_cutoffs, options)
+
+    def _archive(self, rows, name, suffix, options):
+        path = os.path.join(options['output_dir'], f'{name}{suffix}_{options["run"]}.ndjson.gz')
+        if options['dry_run']:
+            self.stdout.write(f'Would archive {rows.count()} rows to {path}')
+            return None
+        try:
+            written = write_archive(rows.values(*ARCHIVE_COLUMNS).iterator(chunk_size=2000), path)
+        except FileExistsError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f'Archived {written} rows to {path}')
+        return written
+
+    def _drop_partition(self, name, start, end, options):
+        rows = ChatHistory.objects.filter(created_at__gte=start, created_at__lt=end)
+        if self._archive(rows, name, '', options) is None:
+            return
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE chat_history DETACH PARTITION "{name}"')
+            cursor.execute(f'DROP TABLE "{name}"')
+        self.stdout.write(self.style.SUCCESS(f'Dropped partition {name}'))
+
+    def _archive_rows(self, name, start, end, default_expired, expired_twins, override_twins, options):
+        """Archives and deletes the expired twins' rows of a partition that other twins still keep."""
+        rows = ChatHistory.objects.filter(created_at__gte=start, created_at__lt=end)
+        groups = [(f'_{twin_id}', rows.filter(twin_id=twin_id)) for twin_id in expired_twins]
+        if default_expired:
+            # Every twin without its own retention
+            groups.append(('_default', rows.exclude(twin_id__in=override_twins)))
+
+        for suffix, group in groups:
+            if not group.exists():
+                continue
+            if self._archive(group, name, suffix, options) is None:
+                continue
+            # Nothing refers to chat_history rows, so this is a single DELETE
+            deleted, _ = group.delete()
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} archived rows from {name}'))
+
+    def _archive_default(self, partitions, default_cutoff, twin_cutoffs, options):
+        """
+        Archives and deletes the expired rows of the default partition. Its rows of months that
+        have a partition were moved there by ensure_partitions, the rest are older or newer.
+        """
+        outside = Q(created_at__lt=partitions[0][1]) | Q(created_at__gte=partitions[-1][2]) if partitions else Q()
+        rows = ChatHistory.objects.filter(outside)
+
+        groups = [
+            (f'_{twin_id}', rows.filter(twin_id=twin_id, created_at__lt=cutoff))
+            for twin_id, cutoff in twin_cutoffs.items()
+        ]
+        groups.append(('_default', rows.exclude(twin_id__in=list(twin_cutoffs)).filter(created_at__lt=default_cutoff)))
+
+        for suffix, group in groups:
+            if not group.exists():
+                continue
+            if self._archive(group, DEFAULT_PARTITION, suffix, options) is None:
+                continue
+            deleted, _ = group.delete()
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} archived rows from {DEFAULT_PARTITION}'))
+
+        with connection.cursor() as cursor:
+            remaining = count_default_rows(cursor)
+        if remaining:
+            self.stdout.write(self.style.WARNING(
+                f'{remaining} rows within their retention are in {DEFAULT_PARTITION}, outside every monthly partition'
+            ))
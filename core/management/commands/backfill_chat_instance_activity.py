@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Left
+from core.chat_history_writer import PREVIEW_LENGTH
+from core.models import ChatHistory, ChatInstance
+
+
+class Command(BaseCommand):
+    help = 'Fill the message count and last query preview of chat instances from their chat history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--twin', help='Only update the chat instances of this twin')
+
+    def handle(self, *args, **options):
+        chat_instances = ChatInstance.objects.all()
+        if options['twin']:
+            chat_instances = chat_instances.filter(twin_id=options['twin'])
+
+        messages = ChatHistory.objects.filter(chat_instance_id=OuterRef('id'))
+        message_count = (
+            messages.order_by().values('chat_instance_id')
+            .annotate(count=Count('id')).values('count')
+        )
+        last_query = messages.order_by('-id').values('user_query')[:1]
+
+        # chat_history has no timestamp, the last message time is only known for new turns
+        updated = chat_instances.update(
+            message_count=Coalesce(Subquery(message_count, output_field=IntegerField()), Value(0)),
+            last_query_preview=Coalesce(Left(Subquery(last_query), PREVIEW_LENGTH), Value('')),
+        )
+        self.stdout.write(self.style.SUCCESS(f'Successfully updated {updated} chat instances'))
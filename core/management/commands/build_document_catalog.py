@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core.document_catalog import catalog_uncataloged_chunks
+
+
+class Command(BaseCommand):
+    help = 'Add the chunks ingested before the document catalog existed to it, one catalog row per document'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--twin', help='Only catalog the documents of this twin')
+
+    def handle(self, *args, **options):
+        documents, chunks = catalog_uncataloged_chunks(options['twin'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully cataloged {chunks} chunks of {documents} documents'))
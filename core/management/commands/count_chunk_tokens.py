@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from core.models import VectorDB
+from core.token_budget import count_tokens
+
+
+class Command(BaseCommand):
+    help = 'Store the token count of document chunks ingested before token counts were recorded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of chunks updated per query')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        last_id = 0
+
+        while True:
+            chunks = list(
+                VectorDB.objects.filter(token_count__isnull=True, id__gt=last_id)
+                .order_by('id')
+                .only('id', 'text')[:batch_size]
+            )
+            if not chunks:
+                break
+
+            for chunk in chunks:
+                chunk.token_count = count_tokens(chunk.text)
+            VectorDB.objects.bulk_update(chunks, ['token_count'])
+
+            total += len(chunks)
+            last_id = chunks[-1].id
+            self.stdout.write(f'Counted tokens for {total} chunks')
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully stored token counts for {total} chunks'))
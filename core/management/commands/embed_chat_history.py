@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+from core.models import ChatHistory
+from core.views.document_search_api import looks_like_follow_up
+from pre_processing_pdf import generate_embeddings
+
+
+class Command(BaseCommand):
+    help = 'Embed the user queries of past chat history rows for the semantic answer cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--twin-id', help='Only embed chat history of this twin version')
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of queries per embedding call')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        chat_history = ChatHistory.objects.filter(query_embedding__isnull=True, cacheable=True)
+        if options['twin_id']:
+            chat_history = chat_history.filter(twin_id=options['twin_id'])
+
+        total = 0
+        last_id = 0
+        while True:
+            rows = list(chat_history.filter(id__gt=last_id).order_by('id').only('id', 'chat_instance_id', 'user_query')[:batch_size])
+            if not rows:
+                break
+            first_id = rows[0].id
+            last_id = rows[-1].id
+
+            # Follow-ups like "yes" saved before they were marked as not cacheable would match
+            # any other chat's "yes", their answers only make sense in their own conversation
+            follow_ups = self._follow_ups(rows)
+            if follow_ups:
+                ChatHistory.objects.filter(id__in=follow_ups).update(cacheable=False)
+                rows = [row for row in rows if row.id not in follow_ups]
+                if not rows:
+                    continue
+
+            try:
+                embeddings = generate_embeddings([row.user_query for row in rows], batch_size=batch_size)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'Error embedding chat history from id {first_id}: {e}'))
+                return
+
+            for row, embedding in zip(rows, embeddings):
+                row.query_embedding = embedding
+            ChatHistory.objects.bulk_update(rows, ['query_embedding'])
+
+            total += len(rows)
+            self.stdout.write(f'Embedded {total} chat history rows')
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully embedded {total} chat history rows'))
+
+    def _follow_ups(self, rows):
+        """Returns the ids of the rows the document response treated as follow-ups: not the first turn of their chat."""
+        candidates = [row for row in rows if looks_like_follow_up(row.user_query)]
+        if not candidates:
+            return set()
+        first_turns = dict(
+            ChatHistory.objects.filter(chat_instance_id__in={row.chat_instance_id for row in candidates})
+            .values('chat_instance_id').annotate(first_id=Min('id')).values_list('chat_instance_id', 'first_id')
+        )
+        return {row.id for row in candidates if first_turns.get(row.chat_instance_id) != row.id}
@@ -0,0 +1,42 @@
+import os
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from core.chat_history_export import FORMATS, ExportFormatError, check_format, export_chat_history, parse_export_time
+
+
+class Command(BaseCommand):
+    help = 'Export the chat history of a twin and time range as NDJSON or Parquet, optionally with the retrieval of every turn'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--twin', help='Only export this twin version')
+        parser.add_argument('--since', help='Only export turns from this ISO 8601 time or date on')
+        parser.add_argument('--until', help='Only export turns before this ISO 8601 time or date')
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--include-retrieval', action='store_true', help='Join the request ledger row of every turn')
+        parser.add_argument('--output', help='File to write, standard output when not given')
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_export_time(options['since']) if options['since'] else None
+            until = parse_export_time(options['until']) if options['until'] else None
+            check_format(options['format'])
+        except (ValueError, ExportFormatError) as e:
+            raise CommandError(str(e))
+
+        chunks = export_chat_history(options['format'], options['twin'], since, until, options['include_retrieval'])
+
+        if not options['output']:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+
+        # Only complete exports get their final name
+        tmp_path = f"{options['output']}.tmp"
+        written = 0
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+        os.replace(tmp_path, options['output'])
+        self.stderr.write(self.style.SUCCESS(f"Exported {written} bytes to {options['output']}"))
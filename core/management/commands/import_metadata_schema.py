@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core.models import MetaDataAttributes
+from core.metadata_schema import load_file_schemas, invalidate_schema
+
+
+class Command(BaseCommand):
+    help = 'Copy the metadata attribute definitions from meta_data_attributes.json into the meta_data_attributes table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--twin', help='Only import this twin version')
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help='Delete attributes of the imported twins that are not in the file',
+        )
+
+    def handle(self, *args, **options):
+        schemas = load_file_schemas()
+        if options['twin']:
+            schemas = {options['twin']: schemas.get(options['twin'], [])}
+
+        for twin_version_id, attributes in schemas.items():
+            with transaction.atomic():
+                for position, attribute in enumerate(attributes):
+                    MetaDataAttributes.objects.update_or_create(
+                        twin_version_id=twin_version_id,
+                        meta_data_name=attribute['meta_data_name'],
+                        defaults={
+                            'meta_data_format': attribute['meta_data_format'],
+                            'meta_data_format_prompt': attribute['meta_data_format_prompt'],
+                            'position': position,
+                        },
+                    )
+
+                if options['replace']:
+                    names = [attribute['meta_data_name'] for attribute in attributes]
+                    MetaDataAttributes.objects.filter(twin_version_id=twin_version_id).exclude(
+                        meta_data_name__in=names
+                    ).delete()
+
+            invalidate_schema(twin_version_id)
+            self.stdout.write(f'Imported {len(attributes)} attributes for {twin_version_id}')
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully imported metadata schemas for {len(schemas)} twins'))
@@ -3,6 +3,7 @@ import os
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from core.models import VectorDB
+from core.token_budget import count_tokens
 
 
 class Command(BaseCommand):
@@ -42,6 +43,7 @@ class Command(BaseCommand):
                     entry = VectorDB(
                         page=page,
                         text=text,
+                        token_count=count_tokens(text),
                         pdf=pdf,
                         embedding=vector
                     )
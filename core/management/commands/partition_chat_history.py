@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from core.chat_history_partitions import TABLE, DEFAULT_PARTITION, is_partitioned, ensure_partitions
+
+OLD_TABLE = f"{TABLE}_unpartitioned"
+
+
+class Command(BaseCommand):
+    help = 'Convert chat_history into a table partitioned by month on created_at (run once, after migrate)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--estimate-created-at',
+            action='store_true',
+            help='Date rows saved before created_at existed by the creation time of their chat instance',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            if is_partitioned(cursor):
+                self.stdout.write('chat_history is already partitioned')
+                return
+
+            cursor.execute(
+                "SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'created_at'",
+                [TABLE],
+            )
+            if cursor.fetchone() is None:
+                raise CommandError('chat_history has no created_at column, run migrate first')
+
+            # Blocks the writers until the new table is in place
+            cursor.execute(f'LOCK TABLE "{TABLE}" IN ACCESS EXCLUSIVE MODE')
+
+            if options['estimate_created_at']:
+                # The column was filled with the time of the migration, the chat's creation is closer
+                cursor.execute(
+                    f'UPDATE "{TABLE}" AS h SET created_at = c.created_at '
+                    f'FROM chat_instance AS c WHERE c.id = h.chat_instance_id'
+                )
+
+            cursor.execute(
+                "SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname <> %s",
+                [TABLE, f"{TABLE}_pkey"],
+            )
+            index_definitions = [row[0] for row in cursor.fetchall()]
+            cursor.execute(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = %s::regclass AND contype = 'f'",
+                [TABLE],
+            )
+            foreign_keys = cursor.fetchall()
+
+            cursor.execute(f'ALTER TABLE "{TABLE}" RENAME TO "{OLD_TABLE}"')
+            cursor.execute(
+                f'CREATE TABLE "{TABLE}" (LIKE "{OLD_TABLE}" INCLUDING DEFAULTS INCLUDING IDENTITY) '
+                f'PARTITION BY RANGE (created_at)'
+            )
+            # The partition key must be part of the primary key
+            cursor.execute(f'ALTER TABLE "{TABLE}" ADD PRIMARY KEY (id, created_at)')
+            cursor.execute(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{TABLE}" DEFAULT')
+
+            cursor.execute(f'SELECT min(created_at) FROM "{OLD_TABLE}"')
+            first = cursor.fetchone()[0]
+            partitions = ensure_partitions(cursor, first or timezone.now())
+
+            cursor.execute(f'INSERT INTO "{TABLE}" OVERRIDING SYSTEM VALUE SELECT * FROM "{OLD_TABLE}"')
+            copied = cursor.rowcount
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence('{TABLE}', 'id'), "
+                f'coalesce((SELECT max(id) FROM "{TABLE}"), 0) + 1, false)'
+            )
+
+            cursor.execute(f'DROP TABLE "{OLD_TABLE}"')
+
+            # The definitions were read before the rename, so they are created on the new parent table.
+            # Built after the copy, each partition gets its own index in one pass.
+            for definition in index_definitions:
+                cursor.execute(definition)
+            for name, definition in foreign_keys:
+                cursor.execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" {definition}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully partitioned chat_history into {len(partitions)} monthly partitions ({copied} rows)'
+        ))
@@ -0,0 +1,158 @@
+import contextlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import uvicorn
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from core.models import ChatInstance, VectorDB
+from core.request_metrics import get_last_request_timings
+from benchmark import TWIN_PREFIX, FAKE_OPENAI_PORT, FAKE_RERANK_PORT, synthetic_queries, is_local_database
+
+SEARCH_SERVICE_PORT = 8303
+
+STAGES = ["embedding", "answer_cache", "metadata", "search", "prompt", "generation", "persist", "total", "end_to_end"]
+PERCENTILES = [50, 95, 99]
+
+
+def start_server(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    deadline = time.monotonic() + 60
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise CommandError(f"Could not start {app} on port {port}")
+        time.sleep(0.05)
+    return server
+
+
+class Command(BaseCommand):
+    help = 'Measure per stage and end to end latency of the document response API against local stand-ins'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='Concurrency levels to run')
+        parser.add_argument('--requests', type=int, default=100, help='Requests per concurrency level')
+        parser.add_argument('--warmup', type=int, default=5, help='Requests sent before measuring')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the generated queries')
+        parser.add_argument('--answer-cache', action='store_true', help='Keep the semantic answer cache enabled')
+        parser.add_argument('--show-pipeline-output', action='store_true', help='Do not hide the prints of the pipeline')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        if not is_local_database(settings.DATABASES['default']):
+            raise CommandError('The benchmark only runs against a local database, set DB_HOST=localhost')
+
+        twins = list(
+            VectorDB.objects.filter(twin_version_id__startswith=TWIN_PREFIX)
+            .values_list('twin_version_id', flat=True).distinct()
+        )
+        if not twins:
+            raise CommandError('No benchmark data found, run seed_benchmark_data first')
+
+        # The clients read these on first use, so they have to be set before any request
+        os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{FAKE_OPENAI_PORT}/v1'
+        os.environ['OPENAI_API_KEY'] = 'benchmark'
+        os.environ['CO_API_URL'] = f'http://127.0.0.1:{FAKE_RERANK_PORT}'
+        os.environ['COHERE_API_KEY'] = 'benchmark'
+        settings.SEARCH_SERVICE_URL = f'http://127.0.0.1:{SEARCH_SERVICE_PORT}'
+        if not options['answer_cache']:
+            # Repeated synthetic queries would otherwise measure the cache instead of the pipeline
+            settings.ANSWER_CACHE_ENABLED = False
+
+        self.stdout.write('Starting the fake OpenAI, fake rerank and search services')
+        servers = [
+            start_server('benchmark.fake_openai_server:app', FAKE_OPENAI_PORT),
+            start_server('benchmark.fake_rerank_server:app', FAKE_RERANK_PORT),
+            start_server('ChatRAG.document_db_service_pgvector_rerank:app', SEARCH_SERVICE_PORT),
+        ]
+
+        rng = random.Random(options['seed'])
+        total_requests = options['warmup'] + options['requests'] * len(options['concurrency'])
+        queries = iter(synthetic_queries(total_requests, options['seed']))
+
+        output = contextlib.nullcontext() if options['show_pipeline_output'] else contextlib.redirect_stdout(io.StringIO())
+        results = []
+        try:
+            with output:
+                self.run_level(1, [(rng.choice(twins), next(queries)) for _ in range(options['warmup'])])
+
+            for concurrency in options['concurrency']:
+                jobs = [(rng.choice(twins), next(queries)) for _ in range(options['requests'])]
+                with output:
+                    samples, errors, seconds = self.run_level(concurrency, jobs)
+                result = self.summarize(concurrency, samples, errors, seconds)
+                results.append(result)
+                self.report(result)
+        finally:
+            for server in servers:
+                server.should_exit = True
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def run_level(self, concurrency, jobs):
+        # Chat instances are created up front so their insert is not measured
+        jobs = [(twin, query, ChatInstance.objects.create(twin_id=twin).id) for twin, query in jobs]
+
+        def send(job):
+            twin, query, chat_instance_id = job
+            client = Client(HTTP_HOST='localhost')
+            try:
+                start = time.perf_counter()
+                response = client.post(
+                    '/core/api/document-response/',
+                    data=json.dumps({'query': query, 'twin_version_id': twin, 'chat_instance_id': chat_instance_id}),
+                    content_type='application/json',
+                )
+                end_to_end = (time.perf_counter() - start) * 1000
+                if response.status_code != 200:
+                    return None
+                return dict(get_last_request_timings(), end_to_end=end_to_end)
+            finally:
+                # Each request gets its own connection like under runserver
+                connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            responses = list(executor.map(send, jobs))
+        seconds = time.perf_counter() - start
+
+        samples = [timings for timings in responses if timings is not None]
+        return samples, len(responses) - len(samples), seconds
+
+    def summarize(self, concurrency, samples, errors, seconds):
+        stages = {}
+        for name in STAGES:
+            values = [timings[name] for timings in samples if name in timings]
+            if values:
+                stages[name] = {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+                stages[name]['count'] = len(values)
+
+        return {
+            'concurrency': concurrency,
+            'requests': len(samples) + errors,
+            'errors': errors,
+            'throughput': len(samples) / seconds if seconds else 0,
+            'stages': stages,
+        }
+
+    def report(self, result):
+        self.stdout.write('')
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'Concurrency {result["concurrency"]}: {result["requests"]} requests, '
+            f'{result["errors"]} errors, {result["throughput"]:.1f} req/s'
+        ))
+        self.stdout.write(f'{"stage":<14}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"count":>8}')
+        for name, stats in result['stages'].items():
+            self.stdout.write(f'{name:<14}{stats["p50"]:>10.1f}{stats["p95"]:>10.1f}{stats["p99"]:>10.1f}{stats["count"]:>8}')
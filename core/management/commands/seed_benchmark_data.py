@@ -0,0 +1,72 @@
+import random
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Document, VectorDB, ChatInstance
+from core.token_budget import count_tokens
+from benchmark import TWIN_PREFIX, DOCUMENT_TYPES, synthetic_text, is_local_database
+from benchmark.fake_openai_server import deterministic_embedding
+
+
+class Command(BaseCommand):
+    help = 'Seed a local pgvector database with synthetic twins for the latency benchmark'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--twins', type=int, default=3, help='Number of synthetic twins')
+        parser.add_argument('--documents', type=int, default=20, help='Documents per twin')
+        parser.add_argument('--chunks', type=int, default=30, help='Chunks per document')
+        parser.add_argument('--chunk-words', type=int, default=150, help='Words per chunk')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the generated text')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per bulk insert')
+
+    def handle(self, *args, **options):
+        if not is_local_database(settings.DATABASES['default']):
+            raise CommandError('Benchmark data is only seeded into a local database, set DB_HOST=localhost')
+
+        rng = random.Random(options['seed'])
+
+        # Seeding again replaces the previous benchmark data
+        VectorDB.objects.filter(twin_version_id__startswith=TWIN_PREFIX).delete()
+        Document.objects.filter(twin_version_id__startswith=TWIN_PREFIX).delete()
+        ChatInstance.objects.filter(twin_id__startswith=TWIN_PREFIX).delete()
+
+        total = 0
+        for t in range(options['twins']):
+            twin_version_id = f'{TWIN_PREFIX}{t}'
+            entries = []
+            documents = []
+
+            for d in range(options['documents']):
+                pdf = f'benchmark-document-{t}-{d}.pdf'
+                document_type = rng.choice(DOCUMENT_TYPES)
+                # The search resolves metadata filters on the document catalog
+                document = Document(
+                    pdf_id=f'{twin_version_id}-{d}',
+                    name=pdf,
+                    twin_id=twin_version_id,
+                    twin_version_id=twin_version_id,
+                    meta_data={'document_type': document_type},
+                    chunk_count=options['chunks'],
+                )
+                documents.append(document)
+
+                for c in range(options['chunks']):
+                    text = synthetic_text(rng, options['chunk_words'])
+                    entries.append(VectorDB(
+                        pdf_id=f'{twin_version_id}-{d}',
+                        page=str(c + 1),
+                        text=text,
+                        token_count=count_tokens(text),
+                        pdf=pdf,
+                        embedding=deterministic_embedding(text),
+                        twin_id=twin_version_id,
+                        twin_version_id=twin_version_id,
+                        meta_data={'document_type': document_type},
+                        document=document,
+                    ))
+
+            Document.objects.bulk_create(documents, batch_size=options['batch_size'])
+            VectorDB.objects.bulk_create(entries, batch_size=options['batch_size'])
+            total += len(entries)
+            self.stdout.write(f'Seeded {len(entries)} chunks for {twin_version_id}')
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully seeded {total} chunks for {options["twins"]} twins'))
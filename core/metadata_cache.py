@@ -0,0 +1,42 @@
+"""
+Cache for the metadata filters extracted from user queries.
+
+Entries are keyed by twin_version_id and the normalized query, and stored under the
+twin's metadata schema version. Editing a twin's metadata attributes changes its schema
+version, so the old entries are no longer read and expire with the TTL.
+"""
+import hashlib
+import re
+from django.conf import settings
+from django.core.cache import cache
+from core.metadata_schema import get_schema_version
+
+CACHE_KEY_PREFIX = "meta_data"
+
+
+def normalize_query(query):
+    """Lowercase the query, collapse whitespace and drop trailing punctuation."""
+    normalized = re.sub(r'\s+', ' ', query or "").strip().lower()
+    return normalized.rstrip(" ?.!")
+
+
+def _cache_key(twin_version_id, query):
+    query_hash = hashlib.sha1(normalize_query(query).encode("utf-8")).hexdigest()
+    return f"{CACHE_KEY_PREFIX}:{twin_version_id}:{query_hash}"
+
+
+def get_cached_metadata(twin_version_id, query):
+    """Returns the cached metadata JSON string for the query, or None on a miss."""
+    return cache.get(
+        _cache_key(twin_version_id, query),
+        version=get_schema_version(twin_version_id),
+    )
+
+
+def set_cached_metadata(twin_version_id, query, metadata_json):
+    cache.set(
+        _cache_key(twin_version_id, query),
+        metadata_json,
+        timeout=settings.METADATA_CACHE_TTL,
+        version=get_schema_version(twin_version_id),
+    )
@@ -0,0 +1,206 @@
+"""
+Rule-based metadata extraction from user queries.
+
+Each twin's attribute definitions in meta_data_attributes.json are compiled once into a
+single regular expression over all enum values and synonyms, plus small patterns for the
+typed fields (integers, numbers and dates). The extractor reports whether it is confident
+in its result; meta_data_extraction only calls the LLM when it is not.
+"""
+import re
+import threading
+from datetime import datetime
+from core.metadata_schema import get_twin_attributes, get_schema_version
+
+# Name parts that say nothing about which attribute a query refers to
+STOP_TOKENS = {"id", "name", "type", "date", "m"}
+
+DATE_HINT_PATTERN = re.compile(r'\b(?:dated?|issued|(?:19|20)\d{2})\b', re.IGNORECASE)
+
+MONTH_DATE_PATTERN = re.compile(
+    r'\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+(\d{4})\b',
+    re.IGNORECASE,
+)
+DAY_MONTH_DATE_PATTERN = re.compile(
+    r'\b(\d{1,2})(?:st|nd|rd|th)?\s+(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?,?\s+(\d{4})\b',
+    re.IGNORECASE,
+)
+ISO_DATE_PATTERN = re.compile(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b')
+
+# Dates are written the way the schema examples show them, e.g. "Aug 22, 2023"
+DATE_OUTPUT_FORMAT = "%b %d, %Y"
+
+
+def _name_tokens(meta_data_name):
+    return [token for token in meta_data_name.lower().split("_") if token not in STOP_TOKENS]
+
+
+def _parse_date(query):
+    match = MONTH_DATE_PATTERN.search(query)
+    if match:
+        month, day, year = match.groups()
+        return _format_date(f"{month[:3]} {day} {year}", "%b %d %Y")
+
+    match = DAY_MONTH_DATE_PATTERN.search(query)
+    if match:
+        day, month, year = match.groups()
+        return _format_date(f"{month[:3]} {day} {year}", "%b %d %Y")
+
+    match = ISO_DATE_PATTERN.search(query)
+    if match:
+        return _format_date("-".join(match.groups()), "%Y-%m-%d")
+
+    return None
+
+
+def _format_date(text, input_format):
+    try:
+        return datetime.strptime(text.title(), input_format).strftime(DATE_OUTPUT_FORMAT)
+    except ValueError:
+        return None
+
+
+class LocalMetadataExtractor:
+    """
+    Extracts metadata for one twin version without an LLM call.
+
+    Enum values and synonyms are matched with one compiled alternation, longest term first.
+    A single lowercase enum word (e.g. "open") is only trusted when the attribute itself is
+    also mentioned in the query, since such words are common in ordinary questions. The mention
+    must be outside the matched word: when an enum value is also a hint of its attribute (e.g.
+    "document" for document_type), the word alone does not count as both.
+    """
+
+    def __init__(self, attributes):
+        self.attribute_names = [attribute["meta_data_name"] for attribute in attributes]
+        self.terms = {}
+        self.hints = {}
+        self.typed_fields = []
+        self.date_fields = []
+
+        token_counts = {}
+        for attribute in attributes:
+            for token in set(_name_tokens(attribute["meta_data_name"])):
+                token_counts[token] = token_counts.get(token, 0) + 1
+
+        for attribute in attributes:
+            name = attribute["meta_data_name"]
+            meta_data_format = attribute.get("meta_data_format", {})
+            field_type = meta_data_format.get("type")
+            tokens = _name_tokens(name)
+            phrase = name.replace("_", " ").lower()
+
+            # Name parts shared by several attributes (e.g. "site") do not point at any one of them
+            distinctive_tokens = {token for token in tokens if token_counts[token] == 1}
+            hint_terms = {phrase}
+            if field_type != "date":
+                hint_terms.update(distinctive_tokens)
+            for example in meta_data_format.get("enumExamples", []):
+                hint_terms.add(str(example).lower())
+            self.hints[name] = re.compile(
+                r'\b(?:' + "|".join(re.escape(term) for term in sorted(hint_terms, key=len, reverse=True)) + r')\b',
+                re.IGNORECASE,
+            )
+
+            for value in meta_data_format.get("enum", []):
+                self._add_term(str(value), name, value, synonym=False)
+            for synonyms, value in meta_data_format.get("synonym_mapping", {}).items():
+                for synonym in synonyms.split(","):
+                    if synonym.strip():
+                        self._add_term(synonym.strip(), name, value, synonym=True)
+
+            if field_type in ("integer", "number"):
+                # The number must directly follow the attribute, e.g. "equipment id 12"
+                labels = {phrase} | distinctive_tokens
+                number = r'(\d+)' if field_type == "integer" else r'(-?\d+(?:\.\d+)?)'
+                pattern = re.compile(
+                    r'\b(?:' + "|".join(re.escape(label) for label in sorted(labels, key=len, reverse=True)) + r')'
+                    r'\s*(?:id|no\.?|number|#)?\s*[:=#]?\s*' + number + r'\b',
+                    re.IGNORECASE,
+                )
+                self.typed_fields.append((name, field_type, pattern))
+            elif field_type == "date":
+                self.date_fields.append(name)
+
+        self.term_pattern = None
+        if self.terms:
+            self.term_pattern = re.compile(
+                r'\b(' + "|".join(re.escape(term) for term in sorted(self.terms, key=len, reverse=True)) + r')s?\b',
+                re.IGNORECASE,
+            )
+
+    def _add_term(self, term, attribute_name, value, synonym):
+        # Proper names, acronyms, phrases and synonyms identify the attribute on their own
+        specific = synonym or " " in term or not term.islower() or not term.isalpha()
+        self.terms.setdefault(term.lower(), []).append((attribute_name, value, specific))
+
+    def _hinted_outside(self, name, query, span):
+        """Whether the attribute is mentioned in the query outside the span of a matched term."""
+        start, end = span
+        return any(hint.end() <= start or hint.start() >= end for hint in self.hints[name].finditer(query))
+
+    def extract(self, query):
+        """
+        Returns (metadata, confident). metadata has every attribute of the twin,
+        with None for the ones not found in the query.
+        """
+        metadata = {name: None for name in self.attribute_names}
+        confident = True
+        resolved = set()
+
+        if self.term_pattern:
+            for match in self.term_pattern.finditer(query):
+                matched_text = match.group(1)
+                for name, value, specific in self.terms[matched_text.lower()]:
+                    if metadata[name] is not None and metadata[name] != value:
+                        # Two different values for the same attribute
+                        confident = False
+                    if not (specific or matched_text.isupper() or self._hinted_outside(name, query, match.span())):
+                        confident = False
+                    metadata[name] = value
+                    resolved.add(name)
+
+        for name, field_type, pattern in self.typed_fields:
+            match = pattern.search(query)
+            if match:
+                number = match.group(1)
+                metadata[name] = int(number) if field_type == "integer" else float(number)
+                resolved.add(name)
+
+        for name in self.date_fields:
+            value = _parse_date(query)
+            if value:
+                metadata[name] = value
+                resolved.add(name)
+            elif DATE_HINT_PATTERN.search(query):
+                confident = False
+
+        # An attribute is mentioned but no value could be pulled out of the query
+        for name in self.attribute_names:
+            if name not in resolved and self.hints[name].search(query):
+                confident = False
+
+        return metadata, confident
+
+
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def get_local_extractor(twin_version_id):
+    """Returns the compiled extractor for the twin, rebuilding it when its schema changes."""
+    schema_version = get_schema_version(twin_version_id)
+    cached = _extractors.get(twin_version_id)
+    if cached and cached[0] == schema_version:
+        return cached[1]
+
+    with _extractors_lock:
+        extractor = LocalMetadataExtractor(get_twin_attributes(twin_version_id))
+        _extractors[twin_version_id] = (schema_version, extractor)
+    return extractor
+
+
+def extract_metadata_locally(twin_version_id, query):
+    """Returns (metadata, confident) for the query using the twin's compiled extractor."""
+    if not query:
+        return {}, False
+    return get_local_extractor(twin_version_id).extract(query)
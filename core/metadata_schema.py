@@ -0,0 +1,145 @@
+"""
+Registry of the per-twin metadata attribute definitions.
+
+Definitions are stored in the meta_data_attributes table (MetaDataAttributes), one row per
+attribute of a twin version. A twin's definitions are loaded on first use and kept in memory
+by twin_version_id, together with a short schema version hash (callers use it to key anything
+derived from the schema) and the metadata extraction prompt messages built from them.
+Saving or deleting a row drops the twin's entry in this process right away, other worker
+processes reload it after METADATA_SCHEMA_TTL seconds.
+
+Twins that have no rows in the table yet fall back to meta_data_attributes.json, which is
+re-read whenever its modification time changes. `python manage.py import_metadata_schema`
+copies the file into the table.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from core.models import MetaDataAttributes
+
+METADATA_ATTRIBUTES_FILE = os.path.join(settings.BASE_DIR, 'meta_data_attributes.json')
+
+_lock = threading.Lock()
+_file_state = {
+    "mtime": None,
+    "twin_versions": {},
+}
+# twin_version_id -> (loaded_at, entry)
+_entries = {}
+
+
+def _schema_hash(attributes):
+    serialized = json.dumps(attributes, sort_keys=True)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()[:12]
+
+
+# Function to (re)build the twin index when the JSON file has changed on disk
+def _refresh_file():
+    try:
+        mtime = os.path.getmtime(METADATA_ATTRIBUTES_FILE)
+    except OSError:
+        return
+
+    if mtime == _file_state["mtime"]:
+        return
+
+    with _lock:
+        if mtime == _file_state["mtime"]:
+            return
+
+        with open(METADATA_ATTRIBUTES_FILE, 'r') as f:
+            metadata_attributes = json.load(f)
+
+        _file_state["twin_versions"] = {
+            twin_version["twin_version_id"]: twin_version["attributes"]
+            for twin_version in metadata_attributes.get("twin_versions", [])
+        }
+        _file_state["mtime"] = mtime
+        # Entries loaded from the old file are stale now
+        _entries.clear()
+        print(f"Loaded metadata attributes for {len(_file_state['twin_versions'])} twin versions from file")
+
+
+def load_file_schemas():
+    """Returns {twin_version_id: attributes} from meta_data_attributes.json."""
+    _refresh_file()
+    return _file_state["twin_versions"]
+
+
+def _load_attributes(twin_version_id):
+    try:
+        attributes = list(
+            MetaDataAttributes.objects.filter(twin_version_id=twin_version_id)
+            .order_by("position", "id")
+            .values("meta_data_name", "meta_data_format", "meta_data_format_prompt")
+        )
+    except Exception as e:
+        print(f"Error loading metadata attributes of {twin_version_id} from the database: {e}")
+        attributes = []
+
+    return attributes or load_file_schemas().get(twin_version_id, [])
+
+
+def _build_entry(attributes):
+    return {
+        "attributes": attributes,
+        "schema_version": _schema_hash(attributes) if attributes else "none",
+        # Same text as the metadata extraction prompt always had, built once per schema
+        "prompt_fragments": tuple(
+            {
+                "role": "system",
+                "content": f"{attribute['meta_data_format_prompt']}: {attribute['meta_data_format']}",
+            }
+            for attribute in attributes
+        ),
+    }
+
+
+def _get_entry(twin_version_id):
+    _refresh_file()
+    cached = _entries.get(twin_version_id)
+    if cached and time.monotonic() - cached[0] < settings.METADATA_SCHEMA_TTL:
+        return cached[1]
+
+    entry = _build_entry(_load_attributes(twin_version_id))
+    _entries[twin_version_id] = (time.monotonic(), entry)
+    return entry
+
+
+def invalidate_schema(twin_version_id=None):
+    """Drops the cached schema of a twin, or of all twins."""
+    if twin_version_id is None:
+        _entries.clear()
+    else:
+        _entries.pop(twin_version_id, None)
+
+
+@receiver([post_save, post_delete], sender=MetaDataAttributes)
+def _invalidate_on_edit(sender, instance, **kwargs):
+    invalidate_schema(instance.twin_version_id)
+
+
+def get_twin_attributes(twin_version_id):
+    """
+    Returns the list of metadata attribute definitions for the twin version,
+    or an empty list when the twin has no schema.
+    """
+    return _get_entry(twin_version_id)["attributes"]
+
+
+def get_schema_version(twin_version_id):
+    """
+    Returns a short hash of the twin's attribute definitions. It changes whenever
+    they are edited.
+    """
+    return _get_entry(twin_version_id)["schema_version"]
+
+
+def get_metadata_prompt_fragments(twin_version_id):
+    """Returns the precompiled prompt messages describing each metadata attribute of the twin."""
+    return _get_entry(twin_version_id)["prompt_fragments"]
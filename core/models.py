@@ -1,8 +1,34 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.postgres.fields import ArrayField
 from pgvector.django import VectorField, HnswIndex
 
    
+class Document(models.Model):
+    """Catalog of the ingested documents, one row per pdf_id, kept with its chunks in VectorDB."""
+    id = models.BigAutoField(primary_key=True)
+    pdf_id = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=255)
+    twin_id = models.CharField(max_length=255, default="")
+    twin_version_id = models.CharField(max_length=255, default="")
+    type = models.CharField(max_length=255, default="document")
+    asset_id = models.CharField(max_length=255, null=True, blank=True)
+    integration_entity_id = models.UUIDField(null=True, blank=True)
+    meta_data = models.JSONField(default=dict)
+    chunk_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'document'
+        indexes = [
+            # Keyset pagination of a twin's documents, newest first
+            models.Index(fields=['twin_id', 'id'], name='document_twin_idx'),
+            models.Index(fields=['twin_version_id'], name='document_twin_version_idx'),
+            models.Index(fields=['twin_id', 'asset_id', 'integration_entity_id'], name='document_asset_idx'),
+        ]
+
+
 class VectorDB(models.Model):
     id = models.BigAutoField(primary_key=True)
     pdf_id = models.CharField(max_length=255,default="")
@@ -21,6 +47,8 @@ class VectorDB(models.Model):
     type = models.CharField(max_length=255, default="document")
     asset_id = models.CharField(max_length=255, null=True, blank=True)
     integration_entity_id = models.UUIDField(null=True, blank=True)
+    token_count = models.IntegerField(null=True, blank=True, help_text="Number of gpt-4o-mini tokens in text, computed at ingest")
+    document = models.ForeignKey(Document, related_name='chunks', on_delete=models.CASCADE, null=True, blank=True)
     
     class Meta:
         indexes = [
@@ -34,9 +62,12 @@ class VectorDB(models.Model):
         ]
 
 class MetaDataAttributes(models.Model):
+    twin_version_id = models.CharField(max_length=255, default="", db_index=True)
     meta_data_name = models.CharField(max_length=255)
     meta_data_format = models.JSONField()  
     meta_data_format_prompt = models.CharField(max_length=255)
+    position = models.IntegerField(default=0, help_text="Order of the attribute in the twin's schema")
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         db_table = 'meta_data_attributes' 
@@ -45,9 +76,17 @@ class ChatInstance(models.Model):
     id = models.BigAutoField(primary_key=True)
     twin_id = models.CharField(max_length=255) 
     created_at = models.DateTimeField(auto_now_add=True)  
+    # Activity summary for the chat list, updated when chat turns are written
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.IntegerField(default=0)
+    last_query_preview = models.CharField(max_length=200, default="", blank=True)
 
     class Meta:
         db_table = 'chat_instance'
+        indexes = [
+            # Keyset pagination of a twin's chat instances, newest first
+            models.Index(fields=['twin_id', 'id'], name='chat_instance_twin_id_idx'),
+        ]
         
 class ChatHistory(models.Model):
     id = models.BigAutoField(primary_key=True)
@@ -55,11 +94,73 @@ class ChatHistory(models.Model):
     twin_id = models.CharField(max_length=255)
     user_query = models.CharField()
     chatbot_response = models.CharField() 
+    query_embedding = VectorField(
+        dimensions=1536,
+        help_text="Vector embedding of the user query, used by the semantic answer cache",
+        null=True,
+        blank=True,
+    )
+    cacheable = models.BooleanField(default=True)
+    # Joins the turn with its RequestLedger row
+    request_id = models.CharField(max_length=32, blank=True, default="")
+    # Partition key of chat_history, see core/chat_history_partitions.py
+    created_at = models.DateTimeField(default=timezone.now)
+
     class Meta:
         db_table = 'chat_history' 
+        indexes = [
+            # Keyset pagination of a chat's history, newest first
+            models.Index(fields=['twin_id', 'chat_instance', 'id'], name='chat_history_instance_idx'),
+            HnswIndex(
+                name="chat_history_query_embedding_index",
+                fields=["query_embedding"],
+                m=16,
+                ef_construction=64,
+                opclasses=["vector_cosine_ops"],
+            )
+        ]
         
 
 
+
+class ChatMemory(models.Model):
+    chat_instance_id = models.BigIntegerField(primary_key=True)
+    turns = models.JSONField(default=list, help_text="Most recent turns of the chat as {query, response, tokens}")
+    summary = models.TextField(default="", blank=True, help_text="Rolling summary of the turns before them")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'chat_memory'
+
+
+class RequestLedger(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    twin_id = models.CharField(max_length=255)
+    chat_instance_id = models.BigIntegerField(null=True, blank=True)
+    endpoint = models.CharField(max_length=100)
+    status_code = models.IntegerField()
+    total_ms = models.FloatField()
+    stage_timings = models.JSONField(default=dict, help_text="Milliseconds spent per pipeline stage")
+    llm_calls = models.IntegerField(default=0)
+    prompt_tokens = models.IntegerField(default=0)
+    completion_tokens = models.IntegerField(default=0)
+    embedding_calls = models.IntegerField(default=0)
+    embedding_tokens = models.IntegerField(default=0)
+    rerank_documents = models.IntegerField(default=0)
+    chunks_packed = models.IntegerField(default=0)
+    cache_hits = models.JSONField(default=list)
+    cost_usd = models.FloatField(default=0)
+    request_id = models.CharField(max_length=32, blank=True, default="", db_index=True)
+    retrieval = models.JSONField(default=dict, help_text="Metadata filter and chunk ids the request retrieved")
+
+    class Meta:
+        db_table = 'request_ledger'
+        indexes = [
+            models.Index(fields=['twin_id', 'created_at'], name='request_ledger_twin_idx'),
+            models.Index(fields=['created_at'], name='request_ledger_created_idx'),
+        ]
+
         
 def __str__(self):
     return f"Page {self.page}: {self.text[:50]}"
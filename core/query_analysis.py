@@ -0,0 +1,144 @@
+"""
+Routing and metadata extraction of a user query in one step.
+
+A document query used to need one LLM call to route it and another one to extract its
+metadata filter before the answer could be generated. analyze_query returns both: the local
+router and the local metadata extractor are tried first, and when the LLM is still needed a
+single structured call returns the route together with the metadata of the twin's schema.
+The route and the metadata are cached like the separate calls cache them, so a document
+response request that follows a decision pipeline request for the same query reuses them.
+"""
+import json
+from core.llm_client import create_chat_completion
+from core.llm_scheduler import INTERACTIVE
+from core.metadata_cache import get_cached_metadata, set_cached_metadata
+from core.metadata_extractor import extract_metadata_locally
+from core.metadata_schema import get_twin_attributes, get_metadata_prompt_fragments
+from core.query_router import (
+    SYSTEM_PROMPT as ROUTING_PROMPT,
+    route_locally,
+    route_by_prototype,
+    route_with_llm,
+    get_cached_route,
+    set_cached_route,
+    parse_decision,
+)
+from core.request_metrics import cache_hit
+
+METADATA_INSTRUCTIONS = (
+    'In the same JSON object, add a "metadata" object with the following metadata extracted from the user query, '
+    'whatever its type is.'
+)
+
+METADATA_FORMAT_INSTRUCTIONS = (
+    "Within the metadata object, just provide the meta data attribute and the value for it only. Do not add additional "
+    "details like enum, examples etc. If any of these metadata fields are not found, return null for those fields. "
+    "The property names must be enclosed in double quotes."
+)
+
+
+def construct_analysis_prompt(twin_version_id, query):
+    """The instructions and the twin's schema come first, so every query of a twin shares the same prefix."""
+    prompt = [
+        {"role": "system", "content": ROUTING_PROMPT},
+        {"role": "system", "content": METADATA_INSTRUCTIONS},
+    ]
+    prompt.extend(get_metadata_prompt_fragments(twin_version_id))
+    prompt.append({"role": "system", "content": METADATA_FORMAT_INSTRUCTIONS})
+    prompt.append({"role": "user", "content": query})
+    return prompt
+
+
+def parse_analysis(content, twin_version_id, query):
+    """
+    Returns (decision, metadata, valid) from the JSON response. metadata has every attribute
+    of the twin, valid is False when the response had no metadata object.
+    """
+    try:
+        analysis = json.loads(content)
+    except (TypeError, ValueError):
+        analysis = {}
+    if not isinstance(analysis, dict):
+        analysis = {}
+
+    extracted = analysis.get("metadata")
+    valid = isinstance(extracted, dict)
+    if not valid:
+        extracted = {}
+
+    metadata = {}
+    for attribute in get_twin_attributes(twin_version_id):
+        name = attribute["meta_data_name"]
+        metadata[name] = extracted.get(name)
+
+    return parse_decision(analysis, query), metadata, valid
+
+
+def _local_metadata(twin_version_id, query):
+    """Returns the metadata JSON from the cache or the local extractor, or None when the LLM is needed."""
+    metadata_json = get_cached_metadata(twin_version_id, query)
+    if metadata_json is not None:
+        cache_hit("metadata_cache")
+        return metadata_json
+
+    metadata, confident = extract_metadata_locally(twin_version_id, query)
+    if confident:
+        cache_hit("metadata_local")
+        metadata_json = json.dumps(metadata)
+        set_cached_metadata(twin_version_id, query, metadata_json)
+        return metadata_json
+    return None
+
+
+def _with_metadata(decision, metadata_json):
+    if decision["type"] != "document_query":
+        return decision
+    return {**decision, "metadata": json.loads(metadata_json)}
+
+
+def analyze_query(query, twin_version_id, query_vector=None, priority=INTERACTIVE):
+    """
+    Returns (decision, source) for the query. Document query decisions carry the extracted
+    metadata under "metadata". source is "rules", "prototype", "cache", "llm" or "fused",
+    the last one being a single LLM call for both the route and the metadata.
+    """
+    decision = route_locally(query, twin_version_id)
+    if decision:
+        return decision, "rules"
+
+    metadata_json = _local_metadata(twin_version_id, query)
+    cached_decision = get_cached_route(twin_version_id, query)
+
+    if metadata_json is not None:
+        # Only the route is missing
+        if cached_decision:
+            return _with_metadata(cached_decision, metadata_json), "cache"
+        decision = route_by_prototype(query, query_vector)
+        if decision:
+            return _with_metadata(decision, metadata_json), "prototype"
+        decision = route_with_llm(query, twin_version_id, priority)
+        return _with_metadata(decision, metadata_json), "llm"
+
+    if cached_decision and cached_decision["type"] != "document_query":
+        return cached_decision, "cache"
+
+    completion = create_chat_completion(
+        construct_analysis_prompt(twin_version_id, query),
+        model="gpt-4o-mini",
+        tenant=twin_version_id,
+        priority=priority,
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+    content = completion.choices[0].message.content
+    print("Query analyzed.", content)
+
+    decision, metadata, valid = parse_analysis(content, twin_version_id, query)
+    # Only cache responses that parse, so a bad completion is retried next time
+    if valid:
+        set_cached_route(twin_version_id, query, decision)
+        set_cached_metadata(twin_version_id, query, json.dumps(metadata))
+
+    if decision["type"] == "document_query":
+        decision = {**decision, "metadata": metadata}
+    return decision, "fused"
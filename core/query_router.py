@@ -0,0 +1,369 @@
+"""
+Local routing of user queries for the decision pipeline.
+
+A query is a sensor query, an action query or a document query. The clear cases are decided
+here without an LLM call, in this order:
+
+1. Action rules: the whole query is a command for one of ACTIONS, e.g. "open the sun study".
+2. Sensor dictionary: the query names a known sensor of the twin (SENSOR_NAMES_FILE).
+3. Nearest prototype: the query embedding is compared with embedded example queries and the
+   route of the closest one is used when it is close enough and clearly closer than the rest.
+
+Anything else, e.g. a question that mentions an action or a sensor without matching a rule,
+goes to the LLM. Its decisions are cached per twin and normalized query.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from core.embedding_batcher import embed_text
+from core.llm_client import create_chat_completion, create_embeddings
+from core.llm_scheduler import INTERACTIVE
+from core.metadata_cache import normalize_query
+from core.request_metrics import record_usage
+from core.token_budget import count_tokens
+
+CACHE_KEY_PREFIX = "route"
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Action name -> words that name its target in a command
+ACTIONS = {
+    "open_waypoint": r"way\s?points?",
+    "open_markup": r"mark\s?ups?",
+    "open_sensors": r"sensors?(?:\s+(?:view|panel|list))?",
+    "open_sun_study": r"sun\s?stud(?:y|ies)",
+}
+
+_POLITE = r"(?:(?:please|pls|can you|could you|would you)\s+)?"
+_COMMAND = r"(?:open|show|display|launch|start|go to|bring up|view)"
+
+ACTION_PATTERNS = {
+    action: re.compile(
+        rf"^{_POLITE}{_COMMAND}\s+(?:(?:the|my|a)\s+)?{target}(?:\s+(?:please|now))?$"
+    )
+    for action, target in ACTIONS.items()
+}
+ACTION_PATTERNS["exit"] = re.compile(
+    rf"^{_POLITE}(?:exit|quit|close|leave|bye|goodbye)(?:\s+(?:the\s+)?(?:app|application|chat|view|this))?(?:\s+please)?$"
+)
+
+# Words that point to an action or to sensor data without settling the route on their own
+AMBIGUOUS_HINT_PATTERN = re.compile(
+    r"\b(?:way\s?points?|mark\s?ups?|sun\s?stud(?:y|ies)|sensors?|readings?|live|current(?:ly)?|right now)\b"
+)
+
+# Example queries per route for the nearest prototype classifier.
+# Sensor queries need the sensor names, so a query closest to them goes to the LLM.
+ROUTE_PROTOTYPES = {
+    "document_query": [
+        "What is the maintenance procedure for the chiller?",
+        "How do I reset the generator after a fault?",
+        "Summarize the fire safety policy",
+        "What does the warranty cover for the compressor?",
+        "Who is responsible for approving the site inspection report?",
+        "What are the steps to replace the air filter?",
+        "Explain the troubleshooting steps when the equipment is not working",
+        "How many days of annual leave do employees get?",
+        "What is written in the handover document about the roof?",
+        "Hi, what can you help me with?",
+    ],
+    "sensor_query": [
+        "What is the current temperature reading?",
+        "Show me the humidity sensor values for today",
+        "What is the CO2 level in the meeting room right now?",
+        "Is the occupancy sensor on level 2 reporting?",
+    ],
+    "open_waypoint": ["Take me to the waypoints", "I want to see the waypoint view"],
+    "open_markup": ["Let me add a markup", "I want to see the markups"],
+    "open_sensors": ["Let me see all the sensors", "Bring up the sensor panel"],
+    "open_sun_study": ["Let me see the sun study", "Show how the sun moves over the building"],
+    "exit": ["I am done, close this", "Get me out of here"],
+}
+
+SYSTEM_PROMPT = """
+        You are an intelligent assistant designed to process user queries and determine the appropriate action or data retrieval required. Your task is to parse the user's query and identify whether it pertains to sensors, documents, or specific actions. Based on this, you will return a JSON structure indicating the next steps.
+
+        1. **Sensor API**: If the user query mentions any sensor names, return the query and the sensor name(s) in a JSON structure.
+        2. **Action API**: If the user query mentions any specific action, return the action in a JSON structure. Recognized actions include:
+            - "open waypoint": open_waypoint
+            - "open markup": open_markup
+            - "open sensors": open_sensors
+            - "open sun study": open_sun_study
+            - "exit": exit
+        3. **Document API**: If the query does not mention a sensor or a specific action, return the original user query.
+
+        Below is the format for your response based on the identified criteria:
+
+        - **Sensor Query JSON Structure:**
+              "type": "sensor_query",
+              "query": "{query}",
+              "sensors": ["<sensor_name_1>", "<sensor_name_2>", ...]
+
+        - **Action Query JSON Structure:**
+              "type": "action_query",
+              "action": "<identified_action>"
+
+
+        - **Original Query JSON Structure:**
+              "type": "document_query",
+              "query": "{query}"
+
+
+        Process the user query accordingly and return the appropriate JSON structure.
+        """
+
+
+def action_decision(action):
+    return {"type": "action_query", "action": action}
+
+
+def sensor_decision(query, sensors):
+    return {"type": "sensor_query", "query": query, "sensors": sensors}
+
+
+def document_decision(query):
+    return {"type": "document_query", "query": query}
+
+
+class SensorDictionary:
+    """
+    Known sensor names per twin, from the optional JSON file set by SENSOR_NAMES_FILE:
+    {"default": [...], "<twin_version_id>": [...]}, where each sensor is a name or
+    {"name": ..., "synonyms": [...]}. The file is re-read whenever it changes and the
+    names of each twin are compiled into one pattern, longest name first.
+    """
+
+    def __init__(self, sensors_file=None):
+        self.sensors_file = sensors_file
+        self._file_mtime = None
+        self._lock = threading.Lock()
+        self._sensors = {}
+        self._compiled = {}
+
+    def _refresh(self):
+        if not self.sensors_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.sensors_file)
+        except OSError:
+            mtime = None
+        if mtime == self._file_mtime:
+            return
+
+        with self._lock:
+            if mtime == self._file_mtime:
+                return
+            sensors = {}
+            if mtime is not None:
+                try:
+                    with open(self.sensors_file, 'r') as f:
+                        sensors = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Error loading sensor names from {self.sensors_file}: {e}")
+                    return
+            self._sensors = sensors
+            self._compiled = {}
+            self._file_mtime = mtime
+            print(f"Loaded sensor names for {len(sensors)} twins")
+
+    def _compile(self, twin_version_id):
+        terms = {}
+        for sensor in self._sensors.get("default", []) + self._sensors.get(twin_version_id, []):
+            if isinstance(sensor, str):
+                sensor = {"name": sensor}
+            for term in [sensor["name"], *sensor.get("synonyms", [])]:
+                terms[term.lower()] = sensor["name"]
+
+        pattern = None
+        if terms:
+            pattern = re.compile(
+                r'\b(' + "|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)) + r')s?\b',
+                re.IGNORECASE,
+            )
+        return pattern, terms
+
+    def find(self, twin_version_id, query):
+        """Returns the names of the twin's sensors mentioned in the query, in order of appearance."""
+        self._refresh()
+        compiled = self._compiled.get(twin_version_id)
+        if compiled is None:
+            compiled = self._compile(twin_version_id)
+            self._compiled[twin_version_id] = compiled
+
+        pattern, terms = compiled
+        if pattern is None:
+            return []
+
+        names = []
+        for match in pattern.finditer(query):
+            name = terms[match.group(1).lower()]
+            if name not in names:
+                names.append(name)
+        return names
+
+
+sensor_dictionary = SensorDictionary(getattr(settings, "SENSOR_NAMES_FILE", None))
+
+
+class PrototypeClassifier:
+    """
+    Nearest prototype classifier over ROUTE_PROTOTYPES. The prototypes are embedded in one
+    request the first time a query needs them.
+    """
+
+    def __init__(self, prototypes, model=EMBEDDING_MODEL):
+        self.prototypes = prototypes
+        self.model = model
+        self.labels = None
+        self.matrix = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.matrix is not None:
+            return
+        with self._lock:
+            if self.matrix is not None:
+                return
+            labels, texts = [], []
+            for label, examples in self.prototypes.items():
+                labels.extend([label] * len(examples))
+                texts.extend(examples)
+
+            response = create_embeddings(texts, model=self.model, pool="ingest")
+            matrix = np.array([item.embedding for item in response.data], dtype=np.float32)
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+            self.labels = labels
+            self.matrix = matrix
+
+    def classify(self, query_vector):
+        """Returns (label, similarity, margin) of the closest route and how much closer it is than the next one."""
+        self._load()
+        vector = np.asarray(query_vector, dtype=np.float32)
+        similarities = self.matrix @ (vector / np.linalg.norm(vector))
+
+        best = {}
+        for label, similarity in zip(self.labels, similarities):
+            if similarity > best.get(label, -1):
+                best[label] = float(similarity)
+
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)
+        (label, similarity), (_, runner_up) = ranked[0], ranked[1]
+        return label, similarity, similarity - runner_up
+
+
+prototype_classifier = PrototypeClassifier(ROUTE_PROTOTYPES)
+
+
+def route_locally(query, twin_version_id=None):
+    """
+    Returns the decision for a query that the rules settle on their own, or None.
+    Takes no I/O, so it can run before anything else in a request.
+    """
+    normalized = normalize_query(query)
+
+    for action, pattern in ACTION_PATTERNS.items():
+        if pattern.match(normalized):
+            return action_decision(action)
+
+    sensors = sensor_dictionary.find(twin_version_id, query)
+    if sensors:
+        return sensor_decision(query, sensors)
+
+    return None
+
+
+def route_by_prototype(query, query_vector=None):
+    """
+    Returns the decision of the nearest prototype, or None when the query is ambiguous.
+    Embeds the query unless its embedding is passed in.
+    """
+    if AMBIGUOUS_HINT_PATTERN.search(normalize_query(query)):
+        return None
+
+    if query_vector is None:
+        query_vector = embed_text(query, model=EMBEDDING_MODEL, hedge=True)
+        record_usage("embeddings", EMBEDDING_MODEL, count_tokens(query))
+
+    label, similarity, margin = prototype_classifier.classify(query_vector)
+    print(f"Nearest route prototype: {label} (similarity {similarity:.3f}, margin {margin:.3f})")
+    if similarity < settings.ROUTER_PROTOTYPE_THRESHOLD or margin < settings.ROUTER_PROTOTYPE_MARGIN:
+        return None
+    if label == "document_query":
+        return document_decision(query)
+    if label in ACTION_PATTERNS:
+        return action_decision(label)
+    # Closest to a sensor query, but no known sensor name was found
+    return None
+
+
+def _cache_key(twin_version_id, query):
+    query_hash = hashlib.sha1(normalize_query(query).encode("utf-8")).hexdigest()
+    return f"{CACHE_KEY_PREFIX}:{twin_version_id}:{query_hash}"
+
+
+def parse_decision(content, query):
+    """Returns the decision from the LLM's JSON response, or a document query when it is not usable."""
+    try:
+        decision = json.loads(content) if isinstance(content, str) else content
+    except (TypeError, ValueError):
+        return document_decision(query)
+
+    route = decision.get("type") if isinstance(decision, dict) else None
+    if route == "action_query" and decision.get("action") in ACTION_PATTERNS:
+        return action_decision(decision["action"])
+    if route == "sensor_query" and decision.get("sensors"):
+        return sensor_decision(query, list(decision["sensors"]))
+    return document_decision(query)
+
+
+def get_cached_route(twin_version_id, query):
+    """Returns the cached LLM decision for the query, or None on a miss."""
+    decision = cache.get(_cache_key(twin_version_id, query))
+    if decision is not None and "query" in decision:
+        return {**decision, "query": query}
+    return decision
+
+
+def set_cached_route(twin_version_id, query, decision):
+    decision = {key: value for key, value in decision.items() if key != "metadata"}
+    cache.set(_cache_key(twin_version_id, query), decision, timeout=settings.ROUTER_CACHE_TTL)
+
+
+def route_with_llm(query, twin_version_id=None, priority=INTERACTIVE):
+    """Asks the LLM for the route of the query. Decisions are cached per twin and normalized query."""
+    decision = get_cached_route(twin_version_id, query)
+    if decision is not None:
+        return decision
+
+    completion = create_chat_completion(
+        [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": query},
+        ],
+        model="gpt-4o-mini",
+        tenant=twin_version_id,
+        priority=priority,
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+    decision = parse_decision(completion.choices[0].message.content, query)
+    set_cached_route(twin_version_id, query, decision)
+    return decision
+
+
+def route_query(query, twin_version_id=None, priority=INTERACTIVE):
+    """Returns (decision, source) for the query, where source is "rules", "prototype" or "llm"."""
+    decision = route_locally(query, twin_version_id)
+    if decision:
+        return decision, "rules"
+
+    decision = route_by_prototype(query)
+    if decision:
+        return decision, "prototype"
+
+    return route_with_llm(query, twin_version_id, priority), "llm"
@@ -0,0 +1,69 @@
+"""
+Per request cost and latency ledger.
+
+Every document response request leaves one RequestLedger row with its stage timings, API
+calls and tokens, the number of documents reranked and chunks packed, the caches it hit and
+its cost in USD from MODEL_PRICES, and what it retrieved under its request_id. Rows are written in batches by a background writer so
+the ledger adds no database round trip to the request.
+"""
+import math
+from django.conf import settings
+from django.utils import timezone
+from core.chat_history_writer import BatchWriter
+from core.models import RequestLedger
+
+ledger_writer = BatchWriter(
+    RequestLedger,
+    batch_size=settings.CHAT_HISTORY_WRITE_BATCH_SIZE,
+    flush_interval=settings.CHAT_HISTORY_FLUSH_INTERVAL,
+)
+
+
+def estimate_cost(usage, rerank_documents):
+    cost = 0.0
+    for key, calls in usage.items():
+        model = key.split(":", 1)[1]
+        input_price, output_price = settings.MODEL_PRICES.get(model, (0, 0))
+        cost += (calls["prompt_tokens"] * input_price + calls["completion_tokens"] * output_price) / 1_000_000
+
+    # Cohere bills one search unit per 100 documents
+    cost += math.ceil(rerank_documents / 100) * settings.RERANK_PRICE_PER_SEARCH
+    return cost
+
+
+def record_request_ledger(request, endpoint, twin_version_id, chat_instance_id, status_code):
+    """Queues the ledger row of a finished request, as returned by request_metrics.get_last_request()."""
+    if not settings.REQUEST_LEDGER_ENABLED or request is None:
+        return
+
+    usage = request["usage"]
+    chat = [calls for key, calls in usage.items() if key.startswith("chat:")]
+    embeddings = [calls for key, calls in usage.items() if key.startswith("embeddings:")]
+    counters = request["counters"]
+    rerank_documents = counters.get("rerank_documents", 0)
+
+    try:
+        chat_instance_id = int(chat_instance_id) if chat_instance_id is not None else None
+    except (TypeError, ValueError):
+        chat_instance_id = None
+
+    ledger_writer.put({
+        "twin_id": twin_version_id or "",
+        "chat_instance_id": chat_instance_id,
+        "endpoint": endpoint,
+        "status_code": status_code,
+        "total_ms": request["timings"].get("total", 0),
+        "stage_timings": {name: round(ms, 2) for name, ms in request["timings"].items() if name != "total"},
+        "llm_calls": sum(calls["calls"] for calls in chat),
+        "prompt_tokens": sum(calls["prompt_tokens"] for calls in chat),
+        "completion_tokens": sum(calls["completion_tokens"] for calls in chat),
+        "embedding_calls": sum(calls["calls"] for calls in embeddings),
+        "embedding_tokens": sum(calls["prompt_tokens"] for calls in embeddings),
+        "rerank_documents": rerank_documents,
+        "chunks_packed": counters.get("chunks_packed", 0),
+        "cache_hits": request["cache_hits"],
+        "cost_usd": estimate_cost(usage, rerank_documents),
+        "request_id": request.get("request_id", ""),
+        "retrieval": request.get("retrieval", {}),
+        "created_at": timezone.now(),
+    })
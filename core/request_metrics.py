@@ -0,0 +1,135 @@
+"""
+Per-request measurements for the document response pipeline.
+
+A request calls start_request() and wraps each pipeline stage in `with stage("name"):`.
+While the request runs, token usage of the API calls (record_usage), counters such as the
+number of chunks packed (count) and cache hits (cache_hit) are collected with it.
+Measurements are kept per thread, so concurrent requests in a threaded server (or in the
+latency benchmark) do not mix. Work a request hands to a thread pool is measured with it
+when the function is wrapped with bind_request(). finish_request() returns the timings in milliseconds together
+with the end to end time, and get_last_request() everything collected for the request.
+
+Every request gets a request_id, saved with its chat turn and its ledger row so the two can
+be joined, and what it retrieved (record_retrieval) is kept with it for the ledger.
+"""
+import functools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+_local = threading.local()
+# Guards the updates, a request's measurements can come from several threads
+_lock = threading.Lock()
+
+
+def start_request():
+    _local.request = {
+        "request_id": uuid.uuid4().hex,
+        "start": time.perf_counter(),
+        "timings": {},
+        "usage": {},
+        "counters": {},
+        "cache_hits": [],
+        "retrieval": {},
+    }
+
+
+def _current():
+    return getattr(_local, "request", None)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request = _current()
+        if request is not None:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with _lock:
+                request["timings"][name] = request["timings"].get(name, 0) + elapsed_ms
+
+
+def record_usage(operation, model, prompt_tokens=0, completion_tokens=0, calls=1):
+    """Adds API calls and their token usage to the current request."""
+    request = _current()
+    if request is None:
+        return
+    with _lock:
+        usage = request["usage"].setdefault(f"{operation}:{model}", {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        usage["calls"] += calls
+        usage["prompt_tokens"] += prompt_tokens or 0
+        usage["completion_tokens"] += completion_tokens or 0
+
+
+def count(name, value=1):
+    request = _current()
+    if request is not None:
+        with _lock:
+            request["counters"][name] = request["counters"].get(name, 0) + value
+
+
+def cache_hit(name):
+    request = _current()
+    if request is None:
+        return
+    with _lock:
+        if name not in request["cache_hits"]:
+            request["cache_hits"].append(name)
+
+
+def get_request_id():
+    """Returns the id of the current request, or "" outside of a request."""
+    request = _current()
+    return request["request_id"] if request is not None else ""
+
+
+def record_retrieval(**fields):
+    """Sets what the current request retrieved, e.g. its metadata filter and chunk ids."""
+    request = _current()
+    if request is not None:
+        with _lock:
+            request["retrieval"].update(fields)
+
+
+def bind_request(fn):
+    """
+    Wraps fn so that, wherever it runs, its measurements go to the request active now.
+    The request must wait for fn before it finishes.
+    """
+    request = _current()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = _current()
+        _local.request = request
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.request = previous
+
+    return wrapper
+
+
+def finish_request():
+    """Returns the stage timings of the current request in ms, with the total under "total"."""
+    request = _current()
+    if request is None:
+        return {}
+    request["timings"]["total"] = (time.perf_counter() - request["start"]) * 1000
+    _local.last_request = request
+    _local.request = None
+    return request["timings"]
+
+
+def get_last_request():
+    """Returns everything collected for the last request finished on this thread."""
+    return getattr(_local, "last_request", None)
+
+
+def get_last_request_timings():
+    """Returns the timings of the last request finished on this thread."""
+    request = get_last_request()
+    return request["timings"] if request else {}
@@ -0,0 +1,102 @@
+"""
+Per chat instance working set of the last retrieval.
+
+After a query is answered, the metadata filter, the query embedding and the ranked chunks
+it retrieved are kept for the chat instance. A follow-up like "yes" or "tell me more" is about
+the same documents, so it reuses them instead of extracting metadata, embedding the follow-up
+text and searching again. Only a follow-up that brings new terms is searched again, with the
+previous query and the new terms together.
+
+Every twin has a generation counter in the cache, bumped by invalidate_answer_cache whenever the
+twin's documents are uploaded, updated or deleted. A working set keeps the generation it was
+saved under and is ignored once the twin has moved on, in every process sharing the cache.
+
+Saving the working set also records the retrieval with the current request, so its ledger row
+says which filter and chunks the answer was based on.
+"""
+import re
+from django.conf import settings
+from django.core.cache import cache
+from core.request_metrics import record_retrieval
+
+CACHE_KEY_PREFIX = "working_set"
+GENERATION_KEY_PREFIX = "working_set_generation"
+
+# Words of a follow-up that do not change what should be retrieved
+FOLLOW_UP_STOP_WORDS = frozenset("""
+    a about again ahead all also an and any are as at be but can continue could details do does
+    elaborate else explain for further give go good great how i in is it its just know let like
+    me more my no not now of ok okay on or please right say see show so sure tell thank thanks
+    that the them then there these they this those to up us want was we what when where which
+    who why will with would yeah yep yes you your
+""".split())
+
+
+def _cache_key(chat_instance_id):
+    return f"{CACHE_KEY_PREFIX}:{chat_instance_id}"
+
+
+def _generation_key(twin_version_id):
+    return f"{GENERATION_KEY_PREFIX}:{twin_version_id}"
+
+
+def get_generation(twin_version_id):
+    return cache.get(_generation_key(twin_version_id), 0)
+
+
+def bump_generation(twin_version_id):
+    """Makes every working set of the twin saved so far stale."""
+    key = _generation_key(twin_version_id)
+    # add is a no-op when the counter exists, incr is atomic in the shared cache backends
+    cache.add(key, 0, timeout=None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Evicted between add and incr
+        cache.set(key, 1, timeout=None)
+        return 1
+
+
+def save_working_set(chat_instance_id, twin_version_id, query, metadata, query_vector, results):
+    chunk_ids = [result.get("id") for result in results]
+    record_retrieval(query=query, metadata=metadata, chunk_ids=chunk_ids, reused=False)
+    cache.set(
+        _cache_key(chat_instance_id),
+        {
+            "twin_version_id": twin_version_id,
+            "generation": get_generation(twin_version_id),
+            "query": query,
+            "metadata": metadata,
+            "query_vector": query_vector,
+            "chunk_ids": chunk_ids,
+            "results": results,
+        },
+        timeout=settings.RETRIEVAL_WORKING_SET_TTL,
+    )
+
+
+def get_working_set(chat_instance_id, twin_version_id):
+    """
+    Returns the working set of the chat instance, or None if there is none for this twin or the
+    twin's documents changed since it was saved.
+    """
+    working_set = cache.get(_cache_key(chat_instance_id))
+    if working_set is None or working_set["twin_version_id"] != twin_version_id:
+        return None
+    if working_set.get("generation", 0) != get_generation(twin_version_id):
+        return None
+    return working_set
+
+
+def clear_working_set(chat_instance_id):
+    cache.delete(_cache_key(chat_instance_id))
+
+
+def find_new_terms(query, previous_query):
+    """Returns the words of the follow-up that are neither filler nor part of the previous query."""
+    previous_words = set(re.findall(r"\w+", (previous_query or "").lower()))
+    new_terms = []
+    for word in re.findall(r"\w+", query.lower()):
+        if len(word) > 2 and word not in FOLLOW_UP_STOP_WORDS and word not in previous_words and word not in new_terms:
+            new_terms.append(word)
+    return new_terms
@@ -7,11 +7,21 @@ class ChatInstanceSerializer(serializers.ModelSerializer):
         fields = ['id', 'twin_id', 'created_at']
         
 class ChatHistoryItemSerializer(serializers.Serializer):
+    id = serializers.IntegerField(help_text="The identifier of the chat history item.")
     user_query = serializers.CharField(help_text="The query sent by the user.")
     chatbot_response = serializers.CharField(help_text="The response from the chatbot.")
 
 class ChatHistoryResponseSerializer(serializers.Serializer):
-    chat_history = ChatHistoryItemSerializer(many=True, help_text="A list of chat history items.")
+    chat_history = ChatHistoryItemSerializer(many=True, help_text="A page of chat history items, oldest first.")
+    has_more = serializers.BooleanField(help_text="Whether there are older items before this page.")
+    next_before_id = serializers.IntegerField(
+        allow_null=True,
+        help_text="The before_id to request the previous page with, null on the first page of the chat.",
+    )
+    next_before_created_at = serializers.DateTimeField(
+        allow_null=True,
+        help_text="The before_created_at to request the previous page with, null on the first page of the chat.",
+    )
     
 class OpenAIResponseContentSerializer(serializers.Serializer):
      content = serializers.CharField(
@@ -23,9 +33,23 @@ class OpenAIResponseSerializer(serializers.Serializer):
     openai_response = OpenAIResponseContentSerializer()
     
 class DocumentSerializer(serializers.Serializer):
+    id = serializers.IntegerField(help_text="The identifier of the document in the catalog.")
     pdf_id = serializers.CharField(help_text="The unique identifier for the PDF document.")
     pdf = serializers.CharField(help_text="The path or URL of the PDF document.")
+    twin_version_id = serializers.CharField(help_text="The twin version the document belongs to.")
+    type = serializers.CharField(help_text="The type of the document.")
+    asset_id = serializers.CharField(allow_null=True, help_text="The asset the document is attached to.")
+    integration_entity_id = serializers.UUIDField(allow_null=True, help_text="The integration entity the document came from.")
+    meta_data = serializers.JSONField(help_text="The metadata of the document.")
+    chunk_count = serializers.IntegerField(help_text="The number of chunks the document was split into.")
+    created_at = serializers.DateTimeField(help_text="When the document was ingested.")
+    updated_at = serializers.DateTimeField(help_text="When the catalog row was last updated.")
     
 class DocumentListResponseSerializer(serializers.Serializer):
-    documents = DocumentSerializer(many=True, help_text="A list of all available documents.")
+    documents = DocumentSerializer(many=True, help_text="A page of documents, newest first.")
+    has_more = serializers.BooleanField(help_text="Whether there are older documents after this page.")
+    next_before_id = serializers.IntegerField(
+        allow_null=True,
+        help_text="The before_id to request the next page with, null on the last page.",
+    )
 
@@ -0,0 +1,101 @@
+"""
+Speculative retrieval while the metadata filter is being extracted.
+
+The twin-scoped hybrid search is started without a filter and with a larger top_k
+(SPECULATIVE_TOP_K) as soon as the query is embedded. When the metadata filter arrives it is
+applied to those candidates in memory, with the same case-insensitive containment the search
+service uses, and a filtered search is only run when fewer than SPECULATIVE_MIN_CANDIDATES
+candidates are left.
+
+Whether this preserves result quality depends on the twin: when its filters select documents
+that are rarely among the closest chunks, the filtered candidates are a poor substitute for
+a filtered search. A sample of the speculative requests (SPECULATIVE_AUDIT_RATE) therefore
+also runs the filtered search in the background and records which share of its results the
+speculative results contained. Twins whose average falls below SPECULATIVE_MIN_RECALL go
+back to extracting the filter first.
+"""
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+
+CACHE_KEY_PREFIX = "speculative_recall"
+
+speculative_executor = ThreadPoolExecutor(
+    max_workers=settings.SPECULATIVE_SEARCH_WORKERS,
+    thread_name_prefix="speculative-search",
+)
+
+
+def _as_text(value):
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def matches_metadata(meta_data, filters):
+    """True when every filter value is contained in the chunk's metadata value, ignoring case."""
+    if not filters:
+        return True
+    if not isinstance(meta_data, dict):
+        return False
+    for key, value in filters.items():
+        if value is None:
+            continue
+        if meta_data.get(key) is None or _as_text(value).lower() not in _as_text(meta_data[key]).lower():
+            return False
+    return True
+
+
+def filter_candidates(candidates, filters):
+    """Returns the candidates matching the filter, in their reranked order."""
+    return [candidate for candidate in candidates if matches_metadata(candidate.get("meta_data"), filters)]
+
+
+def _stats_key(twin_version_id):
+    return f"{CACHE_KEY_PREFIX}:{twin_version_id}"
+
+
+def is_speculation_enabled(twin_version_id):
+    if not settings.SPECULATIVE_RETRIEVAL_ENABLED or twin_version_id in settings.SPECULATIVE_RETRIEVAL_DISABLED_TWINS:
+        return False
+    stats = cache.get(_stats_key(twin_version_id))
+    if not stats or stats["samples"] < settings.SPECULATIVE_MIN_SAMPLES:
+        return True
+    return stats["recall"] >= settings.SPECULATIVE_MIN_RECALL
+
+
+def record_recall(twin_version_id, speculative_results, filtered_results):
+    """Adds one audited request to the twin's moving average of the speculative recall."""
+    expected = {result["id"] for result in filtered_results}
+    if not expected:
+        recall = 1.0
+    else:
+        recall = len(expected & {result["id"] for result in speculative_results}) / len(expected)
+
+    key = _stats_key(twin_version_id)
+    stats = cache.get(key) or {"recall": recall, "samples": 0}
+    # Recent requests count more, so a twin whose documents changed recovers
+    stats["recall"] = 0.9 * stats["recall"] + 0.1 * recall if stats["samples"] else recall
+    stats["samples"] += 1
+    cache.set(key, stats, timeout=None)
+
+    print(f"Speculative retrieval recall for {twin_version_id}: {recall:.2f} (average {stats['recall']:.2f})")
+    if stats["samples"] >= settings.SPECULATIVE_MIN_SAMPLES and stats["recall"] < settings.SPECULATIVE_MIN_RECALL:
+        print(f"Speculative retrieval is disabled for {twin_version_id}")
+
+
+def audit_speculation(search, twin_version_id, speculative_results, query_vector, top_k, query, filters):
+    """Runs the filtered search and compares its results with the speculative ones."""
+    try:
+        filtered_results = search(query_vector, top_k, query, twin_version_id, filters)
+        record_recall(twin_version_id, speculative_results, filtered_results)
+    except Exception as e:
+        print(f"Error auditing speculative retrieval for {twin_version_id}: {e}")
+
+
+def maybe_audit(search, twin_version_id, speculative_results, query_vector, top_k, query, filters):
+    """Audits a sample of the speculative requests in the background."""
+    if filters and random.random() < settings.SPECULATIVE_AUDIT_RATE:
+        speculative_executor.submit(
+            audit_speculation, search, twin_version_id, speculative_results, query_vector, top_k, query, filters,
+        )
@@ -0,0 +1,53 @@
+"""
+Token counting helpers for prompt assembly.
+
+Chunk token counts are computed once at ingest and stored on VectorDB. At request time only the
+dynamic parts of the prompt (template, query, chat history, the short context labels) are
+tokenized, and the retrieved chunks are packed into the remaining budget from their stored counts.
+"""
+from functools import lru_cache
+import tiktoken
+
+# Same per message overhead as num_tokens_from_messages in document_search_api
+TOKENS_PER_MESSAGE = 9
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-4o-mini"):
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text, model="gpt-4o-mini"):
+    """Return the number of tokens in the text for the given model."""
+    if not text:
+        return 0
+    return len(get_encoding(model).encode(text))
+
+
+def pack_results(results, budget, context_label="Context", document_label="Document", model="gpt-4o-mini"):
+    """
+    Greedily picks results in relevance order while their context messages fit in the budget.
+    Results that do not fit are skipped so a later, shorter chunk can still be used.
+
+    Returns: tuple (list, int) - (packed results, tokens used)
+    """
+    packed = []
+    used_tokens = 0
+    role_tokens = count_tokens("user", model)
+
+    for result in results:
+        text_tokens = result.get("token_count")
+        if text_tokens is None:
+            # Chunks ingested before token counts were stored
+            text_tokens = count_tokens(result["text"], model)
+
+        label = f"{context_label} {len(packed) + 1}:  | {document_label}: {result['pdf']}"
+        message_tokens = TOKENS_PER_MESSAGE + role_tokens + text_tokens + count_tokens(label, model)
+
+        if used_tokens + message_tokens > budget:
+            continue
+
+        packed.append(result)
+        used_tokens += message_tokens
+
+    return packed, used_tokens
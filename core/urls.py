@@ -1,5 +1,6 @@
 from django.urls import path
 from core.views.document_search_api import document_response_api
+from core.views.document_response_stream_api import document_response_stream_api
 from .views.decision_pipeline_api import api_decision
 from core.views.document_update_api import document_update_api
 from core.views.get_document_list_api import get_documents_list_api
@@ -8,16 +9,21 @@ from core.views.create_chat_instance_api import create_chat_instance_api
 from core.views.get_chat_instances_api import get_chat_instances_api
 from core.views.document_upload_api import document_upload_api
 from core.views.document_delete_api import document_delete_api
+from core.views.request_ledger_summary_api import request_ledger_summary_api
+from core.views.chat_history_export_api import chat_history_export_api
 
 urlpatterns = [
     path('api/document-response/', document_response_api, name='documet_search_api'),
+    path('api/document-response-stream/', document_response_stream_api, name='document_response_stream_api'),
     path('api/document-update/', document_update_api, name='document_update_api'),
     path('api/get-documents-list/', get_documents_list_api, name='get_documents_list_api'),
     path('api/load-chat-history/', load_chat_history_api, name='load_chat_history_api'),
     path('api/create-chat-instance/', create_chat_instance_api, name='create_chat_instance_api'),
     path('api/get-chat-instances/', get_chat_instances_api, name='get_chat_instances_api'),
     path('api/document-upload/', document_upload_api, name='document_upload_api'),
-    path('api/document-delete/', document_delete_api, name='document_delete_api')
+    path('api/document-delete/', document_delete_api, name='document_delete_api'),
+    path('api/request-ledger-summary/', request_ledger_summary_api, name='request_ledger_summary_api'),
+    path('api/chat-history-export/', chat_history_export_api, name='chat_history_export_api'),
     # path('api/api-decision/', api_decision, name='api_decesion'),
 ]
 
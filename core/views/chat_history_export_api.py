@@ -0,0 +1,71 @@
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.decorators import api_view
+from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
+from core.chat_history_export import (
+    CONTENT_TYPES,
+    ExportFormatError,
+    check_format,
+    export_chat_history,
+    parse_export_time,
+)
+
+
+@extend_schema(
+    summary="Chat History Export API",
+    description=(
+        "Streams the chat history of a twin and time range as NDJSON (one JSON object per line) or Parquet, "
+        "oldest first. With include_retrieval every turn also has the endpoint, status, latency, cost and caches "
+        "of the request that answered it, and the metadata filter and chunk ids it retrieved."
+    ),
+    parameters=[
+        OpenApiParameter('twin_id', str, description='The twin version to export.', required=True),
+        OpenApiParameter('since', str, description='Only export turns from this ISO 8601 time or date on.', required=False),
+        OpenApiParameter('until', str, description='Only export turns before this ISO 8601 time or date.', required=False),
+        OpenApiParameter('export_format', str, description='ndjson (default) or parquet.', required=False),
+        OpenApiParameter('include_retrieval', bool, description='Join the retrieval of every turn. Defaults to false.', required=False),
+    ],
+    responses={
+        200: OpenApiResponse(description='The export, streamed'),
+        400: OpenApiResponse(
+            description='Bad Request - twin_id is required, since and until must be ISO 8601 times or dates, export_format ndjson or parquet',
+            response={
+                'application/json': {
+                    'type': 'object',
+                    'properties': {
+                        'error': {'type': 'string'}
+                    }
+                }
+            }
+        ),
+    }
+)
+
+@api_view(['GET'])
+def chat_history_export_api(request):
+    if request.method == 'GET':
+        twin_id = request.GET.get('twin_id')
+        # Exporting every twin at once is left to the export_chat_history command
+        if not twin_id:
+            return JsonResponse({'error': 'twin_id is required'}, status=400)
+
+        # Not "format", DRF picks the renderer by it
+        export_format = request.GET.get('export_format', 'ndjson')
+        include_retrieval = request.GET.get('include_retrieval', 'false').lower() == 'true'
+
+        try:
+            since = parse_export_time(request.GET['since']) if request.GET.get('since') else None
+            until = parse_export_time(request.GET['until']) if request.GET.get('until') else None
+        except ValueError:
+            return JsonResponse({'error': 'since and until must be ISO 8601 times or dates'}, status=400)
+
+        try:
+            check_format(export_format)
+        except ExportFormatError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        response = StreamingHttpResponse(
+            export_chat_history(export_format, twin_id, since, until, include_retrieval),
+            content_type=CONTENT_TYPES[export_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="chat_history_{twin_id}.{export_format}"'
+        return response
@@ -2,18 +2,26 @@ import json
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
 from core.models import VectorDB
+from core.answer_cache import invalidate_answer_cache
+from core.document_catalog import delete_documents
 
 def delete_data(twin_id, asset_id, integration_entity_id):
     """
-    Deletes data from the core_vectordb table based on the given twin_id, asset_id, and integration_entity_id.
+    Deletes the documents with the given twin_id, asset_id, and integration_entity_id, their chunks
+    in the core_vectordb table and their catalog rows.
     """
     try:
-        VectorDB.objects.filter(
+        rows_to_delete = VectorDB.objects.filter(
             twin_id=twin_id,
             asset_id=asset_id,
             integration_entity_id=integration_entity_id
-        ).delete()
+        )
+        twin_version_ids = set(rows_to_delete.values_list('twin_version_id', flat=True).distinct())
+        delete_documents(rows_to_delete)
         print(f"Successfully deleted data from database for twin_id: {twin_id}")
+
+        for twin_version_id in twin_version_ids:
+            invalidate_answer_cache(twin_version_id)
         return {"status": "success", "message": "Data deleted successfully."}
     except Exception as e:
         print(f"Error deleting data from DB for twin_id {twin_id}: {e}")
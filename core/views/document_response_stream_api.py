@@ -0,0 +1,203 @@
+"""
+Streaming variant of the document response endpoint. The answer is sent to the client as
+Server-Sent Events while gpt-4o-mini generates it, so the first words show up as soon as
+the first tokens arrive instead of after the full completion.
+
+Each token batch is sent as a "data" event with a JSON payload {"content": "..."}.
+The stream ends with a "done" event, or an "error" event if generation fails.
+The chat turn is saved to memory and ChatHistory once the stream has completed.
+"""
+import json
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.decorators import api_view
+from drf_spectacular.utils import extend_schema, OpenApiResponse
+from core.views.document_search_api import prepare_document_response, save_chat_turn, print_timestamp
+from core.llm_client import create_chat_completion
+from core.llm_scheduler import llm_scheduler, LLMQueueFullError, INTERACTIVE
+from core.request_metrics import start_request, stage, finish_request, record_usage, get_last_request
+from core.request_ledger import record_request_ledger
+
+
+def format_sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+def stream_document_response(query, twin_version_id, chat_instance_id, query_vector, cached_answer, valid_prompt, priority=INTERACTIVE):
+    # The request is finished and recorded whichever way the stream ends. When the client
+    # disconnects the generator is closed at a yield and the status stays 499.
+    status_code = 499
+    try:
+        try:
+            if valid_prompt is None:
+                response_content = cached_answer
+                yield format_sse_event({"content": response_content})
+            else:
+                print("Got prompt. Streaming from chatgpt")
+                print_timestamp()
+
+                with stage("generation"):
+                    stream = create_chat_completion(
+                        valid_prompt,
+                        model="gpt-4o-mini",
+                        tenant=twin_version_id,
+                        priority=priority,
+                        temperature=1,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    )
+                    response_parts = []
+                    for chunk in stream:
+                        # The last chunk carries the token usage of the whole stream
+                        if chunk.usage is not None:
+                            record_usage("chat", "gpt-4o-mini", chunk.usage.prompt_tokens, chunk.usage.completion_tokens, calls=0)
+                        if not chunk.choices:
+                            continue
+                        content = chunk.choices[0].delta.content
+                        if content:
+                            response_parts.append(content)
+                            yield format_sse_event({"content": content})
+
+                response_content = "".join(response_parts)
+                print_timestamp()
+        except Exception as e:
+            print(f"Error while streaming the response: {e}")
+            status_code = 500
+            yield format_sse_event({"error": f"Error : {str(e)}"}, event="error")
+            return
+
+        # Only a completed answer becomes part of the conversation
+        try:
+            with stage("persist"):
+                save_chat_turn(query, response_content, twin_version_id, chat_instance_id, query_vector)
+        except Exception as e:
+            print(f"Error saving streamed chat turn for chat_instance_id {chat_instance_id}: {e}")
+
+        status_code = 200
+        yield format_sse_event({}, event="done")
+    finally:
+        timings = finish_request()
+        if timings:
+            print("Stage timings (ms):", {name: round(ms, 1) for name, ms in timings.items()})
+            record_request_ledger(get_last_request(), "document-response-stream", twin_version_id, chat_instance_id, status_code)
+
+
+@extend_schema(
+    summary="Document Response Stream API",
+    description=(
+        "Same as the Document Response API, but the answer is streamed as Server-Sent Events "
+        "(text/event-stream) while it is generated. Each event carries a JSON object with the next "
+        "part of the answer in 'content'. A 'done' event ends the stream, an 'error' event reports a failure."
+    ),
+    request={
+        'application/json': {
+            'type': 'object',
+            'properties': {
+                'query': {
+                    'type': 'string',
+                    'description': 'The user query for which the search is being performed.',
+                },
+                'twin_version_id': {
+                    'type': 'string',
+                    'description': 'The version identifier for the twin or digital twin model.',
+                },
+                'chat_instance_id': {
+                    'type': 'integer',
+                    'description': 'The identifier for the chat instance.',
+                },
+                'priority': {
+                    'type': 'string',
+                    'enum': ['interactive', 'batch'],
+                    'description': 'Scheduling priority of the LLM calls. Bulk jobs should send batch. Defaults to interactive.',
+                },
+            },
+            'required': ['query', 'twin_version_id', 'chat_instance_id'],
+        }
+    },
+    responses={
+        200: OpenApiResponse(description='Stream of Server-Sent Events with the generated answer.'),
+        400: OpenApiResponse(
+            description='Bad Request - Query is required.',
+            response={
+                'application/json': {
+                    'type': 'object',
+                    'properties': {
+                        'error': {
+                            'type': 'string',
+                            'example': 'Query is required.'
+                        }
+                    }
+                }
+            }
+        ),
+        429: OpenApiResponse(
+            description='Too Many Requests - The twin has too many LLM calls queued.',
+            response={
+                'application/json': {
+                    'type': 'object',
+                    'properties': {
+                        'error': {
+                            'type': 'string',
+                            'example': 'Too many queued LLM calls for twin <twin_version_id>, try again later'
+                        }
+                    }
+                }
+            }
+        ),
+        500: OpenApiResponse(
+            description='Internal Server Error - An error occurred while processing the request.',
+            response={
+                'application/json': {
+                    'type': 'object',
+                    'properties': {
+                        'error': {
+                            'type': 'string',
+                            'example': 'Error: Some error message'
+                        }
+                    }
+                }
+            }
+        ),
+    }
+)
+
+@api_view(['POST'])
+def document_response_stream_api(request):
+    try:
+        data = json.loads(request.body)
+        query = data.get('query')
+        twin_version_id = data.get('twin_version_id')
+        chat_instance_id = data.get('chat_instance_id')
+        priority = data.get('priority', INTERACTIVE)
+        print("Received streaming request with query:", query)
+
+        print_timestamp()
+
+        if not query:
+            return JsonResponse({'error': 'Query is required'}, status=400)
+
+        llm_scheduler.check_admission(twin_version_id)
+
+        start_request()
+        query_vector, cached_answer, valid_prompt = prepare_document_response(query, twin_version_id, chat_instance_id, priority)
+
+    except LLMQueueFullError as e:
+        if finish_request():
+            record_request_ledger(get_last_request(), "document-response-stream", twin_version_id, chat_instance_id, 429)
+        return JsonResponse({"error": str(e)}, status=429)
+    except Exception as e:
+        if finish_request():
+            record_request_ledger(get_last_request(), "document-response-stream", twin_version_id, chat_instance_id, 500)
+        return JsonResponse(
+            {"error": f"Error : {str(e)}"},
+            status=500,
+        )
+
+    response = StreamingHttpResponse(
+        stream_document_response(query, twin_version_id, chat_instance_id, query_vector, cached_answer, valid_prompt, priority),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
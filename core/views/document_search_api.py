@@ -7,23 +7,34 @@ and constructing an OpenAI prompt to generate the final response.
 Authors: Chethiya Galkaduwa/ Kalana
 """
 import json
-import os
 import numpy as np
 import requests
 from dotenv import load_dotenv
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
-from openai import OpenAI
-import tiktoken
-import openai
-from core.models import ChatHistory, ChatInstance
+from core.models import ChatHistory
 import re
-from memory_manager import save_and_limit_chat_history, get_memory
+from memory_manager import save_and_limit_chat_history, load_chat_history, has_history, get_last_query
 from rest_framework.decorators import api_view
 from drf_spectacular.utils import extend_schema, OpenApiResponse
 from core.serializer import OpenAIResponseSerializer
 from ChatRAG.prompt_templates import get_prompt_template
+from core.metadata_schema import get_metadata_prompt_fragments
+from core.metadata_cache import get_cached_metadata, set_cached_metadata
+from core.metadata_extractor import extract_metadata_locally
+from core.answer_cache import lookup_similar_answer, same_identifiers
+from core.token_budget import get_encoding, count_tokens, pack_results
+from core.chat_history_writer import chat_history_writer, update_chat_instance_activity
+from core.llm_client import create_chat_completion
+from core.llm_scheduler import llm_scheduler, LLMQueueFullError, INTERACTIVE
+from core.embedding_batcher import embed_text
+from core.request_metrics import start_request, stage, finish_request, record_usage, count, cache_hit, get_last_request, bind_request, get_request_id, record_retrieval
+from core.request_ledger import record_request_ledger
+from core.retrieval_working_set import get_working_set, save_working_set, clear_working_set, find_new_terms
+from core.query_router import route_locally
+from core.query_analysis import analyze_query
+from core.speculative_retrieval import speculative_executor, is_speculation_enabled, filter_candidates, maybe_audit
 
 from datetime import datetime
 
@@ -35,30 +46,20 @@ def print_timestamp():
 
 load_dotenv()
 
-# Initialize OpenAI client
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise ValueError("OPENAI_API_KEY is not set in .env file")
-
-openai.api_key = OPENAI_API_KEY
-
-client = OpenAI(api_key=OPENAI_API_KEY)
-
 chat_history = {} 
 chat_history_with_response = {}
 MAX_HISTORY_LENGTH = 1  
 
-        
-with open('meta_data_attributes.json', 'r') as f:
-    metadata_attributes = json.load(f)
+# Number of chunks requested from the search service
+TOP_K = 12
 
 # Function to generate embedding for a single text input
 def generate_embeddings_for_single_text(text, model="text-embedding-3-small"):
-    response = client.embeddings.create(
-        model=model, 
-        input=text
-    )
-    return np.array(response.data[0].embedding)
+    # Batched with concurrent queries; on the critical path, so slow requests are hedged
+    embedding = np.array(embed_text(text, model=model, hedge=True))
+    # The batched call is made on another thread, so its share is counted here
+    record_usage("embeddings", model, count_tokens(text))
+    return embedding
 
     
 # Function to search query in the external database
@@ -66,65 +67,43 @@ def search_query(query_vector, top_k, query,twin_version_id, metadata):
     
     # print("Querying the external vector database")
 
-    url = "http://127.0.0.1:8201/search_document/VectorDB"
+    url = f"{settings.SEARCH_SERVICE_URL}/search_document/VectorDB"
 
     
     payload = {"query_vector": query_vector.tolist(), "top_k": top_k, "query": query, "twin_version_id": twin_version_id, "meta_data": metadata }
     response = requests.post(url, json=payload)
     if response.status_code == 200:
-        return response.json()['results']
+        results = response.json()['results']
+        # Every candidate is reranked by the search service
+        count("rerank_documents", len(results))
+        return results
     else:
         raise ValueError("Error querying the external vector database")
 
 
-def find_similar_previous_query(query, chat_instance_id):
+def find_similar_previous_query(query_vector, twin_version_id):
     """
-    Find similar previous queries and their markdown responses from the chat history
-    Returns: tuple (bool, str) - (found, markdown_response)
+    Find the most similar previous query of the twin and its markdown response from the chat history
+    Returns: tuple (float, str, str) - (similarity, markdown_response or None, previous_query or None)
     """
     try:
-        # Get previous chats for this instance with exact query match
-        previous_chat = ChatHistory.objects.filter(
-            chat_instance_id=chat_instance_id,
-            user_query__iexact=query  # Case-insensitive exact match
-        ).order_by('-id').first()
-        print("Previous chat found:", previous_chat)
-        
-        if previous_chat:
-            return True, previous_chat.chatbot_response
-        return False, None
-        
+        return lookup_similar_answer(twin_version_id, query_vector)
     except Exception as e:
         print(f"Error checking similar queries: {e}")
-        return False, None
+        return 0, None, None
 
 
-def construct_openai_prompt(query, final_results, twin_version_id="default",chat_instance_id=None):
+def construct_openai_prompt(query, final_results, twin_version_id="default",chat_instance_id=None, similar_response=None):
     """
     Constructs the OpenAI prompt using templates based on twin_version_id.
     Args:
         query (str): The user's query
         final_results (list): Retrieved chunks from vector database
         twin_version_id (str): ID of the twin version to determine prompt template
+        similar_response (str): Previous answer to a similar query, if one was found
     """
-    # Get the appropriate template based on twin ID
-    ##have a dictionary here so it will know to run find_similar_previous_query
-    ##if have a similar query send everything to construct the promt. ask to using the old response structure recustruct it using the new
-    #print("Chat instance ID:", chat_instance_id)
-    similar_response = None
-    # Only check for similar query for the special twin id
-    if twin_version_id == "b7586e58-9a07-47f6-8049-43d6d6f2c5e54455" and chat_instance_id:
-        found, prev_response = find_similar_previous_query(query, chat_instance_id)
-        if found:
-            similar_response = prev_response
-    prompt = get_prompt_template(twin_version_id,query,similar_response).copy()
-    
-    #print("Prompt template:", prompt)
-    
-    # Format the query into the template
-    for item in prompt:
-        if isinstance(item["content"], str):
-            item["content"] = item["content"].format(query=f"This is the query done by the user: {query}")
+    # Static instructions first, then the query, so requests of a twin share a prompt prefix
+    prompt = get_prompt_template(twin_version_id,query,similar_response)
     
     # Add the retrieved chunks as context
     for i, result in enumerate(final_results):
@@ -134,16 +113,19 @@ def construct_openai_prompt(query, final_results, twin_version_id="default",chat
     
     return prompt
 
+FOLLOW_UP_PROMPT_PREFIX = (
+     {"role": "system", "content": "This is a RAG chatbot using OpenAI to generate responses."},
+     {"role": "system", "content": "Generate a concise, accurate and complete response to the user query based on the following chunks. You Must Refer the chat history for getting the contextual understanding of the user query. Refer the metadata for further information. Reference the document knowledge or your own knowledge as needed. If the chat history is about troubleshooting, You MUST provide step by step troubleshooting guide in short. Dont use sensor data, when providing the answeres. If no relevant chunk is found, inform the user that there is no relevant information available for this question. Ensure the response is readable and appropriate for the end user. DO NOT MENTION the methodology or USING words like 'chunks', 'Chunk' or providing explanations. Any numeric value that you provide, round it off to a maximum of two decimals. You must not return any PAGE BREAK signs in the response. Ensure the response is based on the retrieved text and always mention the document it comes from as \"REFERENCES\" within brackets using the document_name from the metadata of each chunk. Only add the documents which you used to generate the answer. You MUST restrict the answer to 10-15 words."},
+)
+
 def construct_openai_prompt_follow_up_query(chat_instance_id, query, final_results):
-    memory = get_memory( chat_instance_id)
-    chat_history = memory.load_memory_variables({})["chat_history"]
+    chat_history = load_chat_history(chat_instance_id)
      
-    prompt = [
-     {"role": "system", "content": "This is a RAG chatbot using OpenAI to generate responses."},
+    # Static instructions first so every follow-up shares the same prompt prefix
+    prompt = list(FOLLOW_UP_PROMPT_PREFIX) + [
      {"role": "system", "content": f"Here is the most recent conversation history for your reference.{chat_history}"},
      {"role": "system", "content": f"This is the current user query: {query}"},
      {"role": "system", "content": "In relation to the chat history, these are text chunks retrieved from the in-house Vector database:"},
-     {"role": "system", "content": "Generate a concise, accurate and complete response to the user query based on the following chunks. You Must Refer the chat history for getting the contextual understanding of the user query. Refer the metadata for further information. Reference the document knowledge or your own knowledge as needed. If the chat history is about troubleshooting, You MUST provide step by step troubleshooting guide in short. Dont use sensor data, when providing the answeres. If no relevant chunk is found, inform the user that there is no relevant information available for this question. Ensure the response is readable and appropriate for the end user. DO NOT MENTION the methodology or USING words like 'chunks', 'Chunk' or providing explanations. Any numeric value that you provide, round it off to a maximum of two decimals. You must not return any PAGE BREAK signs in the response. Ensure the response is based on the retrieved text and always mention the document it comes from as \"REFERENCES\" within brackets using the document_name from the metadata of each chunk. Only add the documents which you used to generate the answer. You MUST restrict the answer to 10-15 words."}
     ]
     
     for i, result in enumerate(final_results):
@@ -155,8 +137,7 @@ def construct_openai_prompt_follow_up_query(chat_instance_id, query, final_resul
 
 
 def construct_openai_prompt_for_meta_data(twin_version_id, chat_instance_id, query):
-    memory = get_memory( chat_instance_id)
-    chat_history = memory.load_memory_variables({})["chat_history"]
+    chat_history = load_chat_history(chat_instance_id)
     
     prompt = [
         {"role": "system", "content": "This is a RAG chatbot using OpenAI to generate responses."},
@@ -174,25 +155,32 @@ def construct_openai_prompt_for_meta_data(twin_version_id, chat_instance_id, que
         )}
     ]
     
-    for twin_version in metadata_attributes["twin_versions"]:
-        if twin_version["twin_version_id"] == twin_version_id:
-            for attribute in twin_version["attributes"]:
-                meta_data_format = attribute["meta_data_format"]
-                meta_data_format_prompt = attribute["meta_data_format_prompt"]
-                prompt.append({
-                    "role": "system",
-                    "content": f"{meta_data_format_prompt}: {meta_data_format}"
-                })
-            break 
+    prompt.extend(get_metadata_prompt_fragments(twin_version_id))
 
     prompt.append({"role": "system", "content": "Within the resposne JSON object, Just provide the meta data attibute and the value for it only.Do not add additional details like enum, examples etc. If any of these metadata fields are not found, return null for those fields. If you can not find any meta data in the user query, just provide a null json object. The property names must be enclosed in double quotes."})
 
     return prompt
 
 
-def meta_data_extraction(twin_version_id, chat_instance_id, query):
+def meta_data_extraction(twin_version_id, chat_instance_id, query, priority=INTERACTIVE):
+    # Reuse the filter extracted earlier for the same twin, schema and query
+    cached_metadata = get_cached_metadata(twin_version_id, query)
+    if cached_metadata is not None:
+        print("Meta data cache hit.", cached_metadata)
+        cache_hit("metadata_cache")
+        return cached_metadata
+
+    # Try the rule-based extractor first and only fall back to the LLM when it is unsure
+    local_metadata, confident = extract_metadata_locally(twin_version_id, query)
+    if confident:
+        metadata = json.dumps(local_metadata)
+        print("Meta data extracted locally.", metadata)
+        cache_hit("metadata_local")
+        set_cached_metadata(twin_version_id, query, metadata)
+        return metadata
+
     openai_prompt =  construct_openai_prompt_for_meta_data(twin_version_id, chat_instance_id, query)
-    completion = client.chat.completions.create(model="gpt-4o-mini",temperature=1, messages=openai_prompt)
+    completion = create_chat_completion(openai_prompt, model="gpt-4o-mini", tenant=twin_version_id, priority=priority, temperature=1)
     response_text  = completion.choices[0].message.content
     
     print("Meta data extracted.", response_text)
@@ -200,13 +188,69 @@ def meta_data_extraction(twin_version_id, chat_instance_id, query):
     
     # Extract JSON part from the response text
     metadata = re.search(r'\{.*\}', response_text, re.DOTALL).group()
+
+    # Only cache filters that parse, so a bad completion is retried next time
+    try:
+        json.loads(metadata)
+        set_cached_metadata(twin_version_id, query, metadata)
+    except json.JSONDecodeError:
+        pass
     
     return metadata
 
 
+def metadata_needs_llm(twin_version_id, query):
+    """True when neither the metadata cache nor the local extractor has the query's filter."""
+    if get_cached_metadata(twin_version_id, query) is not None:
+        return False
+    _, confident = extract_metadata_locally(twin_version_id, query)
+    return not confident
+
+
+def get_metadata_filter(twin_version_id, chat_instance_id, query, priority=INTERACTIVE):
+    """Returns the metadata filter of the query, without the attributes that were not found."""
+    with stage("metadata"):
+        metadata_json = meta_data_extraction(twin_version_id, chat_instance_id, query, priority)
+
+    try:
+        metadata = json.loads(metadata_json)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON format in metadata: {e}")
+
+    return {key: value for key, value in metadata.items() if value is not None}
+
+
+def speculative_search(query_vector, top_k, query, twin_version_id, chat_instance_id, priority=INTERACTIVE):
+    """
+    Searches without a filter while the metadata filter is extracted, then filters the candidates.
+    Returns: tuple (results, filtered_metadata)
+    """
+    candidates_future = speculative_executor.submit(
+        bind_request(search_query), query_vector, settings.SPECULATIVE_TOP_K, query, twin_version_id, {},
+    )
+
+    filtered_metadata = get_metadata_filter(twin_version_id, chat_instance_id, query, priority)
+
+    with stage("search"):
+        candidates = candidates_future.result()
+
+    results = filter_candidates(candidates, filtered_metadata)
+    if len(results) >= min(top_k, settings.SPECULATIVE_MIN_CANDIDATES):
+        print(f"Speculative search kept {len(results)} of {len(candidates)} candidates")
+        cache_hit("speculative_search")
+        results = results[:top_k]
+        maybe_audit(search_query, twin_version_id, results, query_vector, top_k, query, filtered_metadata)
+        return results, filtered_metadata
+
+    print(f"Only {len(results)} of {len(candidates)} speculative candidates match {filtered_metadata}. Searching again.")
+    with stage("search"):
+        results = search_query(query_vector, top_k, query, twin_version_id, filtered_metadata)
+    return results, filtered_metadata
+
+
 def num_tokens_from_messages(messages, model="gpt-4o-mini"):
     """Return a list of dictionaries with message index and token count for each message."""
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     tokens_per_message = 9
     tokens_per_name = 1
 
@@ -226,106 +270,190 @@ def num_tokens_from_messages(messages, model="gpt-4o-mini"):
 
     return token_counts, total_tokens
 
+def looks_like_follow_up(query):
+    return "yes" in query.lower() or "no" in query.lower() or len(query.split()) <= 3
+
 def is_follow_up_query(query,  chat_instance_id):
-    memory = get_memory(chat_instance_id) 
-    chat_history = memory.load_memory_variables({})["chat_history"]
-    
     # Determine if the query is a follow-up
-    if len(chat_history) > 0 and ("yes" in query.lower() or "no" in query.lower() or len(query.split()) <= 3):
+    if has_history(chat_instance_id) and looks_like_follow_up(query):
         return True
     return False
 
-def get_valid_prompt(twin_version_id, query, query_vector, chat_instance_id, model="gpt-4o-mini", max_tokens=8191):
+def get_follow_up_prompt(chat_instance_id, query, results, model="gpt-4o-mini", max_tokens=8191):
+    print("Creating the final prompt")
+
+    with stage("prompt"):
+        # Only the prompt without chunks is tokenized, chunks are packed from their stored token counts
+        base_prompt = construct_openai_prompt_follow_up_query(chat_instance_id, query, [])
+        _, base_tokens = num_tokens_from_messages(base_prompt, model)
+
+        if base_tokens > max_tokens:
+            raise ValueError("Cannot fit the prompt within the token limit with the given results.")
+
+        results, context_tokens = pack_results(results, max_tokens - base_tokens, "Chunk", "Document Name", model)
+        print(f"Packed {len(results)} chunks using {base_tokens + context_tokens} tokens")
+        count("chunks_packed", len(results))
+
+        return construct_openai_prompt_follow_up_query(chat_instance_id, query, results)
+
+def get_follow_up_prompt_from_working_set(working_set, twin_version_id, query, chat_instance_id, model="gpt-4o-mini", max_tokens=8191):
+    """
+    Builds the follow-up prompt from the retrieval of the previous turn. The chunks are searched
+    again only when the follow-up adds new terms, with the previous metadata filter.
+    """
+    results = working_set["results"]
+    new_terms = find_new_terms(query, working_set["query"])
+
+    if new_terms:
+        print(f"Follow-up adds new terms {new_terms}. Searching again.")
+        search_text = f"{working_set['query']} {' '.join(new_terms)}"
+
+        # Only the new terms are embedded and added to the previous query embedding
+        with stage("embedding"):
+            query_vector = working_set["query_vector"] + generate_embeddings_for_single_text(" ".join(new_terms))
+            query_vector = query_vector / np.linalg.norm(query_vector)
+        with stage("search"):
+            results = search_query(query_vector, TOP_K, search_text, twin_version_id, working_set["metadata"])
+
+        save_working_set(chat_instance_id, twin_version_id, search_text, working_set["metadata"], query_vector, results)
+    else:
+        print("Follow-up query. Reusing the retrieval of the previous turn.")
+        cache_hit("working_set")
+        record_retrieval(query=working_set["query"], metadata=working_set["metadata"], chunk_ids=working_set["chunk_ids"], reused=True)
+
+    return get_follow_up_prompt(chat_instance_id, query, results, model, max_tokens)
+
+def get_valid_prompt(twin_version_id, query, query_vector, chat_instance_id, model="gpt-4o-mini", max_tokens=8191, similar_response=None, priority=INTERACTIVE):
     #print("Chat instance ID get_valid_prompt:", chat_instance_id)
-    top_k = 12
+    top_k = TOP_K
 
     # Check if the query is a follow-up query
     follow_up_query = is_follow_up_query(query, chat_instance_id)
 
     if follow_up_query:
         print("This is a follow-up query.")
-        # if chat_instance_id in chat_history:
-        memory = get_memory(chat_instance_id) 
-        chat_history = memory.load_memory_variables({})["chat_history"]
+        last_query = get_last_query(chat_instance_id) or query
+        
+        filtered_metadata = get_metadata_filter(twin_version_id, chat_instance_id, last_query, priority)
 
-        user_queries = [line[6:] for line in chat_history.splitlines() if line.startswith("Human:")]
+        # The follow-up text itself ("yes") says nothing about what to retrieve
+        with stage("embedding"):
+            query_vector = generate_embeddings_for_single_text(last_query)
+        with stage("search"):
+            results = search_query(query_vector, top_k, last_query, twin_version_id, filtered_metadata)
 
-        last_query = user_queries[-1] if user_queries else None
-        
-        metadata_json = meta_data_extraction(twin_version_id, chat_instance_id, last_query)
+        save_working_set(chat_instance_id, twin_version_id, last_query, filtered_metadata, query_vector, results)
+        return get_follow_up_prompt(chat_instance_id, query, results, model, max_tokens)
+      
             
-        try:
-            metadata = json.loads(metadata_json)
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Invalid JSON format in metadata: {e}")
-          
-        filtered_metadata = {key: value for key, value in metadata.items() if value is not None}
-        results = search_query(query_vector, top_k, last_query, twin_version_id, filtered_metadata)
-
-        print("Creating the final prompt")
+    else:
+        print("This is a new query. Proceeding with metadata extraction.")
 
-        # Construct the initial prompt
-        initial_prompt = construct_openai_prompt_follow_up_query(chat_instance_id, query, results)
+        # Speculating only pays off while the filter is waiting for the LLM
+        if is_speculation_enabled(twin_version_id) and metadata_needs_llm(twin_version_id, query):
+            results, filtered_metadata = speculative_search(query_vector, top_k, query, twin_version_id, chat_instance_id, priority)
+        else:
+            filtered_metadata = get_metadata_filter(twin_version_id, chat_instance_id, query, priority)
+            with stage("search"):
+                results = search_query(query_vector, top_k, query, twin_version_id, filtered_metadata)
 
-        token_counts, total_tokens = num_tokens_from_messages(initial_prompt, model)
-            
-        while total_tokens > max_tokens and results:
-            token_counts.pop()
-            results.pop()
-            print(total_tokens)
-            total_tokens = sum(item["token_count"] for item in token_counts)
+        save_working_set(chat_instance_id, twin_version_id, query, filtered_metadata, query_vector, results)
 
-        openai_prompt = construct_openai_prompt_follow_up_query(chat_instance_id, query, results)
+        print("Creating the final prompt")
+        
+        with stage("prompt"):
+            # Only the template part is tokenized, chunks are packed from their stored token counts
+            base_prompt = construct_openai_prompt(query, [], twin_version_id,chat_instance_id, similar_response)
+            _, base_tokens = num_tokens_from_messages(base_prompt, model)
 
-        if total_tokens > max_tokens:
-            raise ValueError("Cannot fit the prompt within the token limit with the given results.")
+            if base_tokens > max_tokens:
+                raise ValueError("Cannot fit the prompt within the token limit with the given results.")
 
-        return openai_prompt
-      
-            
-    else:
-        print("This is a new query. Proceeding with metadata extraction.")
+            results, context_tokens = pack_results(results, max_tokens - base_tokens, "Context", "Document", model)
+            print(f"Packed {len(results)} chunks using {base_tokens + context_tokens} tokens")
+            count("chunks_packed", len(results))
 
-        metadata_json = meta_data_extraction(twin_version_id,chat_instance_id, query)
+            # Pass twin_version_id to construct_openai_prompt
+            return construct_openai_prompt(query, results, twin_version_id,chat_instance_id, similar_response)
 
-        try:
-            metadata = json.loads(metadata_json)
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Invalid JSON format in metadata: {e}")
+def route_document_query(query, twin_version_id, chat_instance_id, priority=INTERACTIVE):
+    """
+    Routes the query before answering it, with its metadata extracted in the same step.
+    Returns: tuple (decision, query_vector) - decision is None when the query should be answered
+    from the documents, query_vector is None when the query was not embedded
+    """
+    decision = route_locally(query, twin_version_id)
+    if decision:
+        return decision, None
 
-        filtered_metadata = {key: value for key, value in metadata.items() if value is not None}
+    # A follow-up is answered from the conversation
+    if is_follow_up_query(query, chat_instance_id):
+        return None, None
 
-        results = search_query(query_vector, top_k, query, twin_version_id, filtered_metadata)
+    with stage("embedding"):
+        query_vector = generate_embeddings_for_single_text(query)
 
-        print("Creating the final prompt")
-        
-        # Pass twin_version_id to construct_openai_prompt
-        initial_prompt = construct_openai_prompt(query, results, twin_version_id,chat_instance_id)
+    with stage("routing"):
+        decision, source = analyze_query(query, twin_version_id, query_vector, priority)
+    print(f"Routed query as {decision['type']} ({source})")
 
-        token_counts, total_tokens = num_tokens_from_messages(initial_prompt, model)
+    if decision["type"] == "document_query":
+        # Its metadata is cached now, the metadata stage reads it from there
+        return None, query_vector
+    return decision, query_vector
 
-        while total_tokens > max_tokens and results:
-            token_counts.pop()
-            results.pop()
-            total_tokens = sum(item["token_count"] for item in token_counts)
+def prepare_document_response(query, twin_version_id, chat_instance_id, priority=INTERACTIVE, query_vector=None):
+    """
+    Runs everything that happens before the answer is generated.
+    Returns: tuple (query_vector, cached_answer, prompt) - prompt is None when a cached answer is reused,
+    query_vector is None for follow-up queries
+    """
+    # Follow-ups like "yes" depend on the conversation, so they are not embedded and never reuse an answer
+    if is_follow_up_query(query, chat_instance_id):
+        working_set = get_working_set(chat_instance_id, twin_version_id)
+        if working_set is not None:
+            return None, None, get_follow_up_prompt_from_working_set(working_set, twin_version_id, query, chat_instance_id)
+        return None, None, get_valid_prompt(twin_version_id, query, None, chat_instance_id, priority=priority)
+
+    if query_vector is None:
+        with stage("embedding"):
+            query_vector = generate_embeddings_for_single_text(query)
 
-        # Pass twin_version_id here as well
-        openai_prompt = construct_openai_prompt(query, results, twin_version_id,chat_instance_id)
+    with stage("answer_cache"):
+        similarity, similar_response, previous_query = find_similar_previous_query(query_vector, twin_version_id)
 
-        if total_tokens > max_tokens:
-            raise ValueError("Cannot fit the prompt within the token limit with the given results.")
+    # A near duplicate about another pump or RFI number only helps as context
+    if similar_response and similarity >= settings.ANSWER_CACHE_RETURN_THRESHOLD and same_identifiers(query, previous_query):
+        print("Returning the cached answer of a previous query.")
+        cache_hit("answer_cache")
+        # Nothing was retrieved for this turn, a follow-up must not reuse an older retrieval
+        clear_working_set(chat_instance_id)
+        return query_vector, similar_response, None
 
-        return openai_prompt
+    valid_prompt = get_valid_prompt(twin_version_id, query, query_vector,  chat_instance_id, similar_response=similar_response, priority=priority)
+    return query_vector, None, valid_prompt
 
-def save_chat_history_to_db(user_query, chatbot_response, twin_version_id, chat_instance_id):
-    chat_instance = ChatInstance.objects.get(id=chat_instance_id)
+def save_chat_history_to_db(user_query, chatbot_response, twin_version_id, chat_instance_id, query_vector=None, cacheable=True):
+    if settings.CHAT_HISTORY_WRITE_BEHIND:
+        # Written in a batch by the background writer, off the response path
+        chat_history_writer.enqueue(chat_instance_id, twin_version_id, user_query, chatbot_response, query_vector, get_request_id(), cacheable)
+        return
 
-    ChatHistory.objects.create(
-        chat_instance=chat_instance, 
+    chat_history = ChatHistory.objects.create(
+        chat_instance_id=chat_instance_id, 
         twin_id=twin_version_id,  
         user_query=user_query,
-        chatbot_response=chatbot_response
+        chatbot_response=chatbot_response,
+        query_embedding=query_vector,
+        request_id=get_request_id(),
+        cacheable=cacheable,
     )
+    update_chat_instance_activity([{"chat_instance_id": chat_instance_id, "user_query": user_query, "created_at": chat_history.created_at}])
+
+def save_chat_turn(query, response_content, twin_version_id, chat_instance_id, query_vector=None):
+    save_and_limit_chat_history(chat_instance_id, query, response_content, twin_version_id)
+    # Only follow-ups are not embedded, their answers depend on the conversation and must never be reused
+    save_chat_history_to_db(query, response_content, twin_version_id, chat_instance_id, query_vector, cacheable=query_vector is not None)
 
 @extend_schema(
     summary="Document Response API",
@@ -351,6 +479,18 @@ def save_chat_history_to_db(user_query, chatbot_response, twin_version_id, chat_
                     'type': 'integer',
                     'description': 'The identifier for the chat instance.',
                 },
+                'priority': {
+                    'type': 'string',
+                    'enum': ['interactive', 'batch'],
+                    'description': 'Scheduling priority of the LLM calls. Bulk jobs should send batch. Defaults to interactive.',
+                },
+                'route': {
+                    'type': 'boolean',
+                    'description': (
+                        'Route the query first, instead of calling the decision pipeline separately. '
+                        'Sensor and action queries are answered with their decision. Defaults to false.'
+                    ),
+                },
             },
             'required': ['query', 'twin_version_id', 'chat_instance_id'],
         }
@@ -371,6 +511,20 @@ def save_chat_history_to_db(user_query, chatbot_response, twin_version_id, chat_
                 }
             }
         ),
+        429: OpenApiResponse(
+            description='Too Many Requests - The twin has too many LLM calls queued.',
+            response={
+                'application/json': {
+                    'type': 'object',
+                    'properties': {
+                        'error': {
+                            'type': 'string',
+                            'example': 'Too many queued LLM calls for twin <twin_version_id>, try again later'
+                        }
+                    }
+                }
+            }
+        ),
         500: OpenApiResponse(
             description='Internal Server Error - An error occurred while processing the request.',
             response={
@@ -391,43 +545,64 @@ def save_chat_history_to_db(user_query, chatbot_response, twin_version_id, chat_
 @api_view(['POST'])
 def document_response_api(request):
     if request.method == 'POST':
+        status_code = 200
+        twin_version_id = chat_instance_id = None
         try:
             data = json.loads(request.body)
             query = data.get('query')
             twin_version_id = data.get('twin_version_id')
             chat_instance_id = data.get('chat_instance_id')
+            priority = data.get('priority', INTERACTIVE)
             print("Received request with query:", query)
             
             print_timestamp()
 
             if not query:
                 return JsonResponse({'error': 'Query is required'}, status=400)
-            
-            query_vector = generate_embeddings_for_single_text(query)
-   
-            valid_prompt = get_valid_prompt(twin_version_id, query, query_vector,  chat_instance_id)
-            
-            print("Got prompt. Sending to chatgpt")
-            print_timestamp()
 
-            completion = client.chat.completions.create(model="gpt-4o-mini",temperature=1, messages=valid_prompt)
-            response_message = completion.choices[0].message
-            print(response_message)
-            print_timestamp()
-            
-            save_and_limit_chat_history(chat_instance_id, query, response_message.content)
+            llm_scheduler.check_admission(twin_version_id)
+
+            start_request()
+            query_vector = None
+            if data.get('route'):
+                decision, query_vector = route_document_query(query, twin_version_id, chat_instance_id, priority)
+                if decision is not None:
+                    return JsonResponse({"decision": decision})
+
+            query_vector, response_content, valid_prompt = prepare_document_response(query, twin_version_id, chat_instance_id, priority, query_vector)
+
+            if valid_prompt is not None:
+                print("Got prompt. Sending to chatgpt")
+                print_timestamp()
+
+                with stage("generation"):
+                    completion = create_chat_completion(valid_prompt, model="gpt-4o-mini", tenant=twin_version_id, priority=priority, temperature=1)
+                response_message = completion.choices[0].message
+                print(response_message)
+                print_timestamp()
+                response_content = response_message.content
             
-            save_chat_history_to_db(query, response_message.content, twin_version_id, chat_instance_id)
+            with stage("persist"):
+                save_chat_turn(query, response_content, twin_version_id, chat_instance_id, query_vector)
             
             openai_response = {
-            "content": response_message.content,
+            "content": response_content,
             }
             
+        except LLMQueueFullError as e:
+            status_code = 429
+            return JsonResponse({"error": str(e)}, status=429)
         except Exception as e:
+            status_code = 500
             return JsonResponse(
                 {"error": f"Error : {str(e)}"},
                 status=500,
             )
+        finally:
+            timings = finish_request()
+            if timings:
+                print("Stage timings (ms):", {name: round(ms, 1) for name, ms in timings.items()})
+                record_request_ledger(get_last_request(), "document-response", twin_version_id, chat_instance_id, status_code)
             
         final_response = {
             "openai_response": openai_response,
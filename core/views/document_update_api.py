@@ -5,10 +5,10 @@ import requests
 from django.http import JsonResponse
 from core.views.document_search_api import generate_embeddings_for_single_text 
 from django.http import JsonResponse, FileResponse, HttpResponse
-import PyPDF2
 from core.models import VectorDB
-import numpy as np
-import pickle
+from core.answer_cache import invalidate_answer_cache
+from core.document_catalog import create_document, delete_documents
+from core.token_budget import count_tokens
 from django.db import transaction
 
 from pre_processing_pdf import (
@@ -62,7 +62,12 @@ def delete_document_data(procore_document_path):
             if not rows_to_delete.exists():
                 return JsonResponse({'msg': f'No data found for document path: {document_name}'}, status=404)
 
-            rows_deleted, _ = rows_to_delete.delete()
+            twin_ids = set(rows_to_delete.values_list('twin_id', flat=True).distinct())
+            rows_deleted = delete_documents(rows_to_delete)
+
+            # Documents of this endpoint store the twin version in twin_id
+            for twin_id in twin_ids:
+                invalidate_answer_cache(twin_id)
             return JsonResponse({'msg': 'Document data deleted successfully.'}, status=200)
 
     except Exception as e:
@@ -72,17 +77,23 @@ def delete_document_data(procore_document_path):
 def save_data_to_db(paragraph_chunks, embeddings, procore_document_path, twin_version_id, json_object, type):
     pdf_name = os.path.basename(procore_document_path).split(".")[0]
     
+    chunks = []
     for i, (chunk, embedding) in enumerate(zip(paragraph_chunks, embeddings)):
         page_number = i + 1 
-        VectorDB.objects.create(
+        chunks.append(VectorDB(
             page=str(page_number),
             text=chunk,
+            token_count=count_tokens(chunk),
             pdf=pdf_name,
             embedding=embedding.tolist(),
             twin_id = twin_version_id,
             meta_data = json_object,
             type = type
-        )
+        ))
+    # Documents of this endpoint store the twin version in twin_id
+    create_document(chunks, pdf_name, twin_id=twin_version_id, meta_data=json_object, type=type)
+
+    invalidate_answer_cache(twin_version_id)
 
 @csrf_exempt
 def document_update_api(request):
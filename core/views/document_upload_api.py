@@ -5,21 +5,17 @@ import requests
 import os
 import re
 from dotenv import load_dotenv
-from openai import OpenAI
 from core.models import VectorDB
+from core.answer_cache import invalidate_answer_cache
+from core.document_catalog import create_document
+from core.token_budget import count_tokens
+from core.embedding_batcher import RESULT_TIMEOUT as EMBEDDING_RESULT_TIMEOUT, get_embedding_batcher, embed_text
 import uuid
 from core.document_loaders import extract_text_from_pdf, extract_text_from_docx, convert_doc_to_pdf, convert_msg_to_pdf, extract_text_from_xlsx
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise ValueError("OPENAI_API_KEY is not set in the .env file")
-
-client = OpenAI(api_key=OPENAI_API_KEY)
-
 
 output_folder_path = 'J:\\Work\\ursaleo-chat-backend\\ChatRAG\\Documents'
 
@@ -94,8 +90,10 @@ def get_document(downloadable_url):
         print(f"Request failed with status code {response.status_code}")
         return False, None, None
         
-def chunk_embed(text_content, batch_size=1, max_tokens=8191):
+def chunk_embed(text_content, max_tokens=8191):
     #Chunk and embed the text content
+    batcher = get_embedding_batcher("text-embedding-ada-002", pool="ingest")
+    pending = []
     for paragraph in text_content:
             paragraph_text = paragraph['text']
             words = paragraph_text.split()
@@ -115,62 +113,60 @@ def chunk_embed(text_content, batch_size=1, max_tokens=8191):
             if current_chunk:
                 chunks.append(' '.join(current_chunk))
 
-            for i in range(0, len(chunks), batch_size):
+            # All chunks are queued first so the batcher can send them in a few calls
+            for chunk in chunks:
+                pending.append((paragraph, chunk, batcher.submit(chunk)))
 
-                batch = chunks[i:i + batch_size]
-                response = client.embeddings.create(
-                    model="text-embedding-ada-002", 
-                    input=batch
-                )
+    for paragraph, chunk, future in pending:
+        if 'embeddings' not in paragraph:
+            paragraph['embeddings'] = []
+        paragraph['embeddings'].append({
+            'chunk': chunk,
+            'embedding': future.result(timeout=EMBEDDING_RESULT_TIMEOUT)
                 
-                for chunk, embedding_obj in zip(batch, response.data):
-                    if 'embeddings' not in paragraph:
-                        paragraph['embeddings'] = []
-                    paragraph['embeddings'].append({
-                        'chunk': chunk,
-                        'embedding': embedding_obj.embedding
-                            
-                    })
+        })
     return text_content
 
 def embed_metadata(content):
-    response = client.embeddings.create(
-                    model="text-embedding-ada-002", 
-                    input=content
-                )
-    return response.data[0].embedding
+    return embed_text(content, model="text-embedding-ada-002", pool="ingest")
     
 
 def save_data_to_db(text_content, twin_id, twin_version_id,meta_data, integration_entity_id, asset_id, filename):
     pdf_id = str(uuid.uuid4())
     type = "document"
     page_number=0
-    success = True
+    chunks = []
     for paragraph in text_content:
         for emb_data in paragraph.get('embeddings', []):
             chunk = emb_data['chunk']
             embedding = emb_data['embedding'] 
             page_number = page_number + 1
-            # Save each chunk with its corresponding embedding in the database
-            try:
-                VectorDB.objects.create(
-                    twin_id=twin_id,
-                    twin_version_id=twin_version_id,
-                    page=page_number, 
-                    text=chunk,
-                    pdf=filename,
-                    embedding=embedding,
-                    type = type,
-                    meta_data = meta_data,
-                    pdf_id = pdf_id,
-                    asset_id = asset_id,
-                    integration_entity_id = integration_entity_id
-                )
-            except Exception as e:
-                print(f"Error saving data to DB for twin_id {twin_id}: {e}")
-                success = False
+            chunks.append(VectorDB(
+                twin_id=twin_id,
+                twin_version_id=twin_version_id,
+                page=page_number, 
+                text=chunk,
+                token_count=count_tokens(chunk),
+                pdf=filename,
+                embedding=embedding,
+                type = type,
+                meta_data = meta_data,
+                asset_id = asset_id,
+                integration_entity_id = integration_entity_id
+            ))
+    # The catalog row and all chunks are saved together, or nothing is
+    try:
+        create_document(
+            chunks, filename, twin_id, twin_version_id, meta_data,
+            asset_id=asset_id, integration_entity_id=integration_entity_id, type=type, pdf_id=pdf_id,
+        )
+        success = True
+    except Exception as e:
+        print(f"Error saving data to DB for twin_id {twin_id}: {e}")
+        success = False
     if success:
         print(f"Successfully saved data to database for twin_id: {twin_id}")
+    invalidate_answer_cache(twin_version_id)
     return success
 
 def save_metadata_to_db(text_content, embedding, twin_id, twin_version_id,meta_data, integration_entity_id, asset_id, filename):
@@ -179,19 +175,23 @@ def save_metadata_to_db(text_content, embedding, twin_id, twin_version_id,meta_d
     page_number=1
     success = True
     try:
-        VectorDB.objects.create(
+        chunk = VectorDB(
                 twin_id=twin_id,
                 twin_version_id=twin_version_id,
                 page=page_number, 
                 text=text_content,
+                token_count=count_tokens(text_content),
                 pdf=filename,
                 embedding=embedding,
                 type = type,
                 meta_data = meta_data,
-                pdf_id = pdf_id,
                 asset_id = asset_id,
                 integration_entity_id = integration_entity_id
             )
+        create_document(
+            [chunk], filename, twin_id, twin_version_id, meta_data,
+            asset_id=asset_id, integration_entity_id=integration_entity_id, type=type, pdf_id=pdf_id,
+        )
     except Exception as e:
             success = False
             print(f"Error saving data to DB for twin_id {twin_id}: {e}")
@@ -199,6 +199,7 @@ def save_metadata_to_db(text_content, embedding, twin_id, twin_version_id,meta_d
           
     if success:
         print(f"Successfully saved data to database for twin_id: {twin_id}")
+        invalidate_answer_cache(twin_version_id)
         return {"status": "success", "message": "Data saved successfully."}
     return success
 
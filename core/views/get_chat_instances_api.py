@@ -1,6 +1,7 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from core.models import ChatInstance
+from django.conf import settings
 from django.http import JsonResponse
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse, extend_schema_field
 from rest_framework import serializers
@@ -8,23 +9,37 @@ from rest_framework import serializers
 class ChatInstanceResponseSerializerWithoutTwinId(serializers.ModelSerializer):
     class Meta:
         model = ChatInstance
-        fields = ['id', 'created_at']
+        fields = ['id', 'created_at', 'last_message_at', 'message_count', 'last_query_preview']
+
+class ChatInstancePageSerializer(serializers.Serializer):
+    chat_instances = ChatInstanceResponseSerializerWithoutTwinId(many=True, help_text="A page of chat instances, newest first.")
+    has_more = serializers.BooleanField(help_text="Whether there are older chat instances after this page.")
+    next_before_id = serializers.IntegerField(
+        allow_null=True,
+        help_text="The before_id to request the next page with, null on the last page.",
+    )
         
 @extend_schema_field(ChatInstanceResponseSerializerWithoutTwinId)
 @extend_schema(
     summary="Get Chat Instances API",
-    description="Retrieve a list of all available chat instances for a given twin_id.",
+    description=(
+        "Retrieve the chat instances of a given twin_id one page at a time, newest first, with the time of "
+        "their last message, their number of messages and a preview of their last query. "
+        "Pass next_before_id as before_id to get the next page."
+    ),
     parameters=[
-        OpenApiParameter('twin_id', str, description='The unique identifier for the twin.', required=True)
+        OpenApiParameter('twin_id', str, description='The unique identifier for the twin.', required=True),
+        OpenApiParameter('before_id', int, description='Only return chat instances older than this chat instance id.', required=False),
+        OpenApiParameter('limit', int, description='Number of chat instances per page. Defaults to 50, at most 200.', required=False),
     ],
     responses={
         200: OpenApiResponse(
-            description='A list of all available chat instances',
-            response=ChatInstanceResponseSerializerWithoutTwinId(many=True),
+            description='A page of chat instances',
+            response=ChatInstancePageSerializer,
 
         ),
         400: OpenApiResponse(
-            description='Bad Request - twin_id is required',
+            description='Bad Request - twin_id is required, before_id and limit must be integers',
             response={
                 'application/json': {
                     'type': 'object',
@@ -55,6 +70,30 @@ def get_chat_instances_api(request):
         
         if not twin_id:
             return JsonResponse({'error': 'twin_id is required'}, status=400)
-        
-        chat_instances = ChatInstance.objects.filter(twin_id=twin_id).values('id', 'created_at')
-        return Response(list(chat_instances), status=200)
+
+        try:
+            before_id = request.GET.get('before_id')
+            before_id = int(before_id) if before_id else None
+            limit = int(request.GET.get('limit', settings.CHAT_HISTORY_PAGE_SIZE))
+        except ValueError:
+            return JsonResponse({'error': 'before_id and limit must be integers'}, status=400)
+
+        limit = min(max(limit, 1), settings.CHAT_HISTORY_MAX_PAGE_SIZE)
+
+        # Ids are unique and follow the creation order, so no chat instance is skipped between pages.
+        # Served by the (twin_id, id) index, one extra row tells whether there is a next page
+        chat_instances = ChatInstance.objects.filter(twin_id=twin_id)
+        if before_id is not None:
+            chat_instances = chat_instances.filter(id__lt=before_id)
+        page = list(
+            chat_instances.order_by('-id')
+            .values('id', 'created_at', 'last_message_at', 'message_count', 'last_query_preview')[:limit + 1]
+        )
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        return Response({
+            'chat_instances': page,
+            'has_more': has_more,
+            'next_before_id': page[-1]['id'] if has_more else None,
+        }, status=200)
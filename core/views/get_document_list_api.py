@@ -1,21 +1,29 @@
 import json
+from django.conf import settings
+from django.db.models import F
 from django.http import JsonResponse
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
-from core.models import VectorDB
+from core.document_catalog import catalog_uncataloged_chunks, has_uncataloged_chunks
+from core.models import Document
 from core.serializer import DocumentListResponseSerializer
 
 @extend_schema(
     summary="Get Documents List API",
-    description="Retrieve a list of all available documents for a given twin_id.",
+    description=(
+        "Retrieve the documents of a given twin_id from the document catalog one page at a time, newest first. "
+        "Pass next_before_id as before_id to get the next page."
+    ),
     parameters=[
-        OpenApiParameter('twin_id', str, description='The unique identifier for the twin.', required=True)
+        OpenApiParameter('twin_id', str, description='The unique identifier for the twin.', required=True),
+        OpenApiParameter('before_id', int, description='Only return documents older than this document id.', required=False),
+        OpenApiParameter('limit', int, description='Number of documents per page. Defaults to 50, at most 200.', required=False),
     ],
     responses={
         200: DocumentListResponseSerializer,
         400: OpenApiResponse(
-            description='Bad Request - twin_id is required',
+            description='Bad Request - twin_id is required, before_id and limit must be integers',
             response={
                 'application/json': {
                     'type': 'object',
@@ -47,13 +55,39 @@ def get_documents_list_api(request):
         if not twin_id:
             return JsonResponse({'error': 'twin_id is required'}, status=400)
 
-        documents = VectorDB.objects.filter(twin_id=twin_id).distinct('pdf_id').values('pdf_id', 'pdf')
-
-        # Convert the QuerySet to a list
-        documents_list = list(documents)
+        try:
+            before_id = request.GET.get('before_id')
+            before_id = int(before_id) if before_id else None
+            limit = int(request.GET.get('limit', settings.DOCUMENT_LIST_PAGE_SIZE))
+        except ValueError:
+            return JsonResponse({'error': 'before_id and limit must be integers'}, status=400)
+
+        limit = min(max(limit, 1), settings.DOCUMENT_LIST_MAX_PAGE_SIZE)
+
+        # Documents ingested before the catalog existed are cataloged on the twin's first list
+        if before_id is None and has_uncataloged_chunks(twin_id):
+            documents_added, chunks_added = catalog_uncataloged_chunks(twin_id)
+            print(f"Cataloged {chunks_added} chunks of {documents_added} documents for twin_id: {twin_id}")
+
+        # One catalog row per document, served by the (twin_id, id) index
+        documents = Document.objects.filter(twin_id=twin_id)
+        if before_id is not None:
+            documents = documents.filter(id__lt=before_id)
+
+        # One extra row tells whether there is a next page
+        page = list(
+            documents.order_by('-id').values(
+                'id', 'pdf_id', 'twin_version_id', 'type', 'asset_id', 'integration_entity_id',
+                'meta_data', 'chunk_count', 'created_at', 'updated_at', pdf=F('name'),
+            )[:limit + 1]
+        )
+        has_more = len(page) > limit
+        page = page[:limit]
 
         final_response = {
-            'documents': documents_list,
+            'documents': page,
+            'has_more': has_more,
+            'next_before_id': page[-1]['id'] if has_more else None,
         }
 
     except Exception as e:
@@ -62,7 +96,6 @@ def get_documents_list_api(request):
     return JsonResponse(final_response)
 
 
-
 # import json
 # from django.http import JsonResponse
 # from django.views.decorators.csrf import csrf_exempt
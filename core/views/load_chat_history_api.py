@@ -1,3 +1,7 @@
+from datetime import timezone as dt_timezone
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.http import JsonResponse
 from core.models import ChatHistory
 from django.views.decorators.csrf import csrf_exempt
@@ -10,10 +14,18 @@ LIMIT = 3
 
 @extend_schema(
     summary="Load Chat History API",
-    description="Retrieve the chat history for a given chat instance in a particular twin.",
+    description=(
+        "Retrieve the chat history for a given chat instance in a particular twin, one page at a time. "
+        "The first page has the most recent items. Pass next_before_id as before_id and next_before_created_at "
+        "as before_created_at to get the page before it. "
+        "Items within a page are in chronological order."
+    ),
     parameters=[
         OpenApiParameter('twin_id', str, description='The unique identifier for the twin.', required=True),
-        OpenApiParameter('chat_instance_id', int, description='The unique identifier for the chat instance.', required=True)
+        OpenApiParameter('chat_instance_id', int, description='The unique identifier for the chat instance.', required=True),
+        OpenApiParameter('before_id', int, description='Only return items older than this item id.', required=False),
+        OpenApiParameter('before_created_at', str, description='The created_at of the before_id item, ISO 8601. Lets the database skip the newer monthly partitions.', required=False),
+        OpenApiParameter('limit', int, description='Number of items per page. Defaults to 50, at most 200.', required=False),
     ],
     responses={
         200: OpenApiResponse(
@@ -21,7 +33,7 @@ LIMIT = 3
         response=ChatHistoryResponseSerializer
         ),
         400: OpenApiResponse(
-            description='Bad Request - twin_id is required',
+            description='Bad Request - twin_id and chat_instance_id are required, chat_instance_id, before_id and limit must be integers, before_created_at an ISO 8601 time',
             response={
                 'application/json': {
                     'type': 'object',
@@ -59,22 +71,49 @@ def load_chat_history_api(request):
         if not chat_instance_id:
             return JsonResponse({'error': 'chat_instance_id is required'}, status=400)
         
-        chat_instance_id = int(chat_instance_id)
+        try:
+            chat_instance_id = int(chat_instance_id)
+            before_id = request.GET.get('before_id')
+            before_id = int(before_id) if before_id else None
+            limit = int(request.GET.get('limit', settings.CHAT_HISTORY_PAGE_SIZE))
+        except ValueError:
+            return JsonResponse({'error': 'chat_instance_id, before_id and limit must be integers'}, status=400)
 
-        
-        #Fetch chat history for the given twin_id and chat_instance_id
+        limit = min(max(limit, 1), settings.CHAT_HISTORY_MAX_PAGE_SIZE)
+
+        before_created_at = request.GET.get('before_created_at')
+        if before_created_at:
+            before_created_at = parse_datetime(before_created_at)
+            if before_created_at is None:
+                return JsonResponse({'error': 'before_created_at must be an ISO 8601 time'}, status=400)
+            if timezone.is_naive(before_created_at):
+                before_created_at = timezone.make_aware(before_created_at)
+
+        #Fetch one page of chat history for the given twin_id and chat_instance_id, newest first.
+        #The (twin_id, chat_instance_id, id) index lets this read only the rows of the page.
         chat_history = ChatHistory.objects.filter(
             twin_id=twin_id,
             chat_instance_id=chat_instance_id
-        ).order_by('-id')
-        
+        )
+        if before_id is not None:
+            chat_history = chat_history.filter(id__lt=before_id)
+        # Turns are stamped when they are queued, so older ids are never newer. The bound on the
+        # partition key keeps PostgreSQL out of the partitions of the months after the cursor.
+        if before_created_at:
+            chat_history = chat_history.filter(created_at__lte=before_created_at)
 
-        # If no chat history found for the twin_id
-        if not chat_history.exists():
-            return JsonResponse({'chat_history': []}, status=200)
-        
-        chat_history_list = list(chat_history.values('user_query', 'chatbot_response'))[::-1]
+        # One extra row tells whether there is an older page
+        page = list(chat_history.order_by('-id').values('id', 'user_query', 'chatbot_response', 'created_at')[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+        # The full microseconds in UTC, the JSON encoder would cut them to milliseconds
+        next_before_created_at = page[-1]['created_at'].astimezone(dt_timezone.utc).isoformat().replace('+00:00', 'Z') if has_more else None
+        for item in page:
+            del item['created_at']
 
         return JsonResponse({
-            'chat_history': chat_history_list
+            'chat_history': page[::-1],
+            'has_more': has_more,
+            'next_before_id': page[-1]['id'] if has_more else None,
+            'next_before_created_at': next_before_created_at,
         }, status=200)
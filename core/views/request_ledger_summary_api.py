@@ -0,0 +1,110 @@
+from datetime import timedelta
+from django.db.models import Aggregate, Count, FloatField, Q, Sum
+from django.db.models.functions import TruncDate
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
+from core.models import RequestLedger
+
+
+class PercentileCont(Aggregate):
+    function = "percentile_cont"
+    template = "%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)"
+    output_field = FloatField()
+
+    def __init__(self, expression, percentile, **extra):
+        super().__init__(expression, percentile=percentile, **extra)
+
+
+@extend_schema(
+    summary="Request Ledger Summary API",
+    description=(
+        "Daily latency and cost per twin from the request ledger: number of requests and errors, "
+        "p50 and p95 end to end latency in ms, tokens used and the total and per request cost in USD."
+    ),
+    parameters=[
+        OpenApiParameter('twin_id', str, description='Only summarize this twin version.', required=False),
+        OpenApiParameter('days', int, description='Number of days to summarize, including today. Defaults to 7.', required=False),
+    ],
+    responses={
+        200: OpenApiResponse(
+            description='One row per twin and day, most recent day first',
+            response={
+                'application/json': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {
+                            'twin_id': {'type': 'string'},
+                            'day': {'type': 'string', 'format': 'date'},
+                            'requests': {'type': 'integer'},
+                            'errors': {'type': 'integer'},
+                            'p50_ms': {'type': 'number'},
+                            'p95_ms': {'type': 'number'},
+                            'llm_calls': {'type': 'integer'},
+                            'prompt_tokens': {'type': 'integer'},
+                            'completion_tokens': {'type': 'integer'},
+                            'embedding_tokens': {'type': 'integer'},
+                            'cost_usd': {'type': 'number'},
+                            'cost_per_request_usd': {'type': 'number'},
+                        }
+                    }
+                }
+            }
+        ),
+        400: OpenApiResponse(
+            description='Bad Request - days must be a positive integer',
+            response={
+                'application/json': {
+                    'type': 'object',
+                    'properties': {
+                        'error': {'type': 'string'}
+                    }
+                }
+            }
+        ),
+    }
+)
+
+@api_view(['GET'])
+def request_ledger_summary_api(request):
+    if request.method == 'GET':
+        twin_id = request.GET.get('twin_id')
+
+        try:
+            days = int(request.GET.get('days', 7))
+        except ValueError:
+            days = 0
+        if days < 1:
+            return JsonResponse({'error': 'days must be a positive integer'}, status=400)
+
+        since = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+        ledger = RequestLedger.objects.filter(created_at__gte=since)
+        if twin_id:
+            ledger = ledger.filter(twin_id=twin_id)
+
+        rows = (
+            ledger.annotate(day=TruncDate('created_at'))
+            .values('twin_id', 'day')
+            .annotate(
+                requests=Count('id'),
+                errors=Count('id', filter=~Q(status_code=200)),
+                p50_ms=PercentileCont('total_ms', 0.5),
+                p95_ms=PercentileCont('total_ms', 0.95),
+                llm_calls=Sum('llm_calls'),
+                prompt_tokens=Sum('prompt_tokens'),
+                completion_tokens=Sum('completion_tokens'),
+                embedding_tokens=Sum('embedding_tokens'),
+                cost_usd=Sum('cost_usd'),
+            )
+            .order_by('-day', 'twin_id')
+        )
+
+        summary = []
+        for row in rows:
+            row['cost_per_request_usd'] = row['cost_usd'] / row['requests'] if row['requests'] else 0
+            summary.append(row)
+
+        return Response(summary, status=200)
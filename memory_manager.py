@@ -32,37 +32,443 @@
 #     save_chat_history( chat_instance_id, query, response)
 #     limit_memory( chat_instance_id, max_items)
 
-from langchain.memory import ConversationBufferMemory 
+"""
+Conversation memory of each chat instance, used to detect follow-up queries and as chat
+history in the prompts.
 
-memory_store = {}
+A conversation is a deque of its most recent turns, each with its token count computed once,
+and a rolling summary of the turns before them. Turns are kept while they fit in
+CONVERSATION_MEMORY_TOKEN_BUDGET (at most CONVERSATION_MEMORY_MAX_TURNS). Older turns are
+folded into the summary by a background LLM call, so the history in a prompt stays small
+however long the chat gets. The summary calls of a chat run one at a time in a process, each
+one folding every turn that overflowed since the last one into the stored summary.
 
-# Function to get or create memory for a specific  chat_instance_id
-def get_memory(chat_instance_id):
-    if  chat_instance_id not in memory_store:
-        memory_store[chat_instance_id] = ConversationBufferMemory(memory_key="chat_history", input_key="query")
-    return memory_store[chat_instance_id]
+Every change is a read-modify-write of the stored memory under a lock shared by all processes:
+the chat_memory row (select_for_update) or a lock key in the cache. A new turn is appended to
+the stored turns, not to the process's copy of them. The summary is made without the lock and
+only stored if the summary it was made from is still the stored one; otherwise its turns are
+summarized again, together with the stored summary.
 
-# Function to save chat history
-def save_chat_history(chat_instance_id, query, response):
-    memory = get_memory(chat_instance_id)
-    # Save the response as a string
-    memory.save_context({"query": query}, {"response": response})
+Conversations live in a shared backend, so every worker process sees the same conversation
+and it survives restarts: the chat_memory table (CONVERSATION_MEMORY_BACKEND = "database") or
+a Django cache (CONVERSATION_MEMORY_BACKEND = "cache", with CONVERSATION_MEMORY_CACHE_ALIAS
+pointing at e.g. a Redis cache). A bounded LRU in each process keeps the conversations read
+in the last CONVERSATION_MEMORY_LOCAL_TTL seconds, so the repeated reads of one request hit
+memory. When a chat has no memory in the backend, it is rebuilt from its last rows in
+chat_history of the last CONVERSATION_MEMORY_HYDRATE_DAYS days.
+"""
+import threading
+import time
+import uuid
+from datetime import timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from core.models import ChatHistory, ChatMemory
+from core.token_budget import count_tokens, get_encoding
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation between a user and a document assistant below in at most {words} words. "
+    "The summary is given to the assistant as context for the next questions, so keep the equipment, documents, "
+    "people, dates and open questions that were mentioned. Only return the summary."
+)
+
+
+def format_turn(query, response):
+    return f"Human: {query}\nAI: {response}"
+
+
+class Turn:
+    __slots__ = ("query", "response", "tokens")
+
+    def __init__(self, query, response, tokens=None):
+        self.query = query
+        self.response = response
+        self.tokens = tokens if tokens is not None else count_tokens(format_turn(query, response))
+
+    def to_dict(self):
+        return {"query": self.query, "response": self.response, "tokens": self.tokens}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["query"], data["response"], data.get("tokens"))
+
+
+class Conversation:
+    __slots__ = ("turns", "summary")
+
+    def __init__(self, turns=(), summary="", max_turns=None):
+        self.turns = deque(turns, maxlen=max_turns)
+        self.summary = summary or ""
+
+    @property
+    def last_query(self):
+        return self.turns[-1].query if self.turns else None
+
+    def fold(self, token_budget):
+        """Removes the oldest turns over the token budget, the newest one is always kept. Returns them."""
+        overflow = []
+        total = sum(turn.tokens for turn in self.turns)
+        while len(self.turns) > 1 and total > token_budget:
+            turn = self.turns.popleft()
+            total -= turn.tokens
+            overflow.append(turn)
+        return overflow
+
+
+class DatabaseMemoryBackend:
+    def get(self, chat_instance_id):
+        return ChatMemory.objects.filter(chat_instance_id=chat_instance_id).values("turns", "summary").first()
+
+    def update(self, chat_instance_id, change):
+        """
+        Calls change with the stored {"turns", "summary"} (None when there is none) while the
+        chat_memory row is locked, and stores what it returns. Nothing is stored when it returns None.
+        """
+        try:
+            return self._update(chat_instance_id, change)
+        except IntegrityError:
+            # Another process created the row first, change it under that row's lock
+            return self._update(chat_instance_id, change)
+
+    def _update(self, chat_instance_id, change):
+        with transaction.atomic():
+            row = ChatMemory.objects.select_for_update().filter(chat_instance_id=chat_instance_id).first()
+            memory = change({"turns": row.turns, "summary": row.summary} if row is not None else None)
+            if memory is None:
+                return None
+            if row is None:
+                ChatMemory.objects.create(chat_instance_id=chat_instance_id, turns=memory["turns"], summary=memory["summary"])
+            else:
+                row.turns = memory["turns"]
+                row.summary = memory["summary"]
+                row.save(update_fields=["turns", "summary", "updated_at"])
+            return memory
+
+
+class CacheMemoryBackend:
+    # Longest a lock is held, it expires on its own if its process dies while holding it
+    LOCK_TIMEOUT = 5
+
+    def __init__(self, alias, timeout):
+        self.alias = alias
+        self.timeout = timeout
+
+    def _key(self, chat_instance_id):
+        return f"chat_memory:{chat_instance_id}"
+
+    def get(self, chat_instance_id):
+        return caches[self.alias].get(self._key(chat_instance_id))
+
+    def update(self, chat_instance_id, change):
+        """Same as DatabaseMemoryBackend.update, locked with a key that only one process can add."""
+        cache = caches[self.alias]
+        lock_key = f"{self._key(chat_instance_id)}:lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.LOCK_TIMEOUT
+        # cache.add is atomic in the shared cache backends (Redis, Memcached)
+        while not cache.add(lock_key, token, timeout=self.LOCK_TIMEOUT):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not lock the memory of chat instance {chat_instance_id}")
+            time.sleep(0.01)
+        try:
+            memory = change(self.get(chat_instance_id))
+            if memory is not None:
+                cache.set(self._key(chat_instance_id), memory, timeout=self.timeout)
+            return memory
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+
+class MemoryStore:
+    """
+    Conversations per chat instance over a shared backend, with an LRU of at most
+    max_entries chats in front of it whose entries are trusted for local_ttl seconds.
+    """
+
+    def __init__(self, backend, max_turns, token_budget, max_entries, local_ttl):
+        self.backend = backend
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-summary")
+        # Overflowed turns per chat waiting to be summarized, and the chats being summarized
+        self._pending = {}
+        self._summarizing = set()
+
+    def _get_local(self, chat_instance_id):
+        with self._lock:
+            entry = self._local.get(chat_instance_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.local_ttl:
+                del self._local[chat_instance_id]
+                return None
+            self._local.move_to_end(chat_instance_id)
+            return entry[1]
+
+    def _set_local(self, chat_instance_id, conversation, keep_summary=False):
+        with self._lock:
+            entry = self._local.get(chat_instance_id)
+            if keep_summary and entry is not None:
+                # A summary stored since the conversation was copied is newer than its own
+                conversation.summary = entry[1].summary
+            self._local[chat_instance_id] = (time.monotonic(), conversation)
+            self._local.move_to_end(chat_instance_id)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def _save_hydrated(self, chat_instance_id, conversation):
+        """Stores a conversation rebuilt from chat_history, unless another process stored one first."""
+        turns = [turn.to_dict() for turn in conversation.turns]
+        try:
+            self.backend.update(
+                chat_instance_id,
+                lambda memory: {"turns": turns, "summary": ""} if memory is None else None,
+            )
+        except Exception as e:
+            print(f"Error saving the memory of chat instance {chat_instance_id}: {e}")
+
+    def _hydrate(self, chat_instance_id):
+        since = timezone.now() - timedelta(days=settings.CONVERSATION_MEMORY_HYDRATE_DAYS)
+        rows = (
+            ChatHistory.objects.filter(chat_instance_id=chat_instance_id, created_at__gte=since)
+            .order_by("-id")
+            .values("user_query", "chatbot_response")[:self.max_turns]
+        )
+        turns = [Turn(row["user_query"], row["chatbot_response"]) for row in reversed(rows)]
+        conversation = Conversation(turns, max_turns=self.max_turns)
+        # Turns that no longer fit are dropped, they are older than any summary would be useful for
+        conversation.fold(self.token_budget)
+        return conversation
+
+    def get_conversation(self, chat_instance_id):
+        conversation = self._get_local(chat_instance_id)
+        if conversation is not None:
+            return conversation
 
+        try:
+            memory = self.backend.get(chat_instance_id)
+            if memory is not None:
+                conversation = Conversation(
+                    (Turn.from_dict(turn) for turn in memory["turns"]), memory["summary"], self.max_turns,
+                )
+            else:
+                conversation = self._hydrate(chat_instance_id)
+                if conversation.turns:
+                    self._save_hydrated(chat_instance_id, conversation)
+        except Exception as e:
+            print(f"Error loading the memory of chat instance {chat_instance_id}: {e}")
+            conversation = Conversation(max_turns=self.max_turns)
 
-# Function to load chat history
-def load_chat_history( chat_instance_id):
-    memory = get_memory( chat_instance_id)
-    return memory.load_memory_variables({})["chat_history"]
+        self._set_local(chat_instance_id, conversation)
+        return conversation
 
-# Function to limit the chat history to a maximum number of items
-def limit_memory( chat_instance_id, max_items=3):
-    memory = get_memory( chat_instance_id)
-    history = memory.load_memory_variables({})["chat_history"]
-    if len(history) > max_items:
-        memory.chat_memory.messages = memory.chat_memory.messages[-max_items:]
+    def _append(self, conversation, turn):
+        """Returns a new conversation with the turn appended, and the turns that overflowed."""
+        # A new object, so readers of the cached one never see it half updated
+        conversation = Conversation(conversation.turns, conversation.summary, self.max_turns)
+        if len(conversation.turns) == self.max_turns:
+            overflow = [conversation.turns[0]]
+        else:
+            overflow = []
+        conversation.turns.append(turn)
+        overflow += conversation.fold(self.token_budget)
+        return conversation, overflow
 
-# Example usage of the limit function
-def save_and_limit_chat_history( chat_instance_id, query, response, max_items=2):
-    save_chat_history( chat_instance_id, query, response)
-    limit_memory( chat_instance_id, max_items)
+    def add_turn(self, chat_instance_id, query, response, twin_version_id=None):
+        # Hydrates the chat's memory from chat_history when it has none yet
+        current = self.get_conversation(chat_instance_id)
+        turn = Turn(query, response)
+        result = {}
 
+        def append_to_stored(memory):
+            # The stored turns, a turn added by another process since this one read them is kept
+            stored = current if memory is None else Conversation(
+                (Turn.from_dict(data) for data in memory["turns"]), memory["summary"], self.max_turns,
+            )
+            result["conversation"], result["overflow"] = self._append(stored, turn)
+            return {"turns": [data.to_dict() for data in result["conversation"].turns], "summary": result["conversation"].summary}
+
+        try:
+            self.backend.update(chat_instance_id, append_to_stored)
+            self._set_local(chat_instance_id, result["conversation"])
+        except Exception as e:
+            print(f"Error saving the memory of chat instance {chat_instance_id}: {e}")
+            result["conversation"], result["overflow"] = self._append(current, turn)
+            self._set_local(chat_instance_id, result["conversation"], keep_summary=True)
+        overflow = result["overflow"]
+
+        if overflow:
+            with self._lock:
+                self._pending.setdefault(chat_instance_id, []).extend(overflow)
+                if chat_instance_id in self._summarizing:
+                    # The running summarization picks them up next
+                    return
+                self._summarizing.add(chat_instance_id)
+            self._summary_executor.submit(self._summarize_pending, chat_instance_id, twin_version_id)
+
+    def _summarize_pending(self, chat_instance_id, twin_version_id):
+        """Summarizes the chat's overflowed turns until none are left, one call at a time."""
+        while True:
+            with self._lock:
+                overflow = self._pending.pop(chat_instance_id, None)
+                if not overflow:
+                    self._summarizing.discard(chat_instance_id)
+                    return
+            try:
+                stored = self._summarize(chat_instance_id, overflow, twin_version_id)
+            except Exception as e:
+                print(f"Error summarizing the memory of chat instance {chat_instance_id}: {e}")
+                continue
+            if not stored:
+                # The stored summary changed during the call, fold the turns into the new one
+                with self._lock:
+                    self._pending[chat_instance_id] = overflow + self._pending.get(chat_instance_id, [])
+
+    def _summarize(self, chat_instance_id, overflow, twin_version_id):
+        """
+        Folds the overflowed turns into the chat's stored summary. Returns False when the stored
+        summary changed while the summary was made, so it was not stored.
+        """
+        # Imported here, the memory itself does not need the OpenAI client
+        from core.llm_client import create_chat_completion
+        from core.llm_scheduler import BATCH
+
+        memory = self.backend.get(chat_instance_id)
+        previous_summary = memory["summary"] if memory is not None else ""
+
+        text = "\n".join(format_turn(turn.query, turn.response) for turn in overflow)
+        if previous_summary:
+            text = f"Summary of the conversation so far: {previous_summary}\n{text}"
+
+        try:
+            completion = create_chat_completion(
+                [
+                    {"role": "system", "content": SUMMARY_PROMPT.format(words=settings.CONVERSATION_SUMMARY_MAX_WORDS)},
+                    {"role": "user", "content": text},
+                ],
+                model="gpt-4o-mini",
+                pool="ingest",
+                tenant=twin_version_id,
+                priority=BATCH,
+                temperature=0,
+            )
+            summary = completion.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"Error summarizing the memory of chat instance {chat_instance_id}: {e}")
+            return True
+
+        changed = []
+
+        def store_summary(memory):
+            if memory is None:
+                return None
+            if memory["summary"] != previous_summary:
+                changed.append(True)
+                return None
+            return {"turns": memory["turns"], "summary": summary}
+
+        try:
+            # The LLM call runs without the lock, so it never blocks a new turn of the chat
+            self.backend.update(chat_instance_id, store_summary)
+        except Exception as e:
+            print(f"Error saving the memory summary of chat instance {chat_instance_id}: {e}")
+            return True
+        if changed:
+            return False
+
+        # Readers only replace the cached conversation, so setting its summary is safe
+        with self._lock:
+            entry = self._local.get(chat_instance_id)
+            if entry is not None:
+                entry[1].summary = summary
+        return True
+
+
+def _create_backend():
+    if settings.CONVERSATION_MEMORY_BACKEND == "cache":
+        return CacheMemoryBackend(settings.CONVERSATION_MEMORY_CACHE_ALIAS, settings.CONVERSATION_MEMORY_TTL)
+    return DatabaseMemoryBackend()
+
+
+memory_store = MemoryStore(
+    _create_backend(),
+    max_turns=settings.CONVERSATION_MEMORY_MAX_TURNS,
+    token_budget=settings.CONVERSATION_MEMORY_TOKEN_BUDGET,
+    max_entries=settings.CONVERSATION_MEMORY_LOCAL_SIZE,
+    local_ttl=settings.CONVERSATION_MEMORY_LOCAL_TTL,
+)
+
+
+def _chat_key(chat_instance_id):
+    try:
+        return int(chat_instance_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_conversation(chat_instance_id):
+    """Returns the chat's Conversation, which must not be modified."""
+    key = _chat_key(chat_instance_id)
+    if key is None:
+        return Conversation()
+    return memory_store.get_conversation(key)
+
+
+def has_history(chat_instance_id):
+    return bool(get_conversation(chat_instance_id).turns)
+
+
+def get_last_query(chat_instance_id):
+    """Returns the user query of the chat's last turn, or None."""
+    return get_conversation(chat_instance_id).last_query
+
+
+def _truncate(text, max_tokens):
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens]) + " ..."
+
+
+# Function to load chat history, formatted the way the prompts have always shown it
+def load_chat_history(chat_instance_id, max_tokens=None):
+    """
+    Returns the summary of the earlier conversation and the newest turns that fit in max_tokens
+    (CONVERSATION_MEMORY_TOKEN_BUDGET by default). A newest turn longer than that is truncated.
+    """
+    conversation = get_conversation(chat_instance_id)
+    budget = max_tokens or settings.CONVERSATION_MEMORY_TOKEN_BUDGET
+
+    window = []
+    used = 0
+    for turn in reversed(conversation.turns):
+        if used + turn.tokens > budget:
+            if not window:
+                window.append(_truncate(format_turn(turn.query, turn.response), budget))
+            break
+        window.append(format_turn(turn.query, turn.response))
+        used += turn.tokens
+
+    lines = []
+    if conversation.summary:
+        lines.append(f"Summary of the earlier conversation: {conversation.summary}")
+    lines.extend(reversed(window))
+    return "\n".join(lines)
+
+
+# Function to save chat history
+def save_and_limit_chat_history(chat_instance_id, query, response, twin_version_id=None):
+    key = _chat_key(chat_instance_id)
+    if key is None:
+        return
+    memory_store.add_turn(key, query, response, twin_version_id)
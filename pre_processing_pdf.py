@@ -11,23 +11,15 @@ SCRIPT WILL CREATE IF A NEW JSON NAME IS PROVIDED UPDATE IF EXSITING NAME IS PRO
 Author: Chethiya Galkaduwa
 """
 
-import fitz  # PyMuPDF
 import json
 import os
 import numpy as np
 from dotenv import load_dotenv
-from openai import OpenAI
+from core.llm_client import create_embeddings
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise ValueError("OPENAI_API_KEY is not set in the .env file")
-
-client = OpenAI(api_key=OPENAI_API_KEY)
-
 # Constants for directories and file paths
 PDF_DIRECTORY = "pdf_doc_1"  # Specify the PDF directory
 JSON_FILE = "paragraph_chunks_toweronly.json"
@@ -40,6 +32,8 @@ def list_pdf_files(directory):
 # Function to extract paragraphs from each page of the PDF
 def extract_paragraphs_from_pdf(pdf_path, pages_per_chunk=1):
     """Extract paragraphs from each page of the PDF and group them into chunks."""
+    import fitz  # PyMuPDF, only needed when a PDF is processed
+
     doc = fitz.open(pdf_path)
     paragraphs = []
     all_text = ""
@@ -113,10 +107,7 @@ def generate_embeddings(texts, batch_size=1):
     embeddings = []
     for i in range(0, len(texts), batch_size):
         batch = texts[i:i+batch_size]
-        response = client.embeddings.create(
-            model="text-embedding-3-small", 
-            input=batch
-        )
+        response = create_embeddings(batch, model="text-embedding-3-small", pool="ingest")
         # Access the embeddings using dot notation
         for data in response.data:
             embeddings.append(data.embedding)